@@ -1,8 +1,213 @@
 from SHERPA_funcs import *
 from datetime import datetime
 
-def sherpa(lblFile, outDir, roi):
+def rcStage(opts, iFiles, oFiles, OperMode):
+  """
+    Build the range compression stage requested in opts, or None.  Without
+    a fixed chirp each trace is matched against the chirp for the aux
+    TX_TEMP/RX_TEMP interpolated onto its SCET (see joinGeometry).
+  """
+  if opts.get('rc') is None:
+    return None
+  os.makedirs(os.path.dirname(oFiles['RC']), exist_ok=True)
+  rc = {'power': opts['rc'] == 'power', 'cal': opts.get('cal', False), 'interp': opts.get('interp', False)}
+  if opts.get('chirp') is not None:
+    rc['H'] = chirpSpectrum(*opts['chirp'], cal=rc['cal'])
+  else:
+    temps = joinGeometry(iFiles['AUX'], iFiles['SCIENCE'], OperMode['recLen'], columns=['TX_TEMP', 'RX_TEMP'])
+    rc['TX_TEMP'] = temps['TX_TEMP']
+    rc['RX_TEMP'] = temps['RX_TEMP']
+  return rc
+
+
+def stackStage(opts, iFiles, oFiles):
+  """
+    Build the along-track stacking stage requested in opts, or None
+  """
+  if opts.get('stack') is None and opts.get('stackDistance') is None:
+    return None
+  os.makedirs(os.path.dirname(oFiles['STACK']), exist_ok=True)
+  return {'n': opts.get('stack'), 'distance': opts.get('stackDistance'), 'power': opts.get('stackPower', False),
+          'aux': iFiles['AUX']}
+
+
+def alignStage(opts, iFiles, OperMode):
+  """
+    Per-record receive window shifts for the alignment requested in opts,
+    or None
+  """
+  if not opts.get('align'):
+    return None
+  shift, ref = alignShifts(iFiles['SCIENCE'], OperMode['recLen'], opts.get('alignRef'))
+  return {'shift': shift, 'ref': ref}
+
+
+def geometryStage(opts, iFiles, oFiles, OperMode):
+  """
+    Per-trace geometry interpolated from the aux records when requested in
+    opts, or None
+  """
+  if not opts.get('geometry'):
+    return None
+  os.makedirs(os.path.dirname(oFiles['GEOMETRY']), exist_ok=True)
+  sciBytes = os.path.getsize(iFiles['SCIENCE'])
+  with timeStage(oFiles.get('_stats'), 'joinGeometry', OperMode['nrec'], sciBytes):
+    return joinGeometry(iFiles['AUX'], iFiles['SCIENCE'], OperMode['recLen'])
+
+
+def stackOut(o, fmt):
+  return [o['STACK'], tableName(o['STACK_ANC'], fmt), tableName(o['STACK_AUX'], fmt)]
+
+
+def reportStats(iFiles, oFiles, OperMode, roi, verb=False):
+  """
+    Log the per-stage statistics and save them as JSON beside the log
+  """
+  stats = oFiles.get('_stats')
+  if stats is None:
+    return
+  logStats(oFiles['_log'], stats, verb=verb)
+  meta = {'label': iFiles['LABEL'], 'mode': OperMode['Mode'], 'nrec': OperMode['nrec'],
+          'roi': getROIs(roi)}
+  writeStats(stats, oFiles['STATS'], meta)
+  writeLog(oFiles['_log'], 'Stage statistics:\t{}'.format(oFiles['STATS']), verb=verb)
+  return
+
+
+def finishManifest(iFiles, oFiles, roi, opts, status='OK'):
+  """
+    Record a finished observation, its data files, log and statistics in
+    the output manifest
+  """
+  outputs = oFiles.get('_outputs', []) + [oFiles['LOG'], oFiles['STATS']]
+  return writeManifest(oFiles['MANIFEST'], iFiles, roi, opts, outputs, status, opts.get('hash', False))
+
+
+def process(iFiles, oFiles, OperMode, roi, block=None, verb=False, opts={}):
+  """
+    Parse the auxiliary file and separate the SCIENCE and ANCILLARY data for
+    no ROI, a single ROI, or a list of ROIs.  Several ROIs are handled in a
+    single pass over the observation, with each ROI's outputs tagged
+    ROI01, ROI02, ...  Returns False when no data falls inside any ROI.
+    opts holds optional stages: 'rc' ('complex' or 'power'), 'chirp'
+    ([TX, RX] temperature bins, or None for per-trace chirps), 'interp'
+    (interpolate per-trace chirps) and 'cal' (apply cal_filter.dat), plus
+    'fmt', the aux/ancillary table format, 'sci'/'sciDtype', the
+    science product layout, 'readAhead', the number of blocks read ahead,
+    'workers', the number of processes decoding shards of the observation,
+    'stack' (traces) or 'stackDistance' (km) with 'stackPower' for
+    stacked radargrams, and 'align' with 'alignRef' to shift the traces to
+    a common receive window opening time (see sepSAdataROIs).  With
+    'geometry' the aux geometry is interpolated onto the SCET of every
+    trace, saved per output and used for the ROI cuts.  Stage statistics are
+    collected in oFiles['_stats'] when present (see newStats), and the
+    data files written are listed in oFiles['_outputs'].
+  """
+  stats = oFiles.get('_stats')
+  oFiles.setdefault('_outputs', [])
+  rc = rcStage(opts, iFiles, oFiles, OperMode)
+  stack = stackStage(opts, iFiles, oFiles)
+  align = alignStage(opts, iFiles, OperMode)
+  geo = geometryStage(opts, iFiles, oFiles, OperMode)
+  fmt = tableFormat(opts.get('fmt', 'csv'))
+  sci = {'sci': opts.get('sci', 'raw'), 'sciDtype': opts.get('sciDtype', 'int8'),
+         'meta': {'mode': OperMode['Mode'], 'presum': OperMode['Presum'], 'bits': OperMode['BitsPerSample'],
+                  'prf': OperMode.get('PRF'), 'science': os.path.basename(iFiles['SCIENCE'])},
+         'stats': stats, 'depth': opts.get('readAhead', READ_AHEAD),
+         'workers': opts.get('workers'), 'stack': stack, 'align': align}
+  if align is not None:
+    sci['meta']['alignRef'] = align['ref']
+  auxBytes = os.path.getsize(iFiles['AUX'])
+  rois = getROIs(roi)
+  if len(rois) <= 1:
+    #
+    # With the trace geometry the science records are cut on each trace's
+    # own interpolated position, and the aux records on the SCET span of
+    # the traces kept
+    #
+    mask, runs = None, None
+    if geo is not None and len(rois):
+      mask = geometryMasks(geo, rois)[0]
+      runs = maskRuns(geometryAuxMasks(iFiles['AUX'], geo, [mask])[0]) if mask.any() else []
+    with timeStage(stats, 'parseAuxFile', auxBytes // AUX_RECLEN, auxBytes):
+      _, idx = parseAuxFile(iFiles['AUX'], oFiles['AUX'], dic=False, csv=True,
+                            roi=rois[0] if rois else [None,None,None,None], fmt=fmt, runs=runs)
+    addBytes(stats, 'parseAuxFile', [tableName(oFiles['AUX'], fmt)])
+    if idx[0] == -1:
+      #
+      # There is not data from this trace in the ROI
+      #
+      writeLog(oFiles['_log'], '[WARNING]: No data for this observation exists within the ROI...', verb=verb)
+      return False
+    if mask is not None:
+      idx = maskRuns(mask)
+    cnt = sepSAdata(iFiles['SCIENCE'], oFiles['SCIENCE'], oFiles['ANCILLARY'], OperMode['recLen'], OperMode['BitsPerSample'], OperMode['Presum'], idx=idx, block=block,
+                    rc=rc, oR=oFiles['RC'], oK=[oFiles[key] for key in ['STACK', 'STACK_ANC', 'STACK_AUX']], fmt=fmt, **sci)
+    oFiles['_outputs'] += [sciName(oFiles['SCIENCE'], sci['sci']), tableName(oFiles['ANCILLARY'], fmt), tableName(oFiles['AUX'], fmt)]
+    oFiles['_outputs'] += [sciName(oFiles['RC'], sci['sci'])] if rc is not None else []
+    oFiles['_outputs'] += stackOut(oFiles, fmt) if stack is not None else []
+    if geo is not None:
+      oFiles['_outputs'] += [writeGeometry(geo, oFiles['GEOMETRY'], fmt, mask)]
+    return True
+  #
+  # Test every record against every ROI at once
+  #
+  tags = ['ROI{:02d}'.format(_k+1) for _k in range(len(rois))]
+  oROI = [tagOut(oFiles, tag) for tag in tags]
+  geoMasks = geometryMasks(geo, rois) if geo is not None else None
+  with timeStage(stats, 'parseAuxFile', auxBytes // AUX_RECLEN, auxBytes):
+    masks, runs = parseAuxROIs(iFiles['AUX'], [o['AUX'] for o in oROI], rois, fmt=fmt,
+                               masks=geometryAuxMasks(iFiles['AUX'], geo, geoMasks) if geo is not None else None)
+  if geo is not None:
+    masks, runs = geoMasks, [maskRuns(m) for m in geoMasks]
+  addBytes(stats, 'parseAuxFile', [tableName(o['AUX'], fmt) for o in oROI])
+  hit = [_k for _k in range(len(rois)) if len(runs[_k])]
+  for _k in range(len(rois)):
+    if _k in hit:
+      writeLog(oFiles['_log'], '{}:\t{}\t{} records'.format(tags[_k], rois[_k], int(masks[_k].sum())), verb=verb)
+    else:
+      writeLog(oFiles['_log'], '[WARNING]: No data for this observation exists within {} {}...'.format(tags[_k], rois[_k]), verb=verb)
+  if len(hit) == 0:
+    return False
+  cnt = sepSAdataROIs(iFiles['SCIENCE'], [oROI[_k]['SCIENCE'] for _k in hit], [oROI[_k]['ANCILLARY'] for _k in hit],
+                      masks[hit], OperMode['recLen'], OperMode['BitsPerSample'], OperMode['Presum'], block=block,
+                      rc=rc, oR=[oROI[_k]['RC'] for _k in hit],
+                      oK=[[oROI[_k][key] for key in ['STACK', 'STACK_ANC', 'STACK_AUX']] for _k in hit], fmt=fmt, **sci)
+  for _k in hit:
+    oFiles['_outputs'] += [sciName(oROI[_k]['SCIENCE'], sci['sci']), tableName(oROI[_k]['ANCILLARY'], fmt), tableName(oROI[_k]['AUX'], fmt)]
+    oFiles['_outputs'] += [sciName(oROI[_k]['RC'], sci['sci'])] if rc is not None else []
+    oFiles['_outputs'] += stackOut(oROI[_k], fmt) if stack is not None else []
+    if geo is not None:
+      oFiles['_outputs'] += [writeGeometry(geo, oROI[_k]['GEOMETRY'], fmt, masks[_k])]
+  return True
+
+def sherpa(lblFile, outDir, roi, block=None, rc=None, chirp=None, cal=False, interp=False, fmt='csv',
+           sci='raw', sciDtype='int8', profile=None, memory=False, resume=False, hash=False,
+           readAhead=READ_AHEAD, workers=None, stack=None, stackDistance=None, stackPower=False,
+           align=False, alignRef=None, geometry=False):
+  """
+    Process one label into outDir.  roi is [None]*4, a single box, a list
+    of boxes or an ROI file (see getROIs).  With resume True an observation
+    whose manifest entry is up to date (see upToDate) is skipped; hash
+    compares the inputs by content instead of size and mtime, readAhead
+    sets how many blocks are read ahead when block is given, and workers
+    decodes the observation in shards on that many processes.  stack
+    (traces) or stackDistance (km) also save stacked radargrams, summing
+    power with stackPower.  align shifts the traces to the receive window
+    opening time alignRef (in ADC samples, by default the earliest of the
+    observation); a 'sherpa' product of aligned traces is float32, and
+    stacking decodes serially (see normOpts).  geometry saves the aux
+    geometry interpolated onto every trace and cuts the ROI with it.
+    Returns False when no data falls inside the ROI.
+  """
   verb=False
+  roi = normROI(roi)
+  opts = {'rc': rc, 'chirp': chirp, 'cal': cal, 'interp': interp, 'fmt': fmt, 'sci': sci, 'sciDtype': sciDtype,
+          'hash': hash, 'readAhead': readAhead,
+          'workers': workers, 'stack': stack, 'stackDistance': stackDistance, 'stackPower': stackPower,
+          'align': align or alignRef is not None, 'alignRef': alignRef,
+          'geometry': geometry}
+  given, opts = opts, normOpts(opts)
   #
   # Get start time
   #
@@ -11,15 +216,23 @@ def sherpa(lblFile, outDir, roi):
   # Program information
   #
   prog = "SHARAD EDR Processing Algorithm"
-  vers = "0.1"
+  vers = SHERPA_VERSION
   #
   # Find science and auxiliary files
   #
-  iFiles = findFiles(lblFile)
+  stats = newStats(profile, memory)
+  with timeStage(stats, 'findFiles', 1, os.path.getsize(lblFile)):
+    iFiles = findFiles(lblFile)
   #
   # Form outDir
   #
   oDirs, oFiles = formOut(lblFile, outDir)
+  oFiles['_stats'] = stats
+  #
+  # Skip observations already processed with the same inputs and options
+  #
+  if resume and upToDate(lblFile, oFiles['MANIFEST'], roi, opts, hash):
+    return readManifest(oFiles['MANIFEST'])[os.path.abspath(lblFile)]['status'] == 'OK'
   #
   # Make output directories
   #
@@ -45,6 +258,8 @@ def sherpa(lblFile, outDir, roi):
   writeLog(oFiles['_log'], 'PRF:\t{}'.format(OperMode['PRF']), verb=verb)
   writeLog(oFiles['_log'], 'Record Length:\t{}'.format(OperMode['recLen']), verb=verb)
   writeLog(oFiles['_log'], 'Number of Records:\t{}'.format(OperMode['nrec']), verb=verb)
+  for w in normWarnings(given, opts):
+    writeLog(oFiles['_log'], '[WARNING]: {}'.format(w), verb=verb)
   writeLog(oFiles['_log'], '', verb=verb)
   ##########################################################
   #
@@ -52,20 +267,13 @@ def sherpa(lblFile, outDir, roi):
   #
   ##########################################################
   #
-  # Parse Auxiliary File
+  # Parse Auxiliary File and separate the SCIENCE and ANCILLARY data
   #
-  _, idx = parseAuxFile(iFiles['AUX'], oFiles['AUX'], dic=False, csv=True, roi=roi) 
-  if idx[0] == -1:
-    #
-    # There is not data from this trace in the ROI
-    #
-    writeLog(oFiles['_log'], '[WARNING]: No data for this observation exists within the ROI...', verb=verb)
+  if not process(iFiles, oFiles, OperMode, roi, block, verb, opts):
+    reportStats(iFiles, oFiles, OperMode, roi, verb)
     oFiles['_log'].close()
-    return
-  #
-  # Separate the SCIENCE and ANCILLARY data
-  #
-  cnt = sepSAdata(iFiles['SCIENCE'], oFiles['SCIENCE'], oFiles['ANCILLARY'], OperMode['recLen'], OperMode['BitsPerSample'], OperMode['Presum'])
+    finishManifest(iFiles, oFiles, roi, opts, 'NO_ROI_DATA')
+    return False
   #
   # Get the total time (tt)
   #
@@ -73,9 +281,11 @@ def sherpa(lblFile, outDir, roi):
   #
   # Report time and close log file
   #
+  reportStats(iFiles, oFiles, OperMode, roi, verb)
   writeLog(oFiles['_log'], 'Total time:\t{}'.format(tt), verb=verb)
   oFiles['_log'].close()
-  return
+  finishManifest(iFiles, oFiles, roi, opts)
+  return True
   
 def main():
   """
@@ -97,27 +307,19 @@ def main():
   # Program information
   #
   prog = "SHARAD EDR Processing Algorithm"
-  vers = "0.1"
+  vers = SHERPA_VERSION
   #
   # Parse the arguments
   #
-  iFiles, oFiles, TransID, OSTLine, OperMode, roi, verb = parseargs(prog, vers)
+  iFiles, oFiles, TransID, OSTLine, OperMode, roi, verb, block, opts = parseargs(prog, vers)
   #
-  # Parse Auxiliary File
-  # 
-  _, idx = parseAuxFile(iFiles['AUX'], oFiles['AUX'], dic=False, csv=True, roi=roi)
-  if idx[0] == -1:
-    #
-    # There is not data from this trace in the ROI
-    #
-    writeLog(oFiles['_log'], '[WARNING]: No data for this observation exists within the ROI...', verb=verb)
+  # Parse Auxiliary File and separate the SCIENCE and ANCILLARY data
+  #
+  if not process(iFiles, oFiles, OperMode, roi, block, verb, opts):
+    reportStats(iFiles, oFiles, OperMode, roi, verb)
     oFiles['_log'].close()
+    finishManifest(iFiles, oFiles, roi, opts, 'NO_ROI_DATA')
     return
-    
-  #
-  # Separate the SCIENCE and ANCILLARY data
-  #
-  cnt = sepSAdata(iFiles['SCIENCE'], oFiles['SCIENCE'], oFiles['ANCILLARY'], OperMode['recLen'], OperMode['BitsPerSample'], OperMode['Presum'], idx=idx)
   #
   # Get the total time (tt)
   #
@@ -125,8 +327,10 @@ def main():
   #
   # Report time and close log file
   # 
+  reportStats(iFiles, oFiles, OperMode, roi, verb)
   writeLog(oFiles['_log'], 'Total time:\t{}'.format(tt), verb=verb)
   oFiles['_log'].close()
+  finishManifest(iFiles, oFiles, roi, opts)
   return
 
 if __name__ == '__main__':
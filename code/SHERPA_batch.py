@@ -0,0 +1,171 @@
+from SHERPA import *
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import traceback
+
+###############################################
+#
+# Label discovery
+#
+###############################################
+def findLabels(src):
+  """
+    Return the sorted PDS label files named by src, which may be a
+    directory, a glob pattern, or a manifest text file listing one label
+    path per line
+  """
+  if os.path.isdir(src):
+    lbls = glob.glob(os.path.join(src, '*.lbl')) + glob.glob(os.path.join(src, '*.LBL'))
+  elif os.path.isfile(src) and not src.lower().endswith('.lbl'):
+    base = os.path.dirname(src)
+    lbls = []
+    with open(src) as f:
+      for line in f:
+        line = line.split('#')[0].strip()
+        if len(line) == 0:
+          continue
+        lbls.append(line if os.path.isabs(line) else os.path.join(base, line))
+  else:
+    lbls = glob.glob(src)
+  return sorted(set(lbls))
+
+###############################################
+#
+# Workers
+#
+###############################################
+def runOne(lblFile, outDir, roi, block=None, hash=False):
+  """
+    Run sherpa() on a single label and report the outcome instead of
+    raising, so one bad observation does not stop a batch
+  """
+  st = datetime.now()
+  res = {'LABEL': lblFile, 'STATUS': 'OK', 'SECONDS': 0., 'ERROR': ''}
+  try:
+    if not sherpa(lblFile, outDir, roi, block=block, hash=hash):
+      res['STATUS'] = 'NO_ROI_DATA'
+  except Exception as e:
+    #
+    # KeyboardInterrupt and SystemExit still stop the batch
+    #
+    res['STATUS'] = 'FAILED'
+    res['ERROR'] = type(e).__name__ if e.args in [(), (None,)] else '{}: {}'.format(type(e).__name__, e)
+    res['TRACEBACK'] = traceback.format_exc()
+  res['SECONDS'] = (datetime.now() - st).total_seconds()
+  return res
+
+
+def skipDone(lbls, outDir, roi, hash=False, verb=True):
+  """
+    Split lbls into those whose outputs in the outDir manifest are up to
+    date, returned as SKIPPED results, and those still to be processed.
+    Labels that cannot be checked are processed, so runOne reports them.
+  """
+  entries = readManifest(os.path.join(outDir, MANIFEST))
+  res, todo = {}, []
+  for lbl in lbls:
+    st = datetime.now()
+    try:
+      done = upToDate(lbl, None, roi, hash=hash, entries=entries)
+    except Exception:
+      done = False
+    if done:
+      res[lbl] = {'LABEL': lbl, 'STATUS': 'SKIPPED', 'SECONDS': (datetime.now() - st).total_seconds(), 'ERROR': ''}
+      reportOne(res[lbl], verb=verb)
+    else:
+      todo.append(lbl)
+  return res, todo
+
+
+def batch(lbls, outDir, roi=[None,None,None,None], block=None, workers=None, verb=True, resume=False, hash=False):
+  """
+    Process many label files with sherpa() on a pool of worker processes.
+    Returns one result dictionary per label (LABEL, STATUS, SECONDS, ERROR)
+    in the order the labels were given.  With resume True, labels whose
+    outputs are up to date in the output manifest are SKIPPED, so an
+    interrupted batch picks up where it stopped.
+  """
+  workers = workers if workers else os.cpu_count()
+  res, todo = skipDone(lbls, outDir, roi, hash, verb) if resume else ({}, lbls)
+  if workers == 1:
+    for lbl in todo:
+      res[lbl] = runOne(lbl, outDir, roi, block, hash)
+      reportOne(res[lbl], verb=verb)
+  else:
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      jobs = {pool.submit(runOne, lbl, outDir, roi, block, hash): lbl for lbl in todo}
+      for job in as_completed(jobs):
+        res[jobs[job]] = job.result()
+        reportOne(res[jobs[job]], verb=verb)
+  return [res[lbl] for lbl in lbls]
+
+
+def reportOne(res, verb=True):
+  writeLog(None, '[{}]\t{:.2f} s\t{}\t{}'.format(res['STATUS'], res['SECONDS'], res['LABEL'], res['ERROR']), verb=verb)
+  return
+
+
+def writeSummary(results, oFile):
+  """
+    Save the per-observation batch results as CSV
+  """
+  summary = pd.DataFrame(results, columns=['LABEL', 'STATUS', 'SECONDS', 'ERROR'])
+  summary.to_csv(oFile)
+  return summary
+
+
+def main():
+  """
+  SHERPA batch driver: run sherpa() over a directory, glob or manifest of
+  PDS label files on a pool of worker processes
+  """
+  st = datetime.now()
+  prog = "SHARAD EDR Processing Algorithm Batch Driver"
+  vers = "0.1"
+  parser = argparse.ArgumentParser(description=str(prog + ' ' + vers))
+  parser.add_argument('src', type=str, nargs=1,
+                      help=str('Directory, glob pattern or manifest of PDS label files'))
+  parser.add_argument('-o', '--outDir', nargs=1, default=['../out/'], type=str,
+                     help=str('Desired output directory'))
+  parser.add_argument('-r', '--roi', nargs=4, action='append', default=None, type=float,
+                     help=str('minLat minLon maxLat maxLon (may be repeated)'))
+  parser.add_argument('-R', '--roiFile', nargs=1, default=[None], type=str,
+                     help=str('Text file with one "minLat minLon maxLat maxLon" ROI per line'))
+  parser.add_argument('-b', '--block', nargs=1, default=[None], type=int,
+                     help=str('Process the science file in blocks of this many records'))
+  parser.add_argument('-j', '--workers', nargs=1, default=[None], type=int,
+                     help=str('Number of worker processes (default: all cores)'))
+  parser.add_argument('-u', '--resume', action="store_true", default=False,
+                     help=str('Skip labels whose outputs in the output manifest are up to date'))
+  parser.add_argument('--hash', action="store_true", default=False,
+                     help=str('Compare inputs by SHA-256 content hash instead of size and mtime'))
+  parser.add_argument('-v', '--verbose', action="store_true", default=False,
+                     help=str('Print per-observation results to screen'))
+  if len(sys.argv[1:]) == 0:
+    parser.print_help()
+    parser.exit()
+  args = parser.parse_args()
+  outDir = args.outDir[0]
+  roi = getROIs(args.roi) if args.roi is not None else []
+  if args.roiFile[0] is not None:
+    roi = roi + readROIs(args.roiFile[0])
+  roi = normROI(roi)
+  lbls = findLabels(args.src[0])
+  if len(lbls) == 0:
+    print('[ERROR]: No label files found for {}'.format(args.src[0]))
+    parser.exit()
+  #
+  # Create the shared output directories once up front
+  #
+  makeOut(outDir, formOut(lbls[0], outDir)[0])
+  results = batch(lbls, outDir, roi, args.block[0], args.workers[0], verb=args.verbose,
+                  resume=args.resume, hash=args.hash)
+  oFile = os.path.join(outDir, 'LOGS', 'batch_{}.csv'.format(st.strftime('%Y%m%dT%H%M%S')))
+  summary = writeSummary(results, oFile)
+  counts = summary['STATUS'].value_counts()
+  writeLog(None, '{} labels: {}'.format(len(lbls), ', '.join('{} {}'.format(v, k) for k, v in counts.items())), verb=True)
+  writeLog(None, 'Summary:\t{}'.format(oFile), verb=True)
+  writeLog(None, 'Total time:\t{}'.format(datetime.now() - st), verb=True)
+  return
+
+if __name__ == '__main__':
+  main()
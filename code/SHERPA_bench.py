@@ -0,0 +1,198 @@
+from SHERPA import *
+from SHERPA_synth import makeAux, makeObservation
+from datetime import datetime
+import tempfile, platform
+
+###############################################
+#
+# Reference implementations
+#
+###############################################
+STRUCT_FMT = {'>u4': '>I', '>u2': '>H', '>i4': '>i', '>i2': '>h', '>f8': '>d', '>f4': '>f'}
+
+def legacyParseAux(fname):
+  """
+    Record-by-record struct.unpack decoder used by parseAuxFile before the
+    structured dtype version.  Kept only as the benchmark baseline.
+  """
+  a = {key: [] for key in AUX_DTYPE.names}
+  a['ELAPSED_TIME'] = []
+  fields = []
+  for key in AUX_DTYPE.names:
+    fmt, off = AUX_DTYPE.fields[key]
+    fields.append((key, off, off + fmt.itemsize, fmt))
+  with open(fname, 'rb') as _f:
+    for _i in range(int(os.path.getsize(fname)/AUX_RECLEN)):
+      _f.seek(_i*AUX_RECLEN)
+      r = _f.read(AUX_RECLEN)
+      for key, s, e, fmt in fields:
+        if fmt.kind == 'S':
+          a[key].append(r[s:e].decode('utf-8'))
+        else:
+          a[key].append(struct.unpack(STRUCT_FMT[fmt.str], r[s:e])[0])
+      a['ELAPSED_TIME'].append(a['EPHEMERIS_TIME'][_i] - a['EPHEMERIS_TIME'][0])
+  return a
+
+###############################################
+#
+# Benchmarks
+#
+###############################################
+def timeit(func, *args, **kwargs):
+  st = datetime.now()
+  out = func(*args, **kwargs)
+  return (datetime.now() - st).total_seconds(), out
+
+
+def benchAux(nrec=20000, verb=True):
+  """
+    Compare the legacy per-record auxiliary decoder against parseAuxFile
+  """
+  with tempfile.TemporaryDirectory() as tmp:
+    fname = makeAux(os.path.join(tmp, 'aux.dat'), nrec)
+    tLoop, ref = timeit(legacyParseAux, fname)
+    tVec, (a, _) = timeit(parseAuxFile, fname, None, dic=True)
+    tMap, _ = timeit(parseAuxFile, fname, None, dic=True, mmap=True)
+  for key in ref:
+    if not np.array_equal(np.asarray(ref[key]), a[key]):
+      raise ValueError('Vectorized decoder disagrees with legacy decoder on {}'.format(key))
+  res = {'nrec': nrec, 'loop_s': tLoop, 'vectorized_s': tVec, 'memmap_s': tMap,
+         'speedup': tLoop / tVec if tVec > 0 else float('inf')}
+  writeLog(None, 'parseAuxFile: {} records'.format(nrec), verb=verb)
+  writeLog(None, '\tLegacy loop:\t{:.4f} s'.format(tLoop), verb=verb)
+  writeLog(None, '\tStructured dtype:\t{:.4f} s'.format(tVec), verb=verb)
+  writeLog(None, '\tStructured memmap:\t{:.4f} s'.format(tMap), verb=verb)
+  writeLog(None, '\tSpeedup:\t{:.1f}x'.format(res['speedup']), verb=verb)
+  return res
+
+
+#
+# Mode benchmarked for each bit depth
+#
+BENCH_MODES = {4: 'SS03', 6: 'SS05', 8: 'SS01'}
+#
+# Block size of the blocked sepSAdata stages
+#
+BENCH_BLOCK = 256
+#
+# Worker processes of the sharded sepSAdata stage (only run on more than
+# one core)
+#
+BENCH_WORKERS = os.cpu_count()
+
+
+def rate(seconds, nrec, nbytes):
+  return {'seconds': seconds, 'records': nrec, 'bytes': nbytes,
+          'records_per_s': nrec / seconds if seconds > 0 else float('inf'),
+          'MB_per_s': nbytes / 1e6 / seconds if seconds > 0 else float('inf')}
+
+
+def benchStages(nrec=1000, bits=6, repeat=3, verb=True):
+  """
+    Time the pipeline stages on a synthetic observation of nrec records in
+    the BENCH_MODES mode of the given bit depth.  Each stage is run repeat
+    times and the best time is kept.  Returns one result dictionary per
+    stage with records/s and MB/s of the input it reads.
+  """
+  mode = BENCH_MODES[bits]
+  res = []
+  with tempfile.TemporaryDirectory() as tmp:
+    lbl = makeObservation(os.path.join(tmp, 'edr'), mode, nrec)
+    iFiles = findFiles(lbl)
+    _, _, OperMode = parseFileName(iFiles['SCIENCE'])
+    n, p = OperMode['recLen'], OperMode['Presum']
+    #
+    # Stand-alone ancillary and packed sample files for the stage readers
+    #
+    recs = readRecords(iFiles['SCIENCE'], n)
+    anc = os.path.join(tmp, 'anc.dat')
+    samp = os.path.join(tmp, 'samples.dat')
+    recs[:, :ANC_RECLEN].tofile(anc)
+    recs[:, ANC_RECLEN:ANC_RECLEN + NSAMP*bits//8].tofile(samp)
+    del recs
+    out = os.path.join(tmp, 'out')
+    os.makedirs(out)
+    sci, aux = os.path.getsize(iFiles['SCIENCE']), os.path.getsize(iFiles['AUX'])
+    stages = [('findFiles', findFiles, (lbl,), {}, os.path.getsize(lbl)),
+              ('parseAuxFile', parseAuxFile, (iFiles['AUX'], None), {'dic': True}, aux),
+              ('parseAncillary', parseAncillary, (anc,), {}, os.path.getsize(anc)),
+              ('loadSamples', loadSamples, (samp, bits), {}, os.path.getsize(samp))]
+    if bits == 6:
+      stages.append(('load6bit', load6bit, (samp, NSAMP), {}, os.path.getsize(samp)))
+    sep = (iFiles['SCIENCE'], os.path.join(out, 'sep.sci'), os.path.join(out, 'sep.csv'), n, bits, p)
+    stages += [('sepSAdata', sepSAdata, sep, {}, sci),
+               ('sepSAdataBlocks', sepSAdata, sep, {'block': BENCH_BLOCK, 'depth': 0}, sci),
+               ('sepSAdataReadAhead', sepSAdata, sep, {'block': BENCH_BLOCK, 'depth': READ_AHEAD}, sci)]
+    if BENCH_WORKERS > 1:
+      stages.append(('sepSAdataShards', sepSAdata, sep, {'block': BENCH_BLOCK, 'workers': BENCH_WORKERS}, sci))
+    stages.append(('sherpa', sherpa, (lbl, out, [None,None,None,None]), {}, sci + aux))
+    for name, func, args, kwargs, nbytes in stages:
+      t = min(timeit(func, *args, **kwargs)[0] for _ in range(repeat))
+      r = dict(rate(t, nrec, nbytes), stage=name, bits=bits, mode=mode)
+      res.append(r)
+      writeLog(None, '{:<20}{}-bit {:>8} records\t{:.4f} s\t{:>12.0f} records/s\t{:>9.1f} MB/s'.format(
+               name, bits, nrec, t, r['records_per_s'], r['MB_per_s']), verb=verb)
+  return res
+
+
+def benchSuite(sizes=[1000, 10000], bits=[4, 6, 8], repeat=3, legacy=False, verb=True):
+  """
+    Run benchStages for every size and bit depth and return the results
+    together with a description of the machine, ready to be saved as JSON
+  """
+  suite = {'timestamp': datetime.now().isoformat(), 'python': platform.python_version(),
+           'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count(),
+           'repeat': repeat, 'results': []}
+  for nrec in sizes:
+    for b in bits:
+      suite['results'] += benchStages(nrec, b, repeat, verb=verb)
+  if legacy:
+    suite['aux_legacy'] = benchAux(max(sizes), verb=verb)
+  return suite
+
+
+def compareBench(old, new, verb=True):
+  """
+    Ratio of the new to the old time of every stage, size and bit depth
+    present in both suites; values above 1 are slowdowns
+  """
+  key = lambda r: (r['stage'], r['bits'], r['records'])
+  ref = {key(r): r for r in old['results']}
+  ratio = {}
+  for r in new['results']:
+    if key(r) in ref and ref[key(r)]['seconds'] > 0:
+      ratio[key(r)] = r['seconds'] / ref[key(r)]['seconds']
+      writeLog(None, '{:<20}{}-bit {:>8} records\t{:.2f}x{}'.format(
+               *key(r), ratio[key(r)], '\t[SLOWER]' if ratio[key(r)] > 1.1 else ''), verb=verb)
+  return ratio
+
+
+def main():
+  prog = "SHARAD EDR Processing Algorithm Benchmarks"
+  vers = "0.1"
+  parser = argparse.ArgumentParser(description=str(prog + ' ' + vers))
+  parser.add_argument('-n', '--nrec', nargs='+', default=[1000, 10000], type=int,
+                     help=str('Observation sizes in records'))
+  parser.add_argument('-b', '--bits', nargs='+', default=[4, 6, 8], type=int, choices=sorted(BENCH_MODES),
+                     help=str('Bits per sample of the benchmarked modes'))
+  parser.add_argument('-r', '--repeat', nargs=1, default=[3], type=int,
+                     help=str('Runs per stage; the best time is kept'))
+  parser.add_argument('-o', '--output', nargs=1, default=[None], type=str,
+                     help=str('JSON file to save the results to (default bench_<time>.json)'))
+  parser.add_argument('-c', '--compare', nargs=1, default=[None], type=str,
+                     help=str('Earlier JSON results to compare against'))
+  parser.add_argument('-l', '--legacy', action="store_true", default=False,
+                     help=str('Also compare parseAuxFile against the legacy struct decoder'))
+  args = parser.parse_args()
+  suite = benchSuite(args.nrec, args.bits, args.repeat[0], args.legacy)
+  oFile = args.output[0] if args.output[0] is not None else 'bench_{}.json'.format(datetime.now().strftime('%Y%m%dT%H%M%S'))
+  with open(oFile, 'w') as f:
+    json.dump(suite, f, indent=1)
+  writeLog(None, 'Results:\t{}'.format(oFile), verb=True)
+  if args.compare[0] is not None:
+    with open(args.compare[0]) as f:
+      compareBench(json.load(f), suite)
+  return
+
+if __name__ == '__main__':
+  main()
@@ -1,6 +1,21 @@
-import glob, sys, os, struct, argparse, bitstring
+import glob, sys, os, struct, argparse, json, cProfile, pstats, tracemalloc, hashlib, threading, queue
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, cached_property
+from datetime import datetime
 import pandas as pd
 import numpy as np
+try:
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
+try:
+  import resource
+except ImportError:
+  resource = None
+
+SHERPA_VERSION = '0.1'
 
 ###############################################
 #
@@ -12,6 +27,106 @@ def writeLog(log, string, verb=False):
     print(string)
   if log is not None:
     log.write(string + '\n')
+
+###############################################
+#
+# Stage instrumentation: wall time, records, bytes read and written and
+# peak memory of each processing stage, accumulated over blocks
+#
+###############################################
+STAGE_KEYS = ['records', 'bytesRead', 'bytesWritten']
+
+def newStats(profile=None, memory=False):
+  """
+    Start collecting stage statistics.  profile names a stage to run under
+    cProfile; memory traces Python/numpy allocations with tracemalloc to
+    report each stage's own peak, otherwise the process peak RSS is used.
+  """
+  if memory and not tracemalloc.is_tracing():
+    tracemalloc.start()
+  return {'stages': {}, 'profile': profile, 'profiler': None, 'memory': memory, 'start': datetime.now()}
+
+
+def peakMemory(stats):
+  if stats['memory']:
+    return tracemalloc.get_traced_memory()[1] / 1e6
+  if resource is not None:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+  return 0.
+
+
+@contextmanager
+def timeStage(stats, name, records=0, read=0, written=0):
+  """
+    Time the enclosed code as stage name of stats (None disables it).  The
+    yielded dictionary holds the records, bytesRead and bytesWritten
+    counts, which the enclosed code may update.
+  """
+  cnt = {'records': records, 'bytesRead': read, 'bytesWritten': written}
+  if stats is None:
+    yield cnt
+    return
+  s = stats['stages'].setdefault(name, dict({key: 0 for key in STAGE_KEYS}, calls=0, seconds=0., peakMB=0.))
+  prof = stats['profile'] == name
+  if prof:
+    stats['profiler'] = stats['profiler'] or cProfile.Profile()
+    stats['profiler'].enable()
+  if stats['memory']:
+    tracemalloc.reset_peak()
+  st = datetime.now()
+  try:
+    yield cnt
+  finally:
+    s['seconds'] += (datetime.now() - st).total_seconds()
+    if prof:
+      stats['profiler'].disable()
+    s['calls'] += 1
+    for key in STAGE_KEYS:
+      s[key] += int(cnt[key])
+    s['peakMB'] = max(s['peakMB'], peakMemory(stats))
+
+
+def addBytes(stats, name, files, key='bytesWritten'):
+  """
+    Add the size of the existing files to a stage's byte count
+  """
+  if stats is not None and name in stats['stages']:
+    stats['stages'][name][key] += sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+
+
+def logStats(log, stats, verb=False):
+  if stats is None:
+    return
+  for name, s in stats['stages'].items():
+    writeLog(log, '{}:\t{:.3f} s\t{} records\t{:.1f} MB read\t{:.1f} MB written\t{:.1f} MB peak'.format(
+             name, s['seconds'], s['records'], s['bytesRead'] / 1e6, s['bytesWritten'] / 1e6, s['peakMB']), verb=verb)
+  return
+
+
+def writeStats(stats, oFile, meta={}):
+  """
+    Save the stage statistics, with throughput in records/s and MB/s of
+    input, as JSON.  A profiled stage is also dumped to a .prof file
+    beside it and its top functions are listed in the summary.
+  """
+  if stats is None:
+    return
+  out = dict(meta)
+  out['totalSeconds'] = (datetime.now() - stats['start']).total_seconds()
+  out['memory'] = 'tracemalloc' if stats['memory'] else 'maxrss'
+  out['stages'] = {}
+  for name, s in stats['stages'].items():
+    out['stages'][name] = dict(s, recordsPerSecond=s['records'] / s['seconds'] if s['seconds'] > 0 else None,
+                               MBPerSecond=s['bytesRead'] / 1e6 / s['seconds'] if s['seconds'] > 0 else None)
+  if stats['profiler'] is not None:
+    prof = os.path.splitext(oFile)[0] + '.prof'
+    stats['profiler'].dump_stats(prof)
+    p = pstats.Stats(prof).sort_stats('cumulative')
+    out['profile'] = {'stage': stats['profile'], 'file': prof,
+                      'top': ['{}:{}({})'.format(*f) for f in p.fcn_list[:20]]}
+  with open(oFile, 'w') as f:
+    json.dump(out, f, indent=1)
+  return out
 ###############################################
 #
 # Argument Parser
@@ -24,6 +139,7 @@ def parseargs(prog, vers):
   outDir = ['../out/']
   verb = False
   roi = [None,None,None,None]
+  block = None
   #
   # Initiate the parser
   #
@@ -38,8 +154,50 @@ def parseargs(prog, vers):
   #
   parser.add_argument('-o', '--outDir', nargs=1, default=outDir, type=str,
                      help=str('Desired output directory'))
-  parser.add_argument('-r', '--roi', nargs=4, default=roi, type=float,
-                     help=str('minLat minLon maxLat maxLon'))
+  parser.add_argument('-r', '--roi', nargs=4, action='append', default=None, type=float,
+                     help=str('minLat minLon maxLat maxLon (may be repeated)'))
+  parser.add_argument('-R', '--roiFile', nargs=1, default=[None], type=str,
+                     help=str('Text file with one "minLat minLon maxLat maxLon" ROI per line'))
+  parser.add_argument('-b', '--block', nargs=1, default=[block], type=int,
+                     help=str('Process the science file in blocks of this many records'))
+  parser.add_argument('--readAhead', nargs=1, default=[READ_AHEAD], type=int,
+                     help=str('Blocks read ahead on a background thread when processing in blocks (0 to disable)'))
+  parser.add_argument('-j', '--workers', nargs=1, default=[None], type=int,
+                     help=str('Decode the observation in shards on this many processes'))
+  parser.add_argument('-f', '--format', nargs=1, default=['csv'], type=str, choices=list(TABLE_EXT),
+                     help=str('Output format of the auxiliary and ancillary tables'))
+  parser.add_argument('--sciFormat', nargs=1, default=['raw'], type=str, choices=SCI_FORMATS,
+                     help=str('Science output layout: legacy headerless int8 .sci, or self-describing {} product'.format(SCI_EXT)))
+  parser.add_argument('--sciDtype', nargs=1, default=['int8'], type=str, choices=SCI_DTYPES,
+                     help=str('Store compressed int8 samples with scale factors, decompressed float32, or the packed 4/6/8-bit samples with scale factors'))
+  parser.add_argument('--rc', nargs=1, default=[None], type=str, choices=['complex', 'power'],
+                     help=str('Range compress the echoes and save a complex or power radargram'))
+  parser.add_argument('--chirp', nargs=2, default=None, type=int,
+                     help=str('TX and RX temperature bins (C) of a fixed reference chirp; by default each trace uses the chirp nearest its aux TX_TEMP/RX_TEMP'))
+  parser.add_argument('--chirpInterp', action="store_true", default=False,
+                     help=str('Interpolate per-trace chirps between temperature bins'))
+  parser.add_argument('--calFilter', action="store_true", default=False,
+                     help=str('Weight the matched filter with calib/cal_filter.dat'))
+  parser.add_argument('--stack', nargs=1, default=[None], type=int,
+                     help=str('Also save radargrams stacked over this many traces'))
+  parser.add_argument('--stackDistance', nargs=1, default=[None], type=float,
+                     help=str('Also save radargrams stacked over this many km along the track (from TLP and SCET)'))
+  parser.add_argument('--stackPower', action="store_true", default=False,
+                     help=str('Stack trace power instead of averaging coherently'))
+  parser.add_argument('--align', action="store_true", default=False,
+                     help=str('Shift every trace to a common receive window opening time'))
+  parser.add_argument('--alignRef', nargs=1, default=[None], type=float,
+                     help=str('Reference receive window opening time in ADC samples (default: earliest of the observation)'))
+  parser.add_argument('-g', '--geometry', action="store_true", default=False,
+                     help=str('Interpolate the aux geometry onto every trace, save it and cut ROIs with it'))
+  parser.add_argument('--profile', nargs=1, default=[None], type=str,
+                     help=str('Run cProfile on one stage (e.g. unpackSamples) and save it beside the log'))
+  parser.add_argument('--traceMemory', action="store_true", default=False,
+                     help=str('Report the peak memory allocated within each stage (slower)'))
+  parser.add_argument('-u', '--resume', action="store_true", default=False,
+                     help=str('Skip the observation if its outputs in the manifest are up to date'))
+  parser.add_argument('--hash', action="store_true", default=False,
+                     help=str('Compare inputs by SHA-256 content hash instead of size and mtime'))
   #
   # Obligatory verbosity level and diagnostic options
   #
@@ -58,7 +216,18 @@ def parseargs(prog, vers):
   lblFile = args.lblFile[0]
   outDir = args.outDir[0]
   verb = args.verbose
-  roi = args.roi
+  roi = args.roi if args.roi is not None else roi
+  if args.roiFile[0] is not None:
+    roi = getROIs(roi) + readROIs(args.roiFile[0])
+  roi = normROI(roi)
+  block = args.block[0]
+  opts = {'rc': args.rc[0], 'chirp': args.chirp, 'cal': args.calFilter, 'interp': args.chirpInterp,
+          'fmt': args.format[0], 'sci': args.sciFormat[0], 'sciDtype': args.sciDtype[0], 'hash': args.hash,
+          'readAhead': args.readAhead[0], 'workers': args.workers[0],
+          'stack': args.stack[0], 'stackDistance': args.stackDistance[0], 'stackPower': args.stackPower,
+          'align': args.align or args.alignRef[0] is not None, 'alignRef': args.alignRef[0],
+          'geometry': args.geometry}
+  given, opts = opts, normOpts(opts)
   #
   # CHECK LBL FILE
   # 
@@ -73,11 +242,21 @@ def parseargs(prog, vers):
   #
   # Find science and auxiliary files
   #
-  iFiles = findFiles(lblFile)
+  stats = newStats(args.profile[0], args.traceMemory)
+  try:
+    with timeStage(stats, 'findFiles', 1, os.path.getsize(lblFile)):
+      iFiles = findFiles(lblFile)
+  except FileNotFoundError as e:
+    print('[ERROR]: {}'.format(e))
+    parser.exit()
   #
   #form outDir
   #
   oDirs, oFiles = formOut(lblFile, outDir)
+  oFiles['_stats'] = stats
+  if args.resume and upToDate(lblFile, oFiles['MANIFEST'], roi, opts, args.hash):
+    print('{} is up to date in {}, skipping'.format(lblFile, outDir))
+    parser.exit()
   #
   # Make output directories
   #
@@ -105,15 +284,40 @@ def parseargs(prog, vers):
   if roi == [None,None,None,None]:
     writeLog(oFiles['_log'], 'Number of Records:\t{}'.format(OperMode['nrec']), verb=verb)
   else:
-    writeLog(oFiles['_log'], 'Region of Interest:\t{}'.format(roi), verb=verb)
+    for r in getROIs(roi):
+      writeLog(oFiles['_log'], 'Region of Interest:\t{}'.format(r), verb=verb)
+  if block is not None:
+    writeLog(oFiles['_log'], 'Block size:\t{}'.format(block), verb=verb)
+    writeLog(oFiles['_log'], 'Read ahead:\t{} blocks'.format(opts['readAhead']), verb=verb)
+  if opts['workers'] is not None:
+    writeLog(oFiles['_log'], 'Worker processes:\t{}'.format(opts['workers']), verb=verb)
+  if opts['rc'] is not None:
+    writeLog(oFiles['_log'], 'Range compression:\t{}'.format(opts['rc']), verb=verb)
+  if opts['stackDistance'] is not None:
+    writeLog(oFiles['_log'], 'Stacking:\t{} km {}'.format(opts['stackDistance'], 'power' if opts['stackPower'] else 'coherent'), verb=verb)
+  elif opts['stack'] is not None:
+    writeLog(oFiles['_log'], 'Stacking:\t{} traces {}'.format(opts['stack'], 'power' if opts['stackPower'] else 'coherent'), verb=verb)
+  if opts['geometry']:
+    writeLog(oFiles['_log'], 'Trace geometry:\tinterpolated from aux SCET', verb=verb)
+  if opts['align']:
+    writeLog(oFiles['_log'], 'Receive window alignment:\t{}'.format('earliest' if opts['alignRef'] is None else opts['alignRef']), verb=verb)
+  for w in normWarnings(given, opts):
+    writeLog(oFiles['_log'], '[WARNING]: {}'.format(w), verb=verb)
+  writeLog(oFiles['_log'], 'Science product:\t{} ({})'.format(opts['sci'], opts['sciDtype']), verb=verb)
   writeLog(oFiles['_log'], '', verb=verb)
-  return iFiles, oFiles, TransID, OSTLine, OperMode, roi, verb
+  return iFiles, oFiles, TransID, OSTLine, OperMode, roi, verb, block, opts
 
 
 def findFiles(lblFile):
+  """
+    Science and auxiliary data files named by a PDS label, looked up in
+    the label's directory in upper or lower case.  Raises
+    FileNotFoundError when either is missing.
+  """
   #
   # Label File exists
   #
+  sciFile, auxFile = '', ''
   with open(lblFile) as f:
     content = f.readlines()
     sw = 0
@@ -136,8 +340,7 @@ def findFiles(lblFile):
   elif os.path.isfile(path + '/' + sciFile.lower()):
     sciFile = path + '/' + sciFile.lower()
   else:
-    print('[ERROR]: Science file not found...')
-    exit()
+    raise FileNotFoundError('Science file {} of {} not found'.format(sciFile, lblFile))
   #
   # Find AUXILIARY FILE
   #
@@ -146,64 +349,69 @@ def findFiles(lblFile):
   elif os.path.isfile(path + '/' + auxFile.lower()):
     auxFile = path + '/' + auxFile.lower()
   else:
-    print('[ERROR]: Auxiliary file not found...')
-    exit()
+    raise FileNotFoundError('Auxiliary file {} of {} not found'.format(auxFile, lblFile))
   iFiles = {'LABEL': lblFile, 'SCIENCE': sciFile, 'AUX': auxFile}
   return iFiles
 
 
+###############################################
+#
+# Instrument modes: on-board presumming, bits per sample and the
+# science record length of every subsurface (SS) and receive-only (RO)
+# mode
+#
+###############################################
+SSInstrMode = { 'SS01': {'Mode': 'SS01', 'Presum': 32, 'BitsPerSample': 8, 'recLen': 3786},
+                'SS02': {'Mode': 'SS02','Presum': 28, 'BitsPerSample': 6, 'recLen': 2886},
+                'SS03': {'Mode': 'SS03','Presum': 16, 'BitsPerSample': 4, 'recLen': 1986},
+                'SS04': {'Mode': 'SS04','Presum': 8, 'BitsPerSample': 8, 'recLen': 3786},
+                'SS05': {'Mode': 'SS05','Presum': 4, 'BitsPerSample': 6, 'recLen': 2886},
+                'SS06': {'Mode': 'SS06','Presum': 2, 'BitsPerSample': 4, 'recLen': 1986},
+                'SS07': {'Mode': 'SS07','Presum': 1, 'BitsPerSample': 8, 'recLen': 3786},
+                'SS08': {'Mode': 'SS08','Presum': 32, 'BitsPerSample': 6, 'recLen': 2886},
+                'SS09': {'Mode': 'SS09','Presum': 28, 'BitsPerSample': 4, 'recLen': 1986},
+                'SS10': {'Mode': 'SS10','Presum': 16, 'BitsPerSample': 8, 'recLen': 3786},
+                'SS11': {'Mode': 'SS11','Presum': 8, 'BitsPerSample': 6, 'recLen': 2886},
+                'SS12': {'Mode': 'SS12','Presum': 4, 'BitsPerSample': 4, 'recLen': 1986},
+                'SS13': {'Mode': 'SS13','Presum': 2, 'BitsPerSample': 8, 'recLen': 3786},
+                'SS14': {'Mode': 'SS14','Presum': 1, 'BitsPerSample': 6, 'recLen': 2886},
+                'SS15': {'Mode': 'SS15','Presum': 32, 'BitsPerSample': 4, 'recLen': 1986},
+                'SS16': {'Mode': 'SS16','Presum': 28, 'BitsPerSample': 8, 'recLen': 3786},
+                'SS17': {'Mode': 'SS17','Presum': 16, 'BitsPerSample': 6, 'recLen': 2886},
+                'SS18': {'Mode': 'SS18','Presum': 8, 'BitsPerSample': 4, 'recLen': 1986},
+                'SS19': {'Mode': 'SS19','Presum': 4, 'BitsPerSample': 8, 'recLen': 3786},
+                'SS20': {'Mode': 'SS20','Presum': 2, 'BitsPerSample': 6, 'recLen': 2886},
+                'SS21': {'Mode': 'SS21','Presum': 1, 'BitsPerSample': 4, 'recLen': 1986},
+             }
+#
+# Receive only
+#
+ROInstrMode = { 'RO01': {'Mode': 'RO01', 'Presum': 32, 'BitsPerSample': 8, 'recLen': 3786},
+                'RO02': {'Mode': 'RO02', 'Presum': 28, 'BitsPerSample': 6, 'recLen': 2886},
+                'RO03': {'Mode': 'RO03', 'Presum': 16, 'BitsPerSample': 4, 'recLen': 1986},
+                'RO04': {'Mode': 'RO04', 'Presum': 8, 'BitsPerSample': 8, 'recLen': 3786},
+                'RO05': {'Mode': 'RO05', 'Presum': 4, 'BitsPerSample': 6, 'recLen': 2886},
+                'RO06': {'Mode': 'RO06', 'Presum': 2, 'BitsPerSample': 4, 'recLen': 1986},
+                'RO07': {'Mode': 'RO07', 'Presum': 1, 'BitsPerSample': 8, 'recLen': 3786},
+                'RO08': {'Mode': 'RO08', 'Presum': 32, 'BitsPerSample': 6, 'recLen': 2886},
+                'RO09': {'Mode': 'RO09', 'Presum': 28, 'BitsPerSample': 4, 'recLen': 1986},
+                'RO10': {'Mode': 'RO10', 'Presum': 16, 'BitsPerSample': 8, 'recLen': 3786},
+                'RO11': {'Mode': 'RO11', 'Presum': 8, 'BitsPerSample': 6, 'recLen': 2886},
+                'RO12': {'Mode': 'RO12', 'Presum': 4, 'BitsPerSample': 4, 'recLen': 1986},
+                'RO13': {'Mode': 'RO13', 'Presum': 2, 'BitsPerSample': 8, 'recLen': 3786},
+                'RO14': {'Mode': 'RO14', 'Presum': 1, 'BitsPerSample': 6, 'recLen': 2886},
+                'RO15': {'Mode': 'RO15', 'Presum': 32, 'BitsPerSample': 4, 'recLen': 1986},
+                'RO16': {'Mode': 'RO16', 'Presum': 28, 'BitsPerSample': 8, 'recLen': 3786},
+                'RO17': {'Mode': 'RO17', 'Presum': 16, 'BitsPerSample': 6, 'recLen': 2886},
+                'RO18': {'Mode': 'RO18', 'Presum': 8, 'BitsPerSample': 4, 'recLen': 1986},
+                'RO19': {'Mode': 'RO19', 'Presum': 4, 'BitsPerSample': 8, 'recLen': 3786},
+                'RO20': {'Mode': 'RO20', 'Presum': 2, 'BitsPerSample': 6, 'recLen': 2886},
+                'RO21': {'Mode': 'RO21', 'Presum': 1, 'BitsPerSample': 4, 'recLen': 1986}
+              }
+
+
 def parseFileName(_file):
   #
-  # Determine to Bits per Sample
-  #
-  SSInstrMode = { 'SS01': {'Mode': 'SS01', 'Presum': 32, 'BitsPerSample': 8, 'recLen': 3786},
-                  'SS02': {'Mode': 'SS02','Presum': 28, 'BitsPerSample': 6, 'recLen': 2886},
-                  'SS03': {'Mode': 'SS03','Presum': 16, 'BitsPerSample': 4, 'recLen': 1986},
-                  'SS04': {'Mode': 'SS04','Presum': 8, 'BitsPerSample': 8, 'recLen': 3786},
-                  'SS05': {'Mode': 'SS05','Presum': 4, 'BitsPerSample': 6, 'recLen': 2886},
-                  'SS06': {'Mode': 'SS06','Presum': 2, 'BitsPerSample': 4, 'recLen': 1986},
-                  'SS07': {'Mode': 'SS07','Presum': 1, 'BitsPerSample': 8, 'recLen': 3786},
-                  'SS08': {'Mode': 'SS08','Presum': 32, 'BitsPerSample': 6, 'recLen': 2886},
-                  'SS09': {'Mode': 'SS09','Presum': 28, 'BitsPerSample': 4, 'recLen': 1986},
-                  'SS10': {'Mode': 'SS10','Presum': 16, 'BitsPerSample': 8, 'recLen': 3786},
-                  'SS11': {'Mode': 'SS11','Presum': 8, 'BitsPerSample': 6, 'recLen': 2886},
-                  'SS12': {'Mode': 'SS12','Presum': 4, 'BitsPerSample': 4, 'recLen': 1986},
-                  'SS13': {'Mode': 'SS13','Presum': 2, 'BitsPerSample': 8, 'recLen': 3786},
-                  'SS14': {'Mode': 'SS14','Presum': 1, 'BitsPerSample': 6, 'recLen': 2886},
-                  'SS15': {'Mode': 'SS15','Presum': 32, 'BitsPerSample': 4, 'recLen': 1986},
-                  'SS16': {'Mode': 'SS16','Presum': 28, 'BitsPerSample': 8, 'recLen': 3786},
-                  'SS17': {'Mode': 'SS17','Presum': 16, 'BitsPerSample': 6, 'recLen': 2886},
-                  'SS18': {'Mode': 'SS18','Presum': 8, 'BitsPerSample': 4, 'recLen': 1986},
-                  'SS19': {'Mode': 'SS19','Presum': 4, 'BitsPerSample': 8, 'recLen': 3786},
-                  'SS20': {'Mode': 'SS20','Presum': 2, 'BitsPerSample': 6, 'recLen': 2886},
-                  'SS21': {'Mode': 'SS21','Presum': 1, 'BitsPerSample': 4, 'recLen': 1986},
-               }
-  #
-  # Receive only
-  #
-  ROInstrMode = { 'RO01': {'Presum': 32, 'BitsPerSample': 8, 'recLen': 3786},
-                  'RO02': {'Presum': 28, 'BitsPerSample': 6, 'recLen': 2886},
-                  'RO03': {'Presum': 16, 'BitsPerSample': 4, 'recLen': 1986},
-                  'RO04': {'Presum': 8, 'BitsPerSample': 8, 'recLen': 3786},
-                  'RO05': {'Presum': 4, 'BitsPerSample': 6, 'recLen': 2886},
-                  'RO06': {'Presum': 2, 'BitsPerSample': 4, 'recLen': 1986},
-                  'RO07': {'Presum': 1, 'BitsPerSample': 8, 'recLen': 3786},
-                  'RO08': {'Presum': 32, 'BitsPerSample': 6, 'recLen': 2886},
-                  'RO09': {'Presum': 28, 'BitsPerSample': 4, 'recLen': 1986},
-                  'RO10': {'Presum': 16, 'BitsPerSample': 8, 'recLen': 3786},
-                  'RO11': {'Presum': 8, 'BitsPerSample': 6, 'recLen': 2886},
-                  'RO12': {'Presum': 4, 'BitsPerSample': 4, 'recLen': 1986},
-                  'RO13': {'Presum': 2, 'BitsPerSample': 8, 'recLen': 3786},
-                  'RO14': {'Presum': 1, 'BitsPerSample': 6, 'recLen': 2886},
-                  'RO15': {'Presum': 32, 'BitsPerSample': 4, 'recLen': 1986},
-                  'RO16': {'Presum': 28, 'BitsPerSample': 8, 'recLen': 3786},
-                  'RO17': {'Presum': 16, 'BitsPerSample': 6, 'recLen': 2886},
-                  'RO18': {'Presum': 8, 'BitsPerSample': 4, 'recLen': 1986},
-                  'RO19': {'Presum': 4, 'BitsPerSample': 8, 'recLen': 3786},
-                  'RO20': {'Presum': 2, 'BitsPerSample': 6, 'recLen': 2886},
-                  'RO21': {'Presum': 1, 'BitsPerSample': 4, 'recLen': 1986}
-                }
-  #
   # Get the file basename
   #
   bname = os.path.basename(_file).split('_')
@@ -212,525 +420,2334 @@ def parseFileName(_file):
   OperMode = bname[3].upper()
   PRF = detPRF(bname[4])
   if OperMode[0:2] == 'SS':
-    OperMode = SSInstrMode[OperMode]
+    OperMode = dict(SSInstrMode[OperMode])
   elif OperMode[0:2] == 'RO':
-    OperMode = ROInstrMode[OperMode]
+    OperMode = dict(ROInstrMode[OperMode])
   OperMode['PRF'] = PRF
   nrec = int(os.path.getsize(_file) / OperMode['recLen'])
   OperMode['nrec'] = nrec
   return TransID, OSTLine, OperMode
 
 
-def parseAuxFile(fname, oFile, roi=[None,None,None,None], dic=True, df=False, csv=False, binary=False, saveNP=False):
-  #
-  # Set up dictionary
-  #
-  a ={'SCET_BLOCK_WHOLE': [],
-      'SCET_BLOCK_FRAC': [],
-      'EPHEMERIS_TIME': [],
-      'ELAPSED_TIME': [],
-      'GEOMETRY_EPOCH': [],
-      'SOLAR_LONGITUDE': [],
-      'ORBIT_NUMBER': [],
-      'X_MARS_SC_POSITION_VECTOR': [],
-      'Y_MARS_SC_POSITION_VECTOR': [],
-      'Z_MARS_SC_POSITION_VECTOR': [],
-      'SPACECRAFT_ALTITUDE': [],
-      'SUB_SC_EAST_LONGITUDE': [],
-      'SUB_SC_PLANETOCENTRIC_LATITUDE': [],
-      'SUB_SC_PLANETOGRAPHIC_LATITUDE': [],
-      'X_MARS_SC_VELOCITY_VECTOR': [],
-      'Y_MARS_SC_VELOCITY_VECTOR': [],
-      'Z_MARS_SC_VELOCITY_VECTOR': [],
-      'MARS_SC_RADIAL_VELOCITY': [],
-      'MARS_SC_TANGENTIAL_VELOCITY': [],
-      'LOCAL_TRUE_SOLAR_TIME': [],
-      'SOLAR_ZENITH_ANGLE': [],
-      'SC_PITCH_ANGLE': [],
-      'SC_YAW_ANGLE': [],
-      'SC_ROLL_ANGLE': [],
-      'MRO_SAMX_INNER_GIMBAL_ANGLE': [],
-      'MRO_SAMX_OUTER_GIMBAL_ANGLE': [],
-      'MRO_SAPX_INNER_GIMBAL_ANGLE': [],
-      'MRO_SAPX_OUTER_GIMBAL_ANGLE': [],
-      'MRO_HGA_INNER_GIMBAL_ANGLE': [],
-      'MRO_HGA_OUTER_GIMBAL_ANGLE': [],
-      'DES_TEMP': [],
-      'DES_5V': [],
-      'DES_12V': [],
-      'DES_2V5': [],
-      'RX_TEMP': [],
-      'TX_TEMP': [],
-      'TX_LEV': [],
-      'TX_CURR': [],
-      'CORRUPTED_DATA_FLAG': []
-    }
-  #
-  # Each record is composed of 267 bytes
-  #
-  recLen = 267
-  if os.path.isfile(fname):
-    _f = open(fname, 'rb')
-    fsize = os.path.getsize(fname)
-    for _i in range(int(fsize/recLen)): # Go through all the rows
-      _f.seek(_i*recLen)
-      r = _f.read(recLen)
-      a['SCET_BLOCK_WHOLE'].append(struct.unpack(">I", r[0:4])[0])
-      a['SCET_BLOCK_FRAC'].append(struct.unpack(">H", r[4:6])[0])
-      a['EPHEMERIS_TIME'].append(struct.unpack(">d", r[6:14])[0])
-      a['ELAPSED_TIME'].append(a['EPHEMERIS_TIME'][_i] - a['EPHEMERIS_TIME'][0])
-      a['GEOMETRY_EPOCH'].append(r[14:37].decode("utf-8"))
-      a['SOLAR_LONGITUDE'].append(struct.unpack(">d", r[37:45])[0])
-      a['ORBIT_NUMBER'].append(struct.unpack(">i", r[45:49])[0])
-      a['X_MARS_SC_POSITION_VECTOR'].append(struct.unpack(">d", r[49:57])[0])
-      a['Y_MARS_SC_POSITION_VECTOR'].append(struct.unpack(">d", r[57:65])[0])
-      a['Z_MARS_SC_POSITION_VECTOR'].append(struct.unpack(">d", r[65:73])[0])
-      a['SPACECRAFT_ALTITUDE'].append(struct.unpack(">d", r[73:81])[0])
-      a['SUB_SC_EAST_LONGITUDE'].append(struct.unpack(">d", r[81:89])[0])
-      a['SUB_SC_PLANETOCENTRIC_LATITUDE'].append(struct.unpack(">d", r[89:97])[0])
-      a['SUB_SC_PLANETOGRAPHIC_LATITUDE'].append(struct.unpack(">d", r[97:105])[0])
-      a['X_MARS_SC_VELOCITY_VECTOR'].append(struct.unpack(">d", r[105:113])[0])
-      a['Y_MARS_SC_VELOCITY_VECTOR'].append(struct.unpack(">d", r[113:121])[0])
-      a['Z_MARS_SC_VELOCITY_VECTOR'].append(struct.unpack(">d", r[121:129])[0])
-      a['MARS_SC_RADIAL_VELOCITY'].append(struct.unpack(">d", r[129:137])[0])
-      a['MARS_SC_TANGENTIAL_VELOCITY'].append(struct.unpack(">d", r[137:145])[0])
-      a['LOCAL_TRUE_SOLAR_TIME'].append(struct.unpack(">d", r[145:153])[0])
-      a['SOLAR_ZENITH_ANGLE'].append(struct.unpack(">d", r[153:161])[0])
-      a['SC_PITCH_ANGLE'].append(struct.unpack(">d", r[161:169])[0])
-      a['SC_YAW_ANGLE'].append(struct.unpack(">d", r[169:177])[0])
-      a['SC_ROLL_ANGLE'].append(struct.unpack(">d", r[177:185])[0])
-      a['MRO_SAMX_INNER_GIMBAL_ANGLE'].append(struct.unpack(">d", r[185:193])[0])
-      a['MRO_SAMX_OUTER_GIMBAL_ANGLE'].append(struct.unpack(">d", r[193:201])[0])
-      a['MRO_SAPX_INNER_GIMBAL_ANGLE'].append(struct.unpack(">d", r[201:209])[0])
-      a['MRO_SAPX_OUTER_GIMBAL_ANGLE'].append(struct.unpack(">d", r[209:217])[0])
-      a['MRO_HGA_INNER_GIMBAL_ANGLE'].append(struct.unpack(">d", r[217:225])[0])
-      a['MRO_HGA_OUTER_GIMBAL_ANGLE'].append(struct.unpack(">d", r[225:233])[0])
-      a['DES_TEMP'].append(struct.unpack(">f", r[233:237])[0])
-      a['DES_5V'].append(struct.unpack(">f", r[237:241])[0])
-      a['DES_12V'].append(struct.unpack(">f", r[241:245])[0])
-      a['DES_2V5'].append(struct.unpack(">f", r[245:249])[0])
-      a['RX_TEMP'].append(struct.unpack(">f", r[249:253])[0])
-      a['TX_TEMP'].append(struct.unpack(">f", r[253:257])[0])
-      a['TX_LEV'].append(struct.unpack(">f", r[257:261])[0])
-      a['TX_CURR'].append(struct.unpack(">f", r[261:265])[0])
-      a['CORRUPTED_DATA_FLAG'].append(struct.unpack(">h", r[265:267])[0])
+###############################################
+#
+# PDS format (FMT) compiler: the COLUMN / BIT_COLUMN definitions of the
+# format/ files become a structured dtype and a plan of vectorized bit
+# field extractions, cached in memory and on disk.  The auxiliary and
+# ancillary decoders below are built from them.
+#
+###############################################
+FMT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'format')
+FMT_CACHE = os.environ.get('SHERPA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'sherpa'))
+FMT_VERSION = 1
+FMT_TYPES = {'MSB_UNSIGNED_INTEGER': '>u', 'UNSIGNED_INTEGER': '>u', 'MSB_INTEGER': '>i', 'INTEGER': '>i',
+             'IEEE_REAL': '>f', 'REAL': '>f', 'BOOLEAN': '>u', 'CHARACTER': 'S', 'DATE': 'S', 'TIME': 'S'}
+#
+# Prefix given to the bit fields of a bit string column; other bit
+# strings use the column name
+#
+FMT_PREFIX = {'OST_LINE': 'OST_', 'PACKET_SEGMENTATION_AND_FPGA_STATUS': 'PSFPGA_'}
+
+def readFMT(fname):
+  """
+    Parse a PDS FMT file into a list of COLUMN dictionaries, each with its
+    BIT_COLUMN dictionaries under 'BIT_COLUMNS'.  ^..._STRUCTURE pointers
+    are followed and their columns included in place.
+  """
+  cols, stack = [], []
+  with open(fname) as f:
+    lines = f.read().splitlines()
+  _i = 0
+  while _i < len(lines):
+    line = lines[_i].strip()
+    _i += 1
+    if '=' not in line:
+      continue
+    key, val = [v.strip() for v in line.split('=', 1)]
     #
-    # Check output
+    # Quoted values may run over several lines
     #
-    iMin = None
-    iMax = None
-    if roi != [None,None,None,None]:
-      iMin, iMax = detIDX(a['SUB_SC_EAST_LONGITUDE'], a['SUB_SC_PLANETOCENTRIC_LATITUDE'], roi) 
-      if iMin == -1:
-        return -1, [iMin, iMax]
-      for key in a:
-        a[key] = a[key][iMin:iMax+1]
-    if csv == True:
-      aux = pd.DataFrame.from_dict(a)
-      aux.to_csv(oFile)
-      return a, [iMin, iMax]
-    if dic == True:
-      return a, [iMin, iMax]
-    elif df == True:
-      return pd.DataFrame.from_dict(a), [iMin, iMax]
+    while val.count('"') == 1 and _i < len(lines):
+      val += ' ' + lines[_i].strip()
+      _i += 1
+    val = val.strip('"')
+    if key == 'OBJECT':
+      stack.append({'OBJECT': val, 'BIT_COLUMNS': []})
+    elif key == 'END_OBJECT':
+      obj = stack.pop()
+      if obj['OBJECT'] == 'BIT_COLUMN' and stack:
+        stack[-1]['BIT_COLUMNS'].append(obj)
+      elif obj['OBJECT'] == 'COLUMN':
+        cols.append(obj)
+    elif key.startswith('^') and key.endswith('STRUCTURE'):
+      cols += readFMT(findFMT(val, os.path.dirname(fname)))
+    elif stack:
+      stack[-1][key] = int(val) if val.lstrip('-').isdigit() else val
+  return cols
 
-def parseAncillary(fname):
+
+def findFMT(name, fmtDir=FMT_DIR):
   """
-    
-  """
-  #
-  # Set up dictionary
-  #
-  a = {'SCET_BLOCK_WHOLE': [],
-       'SCET_BLOCK_FRAC': [],
-       'TLM_COUNTER': [],
-       'FMT_LENGTH': [],
-       'SPARE1': [],
-       'SCET_OST_WHOLE': [],
-       'SCET_OST_FRAC': [],
-       'SPARE2': [],
-       'OST_LINE_NUMBER': [], 
-       'OST_PULSE_REPETITION_INTERVAL': [],
-       'OST_PHASE_COMPENSATION_TYPE': [],
-       'OST_SPARE1': [],
-       'OST_DATA_LENGTH_TAKEN': [], 
-       'OST_OPERATIVE_MODE': [],
-       'OST_MANUAL_GAIN_CONTROL': [],
-       'OST_COMPRESSION_SELECTION': [],
-       'OST_CLOSED_LOOP_TRACKING': [], 
-       'OST_TRACKING_DATA_STORAGE': [],
-       'OST_TRACKING_PRE_SUMMING': [], 
-       'OST_TRACKING_LOGIC_SELECTION': [],
-       'OST_THRESHOLD_LOGIC_SELECTION': [],
-       'OST_SAMPLE_NUMBER': [],
-       'OST_SPARE2': [],
-       'OST_ALPHA_BETA': [],
-       'OST_REFERENCE_BIT': [],
-       'OST_THRESHOLD': [],
-       'OST_THRESHOLD_INCREMENT': [],
-       'OST_SPARE3': [],
-       'OST_INITIAL_ECHO_VALUE': [],
-       'OST_EXPECTED_ECHO_SHIFT': [],
-       'OST_WINDOW_LEFT_SHIFT': [],
-       'OST_WINDOW_RIGHT_SHIFT': [], 
-       'OST_SPARE4': [],
-       'SPARE3': [],
-       'DATA_BLOCK_ID': [],
-       'SCIENCE_DATA_SOURCE_COUNTER': [],
-       'PSFPGA_SCIENTIFIC_DATA_TYPE': [],
-       'PSFPGA_SEGMENTATION_FLAG': [],
-       'PSFPGA_SPARE1': [],
-       'PSFPGA_SPARE2': [],
-       'PSFPGA_DMA_ERROR': [],
-       'PSFPGA_TC_OVERRUN': [],
-       'PSFPGA_FIFO_FULL': [],
-       'PSFPGA_TEST': [],
-       'SPARE4': [],
-       'DATA_BLOCK_FIRST_PRI': [],
-       'TIME_DATA_BLOCK_WHOLE': [],
-       'TIME_DATA_BLOCK_FRAC': [],
-       'SDI_BIT_FIELD': [],
-       'TIME_N': [],
-       'RADIUS_N': [],
-       'TANGENTIAL_VELOCITY_N': [],
-       'RADIAL_VELOCITY_N': [],
-       'TLP': [],
-       'TIME_WPF': [], 
-       'DELTA_TIME': [],
-       'TLP_INTERPOLATE': [],
-       'RADIUS_INTERPOLATE': [],
-       'TANGENTIAL_VELOCITY_INTERPOLATE': [], 
-       'RADIAL_VELOCITY_INTERPOLATE': [],
-       'END_TLP': [],
-       'S_COEFFS': [],
-       'C_COEFFS': [],
-       'SLOPE': [],
-       'TOPOGRAPHY': [],
-       'PHASE_COMPENSATION_STEP': [],
-       'RECEIVE_WINDOW_OPENING_TIME': [],
-       'RECEIVE_WINDOW_POSITION': [],
-     }
-  #
-  # Ancillary rows are 186 bytes long
-  #
-  recLen = 186
-  if os.path.isfile(fname):
-    _f = open(fname, 'rb')
-    fsize = os.path.getsize(fname)
-    for _i in range(int(fsize/recLen)): # Go through all the rows
-      _f.seek(_i*recLen)
-      data = _f.read(recLen)
-      #
-      # Set up dictionary for items
-      #
-      a['SCET_BLOCK_WHOLE'].append(struct.unpack('>I', data[0:4])[0])
-      a['SCET_BLOCK_FRAC'].append(struct.unpack('>H', data[4:6])[0])
-      a['TLM_COUNTER'].append(struct.unpack('>I', data[6:10])[0])
-      a['FMT_LENGTH'].append(struct.unpack('>H', data[10:12])[0])
-      a['SPARE1'].append(struct.unpack('>H', data[12:14])[0])
-      a['SCET_OST_WHOLE'].append(struct.unpack('>I', data[14:18])[0])
-      a['SCET_OST_FRAC'].append(struct.unpack('>H', data[18:20])[0])
-      a['SPARE2'].append(struct.unpack('>B', data[20:21])[0])
-      a['OST_LINE_NUMBER'].append(struct.unpack('>B', data[21:22])[0])
-      #
-      # Deal with the OST_LINE Entries
-      #
-      OST_LINE = bitstring.BitArray(data[22:39])
-      tmp = OST_LINE[0:4].uint
-      if tmp == 1:
-        a['OST_PULSE_REPETITION_INTERVAL'].append(1428)
-      elif tmp == 2:
-        a['OST_PULSE_REPETITION_INTERVAL'].append(1492)
-      elif tmp == 3:
-        a['OST_PULSE_REPETITION_INTERVAL'].append(1290)
-      elif tmp == 4:
-        a['OST_PULSE_REPETITION_INTERVAL'].append(2856)
-      elif tmp == 5:
-        a['OST_PULSE_REPETITION_INTERVAL'].append(2984)
-      else:
-        a['OST_PULSE_REPETITION_INTERVAL'].append(2580)
-      a['OST_PHASE_COMPENSATION_TYPE'].append(OST_LINE[4:8].uint)
-      a['OST_SPARE1'].append(OST_LINE[8:10].uint)
-      a['OST_DATA_LENGTH_TAKEN'].append(OST_LINE[10:32].uint)
-      a['OST_OPERATIVE_MODE'].append(OST_LINE[32:40].uint)
-      a['OST_MANUAL_GAIN_CONTROL'].append(OST_LINE[40:48].uint)
-      a['OST_COMPRESSION_SELECTION'].append(OST_LINE[48:49].bool)
-      a['OST_CLOSED_LOOP_TRACKING'].append(OST_LINE[49:50].bool)
-      a['OST_TRACKING_DATA_STORAGE'].append(OST_LINE[50:51].bool)
-      tmp = OST_LINE[51:54].uint
-      if tmp == 0:
-        a['OST_TRACKING_PRE_SUMMING'].append(0)
-      elif tmp == 1:
-        a['OST_TRACKING_PRE_SUMMING'].append(2)
-      elif tmp == 2:
-        a['OST_TRACKING_PRE_SUMMING'].append(3)
-      elif tmp == 3:
-        a['OST_TRACKING_PRE_SUMMING'].append(4)
-      elif tmp == 4:
-        a['OST_TRACKING_PRE_SUMMING'].append(8)
-      elif tmp == 5:
-        a['OST_TRACKING_PRE_SUMMING'].append(16)
-      elif tmp == 6:
-        a['OST_TRACKING_PRE_SUMMING'].append(32)
-      else:
-        a['OST_TRACKING_PRE_SUMMING'].append(64)
-      a['OST_TRACKING_LOGIC_SELECTION'].append(OST_LINE[54:55].uint)
-      a['OST_THRESHOLD_LOGIC_SELECTION'].append(OST_LINE[55:56].uint)
-      a['OST_SAMPLE_NUMBER'].append(OST_LINE[56:60].uint)
-      a['OST_SPARE2'].append(OST_LINE[60:61].uint)
-      a['OST_ALPHA_BETA'].append(OST_LINE[61:63].uint)
-      a['OST_REFERENCE_BIT'].append(OST_LINE[63:64].uint)
-      a['OST_THRESHOLD'].append(OST_LINE[64:72].uint)
-      a['OST_THRESHOLD_INCREMENT'].append(OST_LINE[72:80].uint)
-      a['OST_SPARE3'].append(OST_LINE[80:84].uint)
-      a['OST_INITIAL_ECHO_VALUE'].append(OST_LINE[84:87].uint)
-      a['OST_EXPECTED_ECHO_SHIFT'].append(OST_LINE[87:90].uint)
-      a['OST_WINDOW_LEFT_SHIFT'].append(OST_LINE[90:93].uint)
-      a['OST_WINDOW_RIGHT_SHIFT'].append(OST_LINE[93:96].uint)
-      a['OST_SPARE4'].append(OST_LINE[96:128].uint)
-      #
-      # End OST LINE
-      #
-      a['SPARE3'].append(struct.unpack('>B', data[38:39])[0])
-      a['DATA_BLOCK_ID'].append(bitstring.BitArray(data[39:42]).uint)
-      a['SCIENCE_DATA_SOURCE_COUNTER'].append(struct.unpack('>H', data[42:44])[0])
+    Path of a format file, matched without regard to case
+  """
+  for f in os.listdir(fmtDir):
+    if f.lower() == os.path.basename(name).lower():
+      return os.path.join(fmtDir, f)
+  raise FileNotFoundError('No format file {} in {}'.format(name, fmtDir))
+
+
+def uniqueNames(objs):
+  """
+    Names of objs with repeated names (SPARE) numbered 1, 2, ... in order
+  """
+  names = [o['NAME'] for o in objs]
+  seen = {}
+  out = []
+  for name in names:
+    if names.count(name) > 1:
+      seen[name] = seen.get(name, 0) + 1
+      name = '{}{}'.format(name, seen[name])
+    out.append(name)
+  return out
+
+
+def bitPlan(name, col, byte, start, bits, dtype, items=1):
+  """
+    Extraction of a bits wide field starting at 0-based MSB-first bit
+    start of the bytes at offset byte of column col: the covering bytes
+    are combined into a big-endian word, shifted and masked
+  """
+  b0 = start // 8
+  nb = (start % 8 + bits + 7) // 8
+  return {'name': name, 'column': col, 'byte': byte + b0, 'nbytes': nb, 'shift': nb*8 - start % 8 - bits,
+          'bits': bits, 'dtype': dtype, 'items': items}
+
+
+def fieldDtype(bits, kind):
+  if kind == 'b':
+    return 'bool'
+  width = next(w for w in [8, 16, 32, 64] if bits <= w)
+  return '{}{}'.format('i' if kind == 'i' else 'u', width // 8)
+
+
+def compileColumns(cols):
+  """
+    Build the record layout of a list of FMT columns: 'fields' lists
+    [name, format, offset, shape] for a structured dtype, 'plan' the bit
+    fields and odd-width integers to extract, and 'recLen' the record size
+  """
+  fields, plan = [], []
+  end = 0
+  for name, c in zip(uniqueNames(cols), cols):
+    off, nbytes = c['START_BYTE'] - 1, c['BYTES']
+    items = c.get('ITEMS', 1)
+    size = c.get('ITEM_BYTES', nbytes // items)
+    code = FMT_TYPES.get(c['DATA_TYPE'])
+    end = max(end, off + nbytes)
+    if c['BIT_COLUMNS'] or code is None or (code[-1] in 'ui' and size not in [1, 2, 4, 8]):
       #
-      # PACKET_SEGMENTATION_AND_FPGA_STATUS bit string
+      # Bit strings and odd-width integers are kept as bytes and decoded
+      # through the plan
       #
-      PSAFS = bitstring.BitArray(data[44:46])
-      a['PSFPGA_SCIENTIFIC_DATA_TYPE'].append(PSAFS[0:1].uint)
-      a['PSFPGA_SEGMENTATION_FLAG'].append(PSAFS[1:3].uint)
-      a['PSFPGA_SPARE1'].append(PSAFS[3:8].uint)
-      a['PSFPGA_SPARE2'].append(PSAFS[8:12].uint)
-      a['PSFPGA_DMA_ERROR'].append(PSAFS[12:13].uint)
-      a['PSFPGA_TC_OVERRUN'].append(PSAFS[13:14].uint)
-      a['PSFPGA_FIFO_FULL'].append(PSAFS[14:15].uint)
-      a['PSFPGA_TEST'].append(PSAFS[15:16].uint)
-      a['SPARE4'].append(struct.unpack('>B', data[46:47])[0])
-      a['DATA_BLOCK_FIRST_PRI'].append(bitstring.BitArray(data[47:50]).uint)
-      a['TIME_DATA_BLOCK_WHOLE'].append(struct.unpack('>I', data[50:54])[0])
-      a['TIME_DATA_BLOCK_FRAC'].append(struct.unpack('>H', data[54:56])[0])
-      a['SDI_BIT_FIELD'].append(struct.unpack('>H', data[56:58])[0])
-      a['TIME_N'].append(struct.unpack('>f', data[58:62])[0])
-      a['RADIUS_N'].append(struct.unpack('>f', data[62:66])[0])
-      a['TANGENTIAL_VELOCITY_N'].append(struct.unpack('>f', data[66:70])[0])
-      a['RADIAL_VELOCITY_N'].append(struct.unpack('>f', data[70:74])[0])
-      a['TLP'].append(struct.unpack('>f', data[74:78])[0])
-      a['TIME_WPF'].append(struct.unpack('>f', data[78:82])[0])
-      a['DELTA_TIME'].append(struct.unpack('>f', data[82:86])[0])
-      a['TLP_INTERPOLATE'].append(struct.unpack('>f', data[86:90])[0])
-      a['RADIUS_INTERPOLATE'].append(struct.unpack('>f', data[90:94])[0])
-      a['TANGENTIAL_VELOCITY_INTERPOLATE'].append(struct.unpack('>f', data[94:98])[0])
-      a['RADIAL_VELOCITY_INTERPOLATE'].append(struct.unpack('>f', data[98:102])[0])
-      a['END_TLP'].append(struct.unpack('>f', data[102:106])[0])
-      tmp = [struct.unpack('>f', data[106:110])[0],
-                            struct.unpack('>f', data[110:114])[0],
-                            struct.unpack('>f', data[114:118])[0],
-                            struct.unpack('>f', data[118:122])[0],
-                            struct.unpack('>f', data[122:126])[0],
-                            struct.unpack('>f', data[126:130])[0],
-                            struct.unpack('>f', data[130:134])[0],
-                            struct.unpack('>f', data[134:138])[0]
-            ]
-      tmp = [str(i) for i in tmp]
-      a['S_COEFFS'].append('"'+ ', '.join(tmp) + '"')
-      tmp = [struct.unpack('>f', data[138:142])[0],
-                            struct.unpack('>f', data[142:146])[0],
-                            struct.unpack('>f', data[146:150])[0],
-                            struct.unpack('>f', data[150:154])[0],
-                            struct.unpack('>f', data[154:158])[0],
-                            struct.unpack('>f', data[158:162])[0],
-                            struct.unpack('>f', data[162:166])[0]
-            ]
-      tmp = [str(i) for i in tmp]
-      a['C_COEFFS'].append('"'+ ', '.join(tmp) + '"')
-      a['SLOPE'].append(struct.unpack('>f', data[166:170])[0])
-      a['TOPOGRAPHY'].append(struct.unpack('>f', data[170:174])[0])
-      a['PHASE_COMPENSATION_STEP'].append(struct.unpack('>f', data[174:178])[0])
-      a['RECEIVE_WINDOW_OPENING_TIME'].append(struct.unpack('>f', data[178:182])[0])
-      a['RECEIVE_WINDOW_POSITION'].append(struct.unpack('>f', data[182:186])[0])
-    return a
-
-
-def sepSAdata(iS, oS, oA, n, b, p, idx=[None,None]):
-  fsize = os.path.getsize(iS)
-  _a = open("tmp.anc", 'wb')
-  _s = open("tmp.sci", 'wb')
-  #
-  # Now split the SCIENCE and ANCILIARY DATA
-  #
-  idx = idx if idx != [None,None] else [0,int(fsize/n)]
-  _i = idx[0]
-  cnt = -1
-  #
-  # Read and process only a select number of echoes
-  #
-  with open(iS, 'rb') as f:
-    #
-    # 
-    f.seek(_i*n)
-    while _i <= idx[1]:
-      cnt += 1
-      s = f.read(n)
-      _a.write(s[:186])
-      _s.write(s[186:])
-      _i += 1
-  _a.close()
-  _s.close()
-  #
-  # Save Ancillary data as CSV
-  #
-  a = parseAncillary("tmp.anc")  
-  anc = pd.DataFrame.from_dict(a)
-  anc.to_csv(oA)
-  #
-  # Deal with the science data, the goal is to save each science file are 8-bit
-  # signed integers
-  #
-  if b == 8:
-    tmp = np.fromfile('tmp.sci', dtype='int8') 
-  elif b == 6:
-    tmp = load6bit('tmp.sci', 3600)
-  elif b == 4:
-    tmp = np.fromfile('tmp.sci', dtype='int4')
-  #
-  # TMP now holds the data, now decompress data...
-  #
-  decom = getDecom(a['OST_COMPRESSION_SELECTION'][0], p, b, a['SDI_BIT_FIELD'])
-  data = tmp * decom
-  #
-  # Now save decompressed science data as int8 binary
-  #
-  data.astype('int8').tofile(oS)
-  #
-  #
-  # Remove temporary files
-  #
-  os.remove("tmp.anc")
-  os.remove("tmp.sci")
-  return cnt
+      fields.append([name, 'u1', off, [nbytes]])
+      if not c['BIT_COLUMNS']:
+        plan.append(bitPlan(name, name, 0, 0, nbytes*8, fieldDtype(nbytes*8, code[-1] if code else 'u')))
+      prefix = FMT_PREFIX.get(c['NAME'], c['NAME'] + '_')
+      for bname, b in zip(uniqueNames(c['BIT_COLUMNS']), c['BIT_COLUMNS']):
+        kind = 'b' if b.get('BIT_DATA_TYPE') == 'BOOLEAN' else 'i' if 'INTEGER' in b.get('BIT_DATA_TYPE', '') and 'UNSIGNED' not in b['BIT_DATA_TYPE'] else 'u'
+        bitems = b.get('ITEMS', 1)
+        bits = b.get('ITEM_BITS', b['BITS']) if bitems > 1 else b['BITS']
+        plan.append(bitPlan(prefix + bname, name, 0, b['START_BIT'] - 1, bits, fieldDtype(bits, kind), bitems))
+    else:
+      fmt = code + str(size) if code != 'S' else 'S' + str(size)
+      fields.append([name, fmt, off, [items] if items > 1 else []])
+  return {'fields': fields, 'plan': plan, 'recLen': end}
 
-def detPRF(val):
-  PRF = {'335': 335.12,
-         '350': 350.14,
-         '387': 387.60,
-         '670': 670.24,
-         '700': 700.28,
-         '775': 775.19,
-         }
-  return PRF[str(val)] 
 
+def fmtDtype(layout, recLen=None, types={}):
+  """
+    Structured dtype of a layout, with the columns in types read with
+    another format
+  """
+  fields = layout['fields']
+  return np.dtype({'names': [f[0] for f in fields],
+                   'formats': [(types.get(f[0], f[1]), tuple(f[3])) if f[3] else types.get(f[0], f[1]) for f in fields],
+                   'offsets': [f[2] for f in fields],
+                   'itemsize': recLen if recLen else layout['recLen']})
 
-def getDecom(c, p, b, s):
+
+def fmtSources(fname):
   """
-    This function decompresses the data based off page 8 of the
-    SHALLOW RADAR EXPERIMENT DATA RECORD SOFTWARE INTERFACE SPECIFICATION.
-    If the compression type is 'Static'
-       U = C* ( 2**S / N )
-         C is the Compressed Data
-         S = L - R + 8
-            L is base 2 log of N rounded UP to the nearest integer
-            R is the bit resolution of the compressed values
-         N is the number of pre-summed echoes
-    If the compression type is 'dynamic'
-      NOT WORKING YET
-      U = C*2**S/N
-        C is the compressed data
-        N is the number of pre-summed echoes
-        S = SDI for SDI <= 5
-        S = SDI-6 for 5 < SDI <= 16
-        S = SDI-16 for SDI > 16
-          where SDI is the SDI_BIT_FIELD parameter from ANCILLIARY DATA
+    Size and mtime of a format file and the files it points to, used to
+    invalidate the disk cache
   """
-  #
-  # Step 5: Decompress the data
-  # Note: Only Static decompression works at this time
-  #
-  if c is not True:
-    c = 'STATIC'
-  else:
-    c = 'DYNAMIC'
-  if c == 'STATIC' or c == 'DYNAMIC':
+  src = {}
+  todo = [fname]
+  while todo:
+    f = todo.pop()
+    st = os.stat(f)
+    src[os.path.basename(f)] = [st.st_size, st.st_mtime]
+    with open(f) as _f:
+      for line in _f:
+        if line.strip().startswith('^') and 'STRUCTURE' in line:
+          todo.append(findFMT(line.split('=')[-1].strip().strip('"'), os.path.dirname(f)))
+  return src
+
+
+@lru_cache(maxsize=None)
+def compileFMT(name, fmtDir=FMT_DIR, cacheDir=FMT_CACHE):
+  """
+    Compile a format file (e.g. 'science_ancillary.fmt') into its record
+    layout (see compileColumns), with 'dtype' the structured dtype.  The
+    layout is read from cacheDir when the format files are unchanged and
+    saved there otherwise; cacheDir None disables the disk cache.
+  """
+  fname = findFMT(name, fmtDir)
+  src = fmtSources(fname)
+  cache = os.path.join(cacheDir, 'fmt_{}.json'.format(os.path.basename(fname).lower())) if cacheDir else None
+  layout = None
+  if cache is not None and os.path.isfile(cache):
+    try:
+      with open(cache) as f:
+        layout = json.load(f)
+      if layout.get('version') != FMT_VERSION or layout.get('sources') != json.loads(json.dumps(src)):
+        layout = None
+    except ValueError:
+      layout = None
+  if layout is None:
+    layout = compileColumns(readFMT(fname))
+    layout.update({'version': FMT_VERSION, 'sources': src})
+    if cache is not None:
+      try:
+        os.makedirs(cacheDir, exist_ok=True)
+        with open(cache, 'w') as f:
+          json.dump(layout, f)
+      except OSError:
+        #
+        # A read-only cache only costs the compile time
+        #
+        pass
+  layout['dtype'] = fmtDtype(layout)
+  return layout
+
+
+def planStart(p):
+  """
+    0-based MSB-first start bit of a plan entry within its column
+  """
+  return p['byte']*8 + p['nbytes']*8 - p['shift'] - p['bits']
+
+
+def columnWords(col):
+  """
+    The bytes of an (n, nbytes) uint8 column as native unsigned 64-bit
+    words holding its big-endian bits: a single word of nbytes*8 bits up
+    to 8 bytes, 64-bit words beyond.  Returns the words and their width.
+  """
+  if col.shape[1] <= 8:
+    w = np.zeros(col.shape[0], dtype='u8')
+    for _j in range(col.shape[1]):
+      w = (w << np.uint64(8)) | col[:, _j]
+    return w[:, None], col.shape[1] * 8
+  pad = -col.shape[1] % 8
+  col = np.concatenate([col, np.zeros((col.shape[0], pad), dtype='u1')], axis=1) if pad else np.ascontiguousarray(col)
+  return col.view('>u8').astype('u8'), 64
+
+
+def extractBits(col, p, words=None):
+  """
+    Apply one plan entry to an (n, nbytes) uint8 column.  words may pass
+    the columnWords of col, shared by all the bit fields of a column.
+  """
+  if p['items'] > 1:
+    return unpackSamples(col[:, p['byte']:], p['bits'], p['items'])
+  words, width = columnWords(col) if words is None else words
+  start = planStart(p)
+  if start % width + p['bits'] > width:
     #
-    # Handle fixed scaling
+    # A field straddling two words is taken from its own bytes
     #
-    if c == 'STATIC': # Static scaling
-      L = np.ceil(np.log2(int(p)))
-      R = b
-      S = L - R + 8
-      N = p
-      return np.power(2, S) / N
-    elif c == True:#dynamic scaling
-      N = p
-      if SDI <= 5:
-        S = SDI
-      elif 5 < SDI <= 16:
-        S = SDI - 6
-      elif SDI > 16:
-        S = SDI - 16
-      return np.power(2, S) / N
-    return
+    words, width = columnWords(col[:, p['byte']:p['byte'] + p['nbytes']])
+    start = width - p['shift'] - p['bits']
+  w = words[:, start // width]
+  w = (w >> np.uint64(width - start % width - p['bits'])) & np.uint64((1 << p['bits']) - 1)
+  if p['dtype'][0] == 'i':
+    #
+    # Sign extend
+    #
+    w = w.astype('i8')
+    w = np.where(w >= 1 << (p['bits'] - 1), w - (1 << p['bits']), w)
+  return w.astype(p['dtype'])
 
-def formOut(lblFile, outDir):
-  oDirs = {'SCIENCE': outDir + '/SCIENCE/',
-           'ANCILLARY': outDir + '/ANCILLARY/',
-           'AUX': outDir + '/AUXILIARY/',
-           'LOGS': outDir + '/LOGS/',
-          }
-  tmp = os.path.basename(lblFile).split('.')[0]
-  oFiles = {'SCIENCE': oDirs['SCIENCE'] + tmp + '.sci',
-            'ANCILLARY': oDirs['ANCILLARY'] + tmp +'.csv',
-            'AUX': oDirs['AUX'] + tmp + '.csv',
-            'LOG': oDirs['LOGS'] + tmp + '.log',
-           }
-  return oDirs, oFiles
 
-def makeOut(outDir, oDirs):
-  #
-  # Make output directories
-  #
-  if not os.path.isdir(outDir):
-    print('[WARNING] New output directory will be created at {}'.format(outDir))
-    os.mkdir(outDir)
-  #
-  # Check output subdirectories
-  #
-  if not os.path.isdir(oDirs['SCIENCE']):
-    os.mkdir(oDirs['SCIENCE'])
-  if not os.path.isdir(oDirs['ANCILLARY']):
-    os.mkdir(oDirs['ANCILLARY'])
-  if not os.path.isdir(oDirs['AUX']):
-    os.mkdir(oDirs['AUX'])
-  if not os.path.isdir(oDirs['LOGS']):
-    os.mkdir(oDirs['LOGS'])
-  return
+def decodeFMT(buf, name, fmtDir=FMT_DIR, types={}, names={}, luts={}):
+  """
+    Decode records with the layout of a format file: every column as a
+    native-endian array in FMT order, bit string columns replaced in place
+    by their bit fields and odd-width integers combined.  buf is bytes, a
+    (nrec, recLen) uint8 array or a record array; records may be longer
+    than the layout.  types reads columns with another format (see
+    fmtDtype), names renames columns or bit fields and luts maps coded
+    values through lookup tables, both keyed by FMT name.
+  """
+  layout = compileFMT(name, fmtDir)
+  if not isinstance(buf, np.ndarray) or buf.dtype.names is None:
+    buf = np.asarray(bytearray(buf) if isinstance(buf, (bytes, memoryview)) else buf, dtype='u1')
+    n = buf.shape[-1] if buf.ndim == 2 else layout['recLen']
+    buf = recordView(buf, fmtDtype(layout, n, types))
+  plan = {}
+  for p in layout['plan']:
+    plan.setdefault(p['column'], []).append(p)
+  out = {}
+  for f in layout['fields']:
+    if f[0] not in plan:
+      out[names.get(f[0], f[0])] = toNative(buf[f[0]])
+      continue
+    col = buf[f[0]]
+    words = columnWords(col) if len(plan[f[0]]) > 1 else None
+    for p in plan[f[0]]:
+      v = extractBits(col, p, words)
+      out[names.get(p['name'], p['name'])] = luts[p['name']][v] if p['name'] in luts else v
+  return out
 
-def detIDX(lons, lats, roi):
-  #
-  # Convert lists to NP arrays
-  #
-  if type(lons) is list:
-    lons = np.array(lons)
-  if type(lats) is list:
-    lats = np.array(lats)
-  idx = np.where( np.logical_and( 
-          np.logical_and(lats >= roi[0], lats <= roi[2]),
-          np.logical_and(lons >= roi[1], lons <= roi[3])
-                ))
-  if len(idx[0]) == 0:
-    return -1, -1
-  return idx[0].min(), idx[0].max()
 
+###############################################
+#
+# Auxiliary record layout (see format/auxiliary.fmt)
+#
+###############################################
+AUX_RECLEN = 267
+AUX_DTYPE = compileFMT('auxiliary.fmt')['dtype']
 
-def load6bit(f, n):
-  nrec = int(os.path.getsize(f)/2700)
-  fmt = ['int:6']*n
-  a = np.zeros(int(n*nrec), int)
-  with open(f, 'rb') as _f:
-    for _i in range(nrec):
-      s = bitstring.BitStream(_f.read(2700))
-      a[_i*n:(_i*n)+n] = s.unpack(fmt)
+
+def toNative(col):
+  """
+    Return a column in native byte order so pandas and downstream numpy
+    code do not have to deal with big-endian views.
+  """
+  if col.dtype.kind == 'S':
+    return np.char.decode(col, 'utf-8')
+  return col.astype(col.dtype.newbyteorder('='))
+
+
+def readAux(fname, mmap=False):
+  """
+    Read every 267-byte auxiliary record in one call as a big-endian
+    structured array.  With mmap=True the file is memory mapped instead
+    of being read into memory.
+  """
+  nrec = int(os.path.getsize(fname) / AUX_RECLEN)
+  if mmap:
+    return np.memmap(fname, dtype=AUX_DTYPE, mode='r', shape=(nrec,))
+  return np.fromfile(fname, dtype=AUX_DTYPE, count=nrec)
+
+
+def readAuxGeo(fname):
+  """
+    Read only SUB_SC_EAST_LONGITUDE and SUB_SC_PLANETOCENTRIC_LATITUDE
+    through strided views into the memory mapped auxiliary records
+  """
+  recs = readAux(fname, mmap=True)
+  return toNative(recs['SUB_SC_EAST_LONGITUDE']), toNative(recs['SUB_SC_PLANETOCENTRIC_LATITUDE'])
+
+
+def decodeAux(recs, t0=None):
+  """
+    Convert structured auxiliary records into a dictionary of numpy columns
+    in the same order as the PDS format, adding ELAPSED_TIME.  t0 is the
+    EPHEMERIS_TIME of the first record in the file and defaults to that of
+    the first record given.
+  """
+  a = {}
+  for key, v in decodeFMT(recs, 'auxiliary.fmt').items():
+    a[key] = v
+    if key == 'EPHEMERIS_TIME':
+      if t0 is None:
+        t0 = a[key][0] if len(a[key]) else 0.
+      a['ELAPSED_TIME'] = a[key] - t0
   return a
-  
-def rangeCompression():
-  return 
+
+
+def parseAuxFile(fname, oFile, roi=[None,None,None,None], dic=True, df=False, csv=False, binary=False, saveNP=False, mmap=False, fmt='csv',
+                 runs=None):
+  """
+    Decode the auxiliary file.  Without an ROI the second return value is
+    [None, None]; with one it is the list of [start, stop] record runs
+    inside the ROI, or [-1, -1] when the ROI is missed.  With csv True the
+    table is written to oFile in the table format fmt (see writeTable);
+    tables written for an ROI are indexed by the original record numbers.
+    runs, when given, selects the records instead of the ROI test (e.g.
+    the aux records spanning the traces in the ROI, see geometryAuxMasks).
+  """
+  if os.path.isfile(fname):
+    idx = [None, None]
+    t0 = None
+    if runs is not None or roi != [None,None,None,None]:
+      #
+      # Check the ROI against the geolocation columns alone and only
+      # decode the records that fall inside it
+      #
+      idx = runs if runs is not None else detRuns(*readAuxGeo(fname), roi)
+      if len(idx) == 0:
+        return -1, [-1, -1]
+      recs = readAux(fname, mmap=True)
+      t0 = float(recs['EPHEMERIS_TIME'][0])
+      recs = takeRuns(recs, idx)
+    else:
+      recs = readAux(fname, mmap=mmap)
+    #
+    # Decode all records at once
+    #
+    a = decodeAux(recs, t0=t0)
+    if csv == True:
+      writeTable(a, oFile, fmt, index=runIndex(idx) if idx != [None, None] else None)
+      return a, idx
+    if dic == True:
+      return a, idx
+    elif df == True:
+      return pd.DataFrame.from_dict(a), idx
+
+
+def parseAuxROIs(fname, oFiles, rois, fmt='csv', masks=None):
+  """
+    Decode the auxiliary file once for several ROIs and write each ROI's
+    records to the matching entry of oFiles.  Returns the (nroi, nrec)
+    membership masks and the list of [start, stop] runs of each ROI.
+    masks, when given, replaces the ROI test of the aux positions (e.g.
+    with geometryAuxMasks).
+  """
+  if masks is None:
+    masks = roiMasks(*readAuxGeo(fname), rois)
+  runs = [maskRuns(m) for m in masks]
+  union = masks.any(axis=0)
+  if union.any():
+    recs = readAux(fname, mmap=True)
+    t0 = float(recs['EPHEMERIS_TIME'][0])
+    aux = decodeAux(takeRuns(recs, maskRuns(union)), t0=t0)
+    index = np.flatnonzero(union)
+    for _k, oFile in enumerate(oFiles):
+      if len(runs[_k]):
+        sel = masks[_k][union]
+        writeTable({key: aux[key][sel] for key in aux}, oFile, fmt, index=index[sel])
+  return masks, runs
+
+
+###############################################
+#
+# Ancillary record layout (see format/science_ancillary.fmt)
+#
+###############################################
+ANC_RECLEN = 186
+#
+# Lookup tables for coded OST values
+#
+PRI_LUT = np.array([2580, 1428, 1492, 1290, 2856, 2984] + [2580]*10, dtype='u2')
+PRESUM_LUT = np.array([0, 2, 3, 4, 8, 16, 32, 64], dtype='u1')
+#
+# Where the decoded ancillary records depart from the FMT file:
+# RECEIVE_WINDOW_POSITION is read as a float as SHERPA always has (the
+# FMT says MSB_UNSIGNED_INTEGER), OST_DATA_TAKE_LENGTH keeps its
+# historical output name and coded OST values go through the tables above
+#
+ANC_TYPES = {'RECEIVE_WINDOW_POSITION': '>f4'}
+ANC_NAMES = {'OST_DATA_TAKE_LENGTH': 'OST_DATA_LENGTH_TAKEN'}
+ANC_LUTS = {'OST_PULSE_REPETITION_INTERVAL': PRI_LUT, 'OST_TRACKING_PRE_SUMMING': PRESUM_LUT}
+ANC_DTYPE = fmtDtype(compileFMT('science_ancillary.fmt'), types=ANC_TYPES)
+
+
+def recordView(buf, dtype):
+  """
+    View a buffer of fixed-length records through a structured dtype.
+    buf may be bytes, a 1-D uint8 array, or a 2-D (nrec, recLen) uint8
+    array (e.g. a memmap slice) whose first dtype.itemsize bytes per row
+    hold the record; no data is copied.
+  """
+  if isinstance(buf, (bytes, bytearray, memoryview)):
+    return np.frombuffer(buf, dtype=dtype, count=len(buf)//dtype.itemsize)
+  if buf.dtype == dtype:
+    return buf
+  if buf.ndim == 1:
+    buf = buf[:len(buf) - len(buf) % dtype.itemsize].reshape(-1, dtype.itemsize)
+  return buf[:, :dtype.itemsize].view(dtype)[:, 0]
+
+
+def decodeAncillary(buf):
+  """
+    Decode the 186-byte ancillary header of every record at once through
+    the science_ancillary.fmt layout (see decodeFMT) with the ANC_TYPES,
+    ANC_NAMES and ANC_LUTS overrides.  S_COEFFS/C_COEFFS are returned as
+    float32 (n, 8) and (n, 7) arrays.
+  """
+  return decodeFMT(recordView(buf, ANC_DTYPE), 'science_ancillary.fmt', names=ANC_NAMES, luts=ANC_LUTS)
+
+
+def flattenTable(a):
+  """
+    Expand (n, k) columns such as S_COEFFS into NAME_1 ... NAME_k columns so
+    the table can be handed to pandas
+  """
+  out = {}
+  for key in a:
+    if np.ndim(a[key]) == 2:
+      for _j in range(a[key].shape[1]):
+        out['{}_{}'.format(key, _j+1)] = a[key][:, _j]
+    else:
+      out[key] = a[key]
+  return out
+
+
+###############################################
+#
+# Table output (aux and ancillary)
+#
+###############################################
+TABLE_EXT = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather', 'npy': '.npy', 'npz': '.npz'}
+
+
+def tableFormat(fmt):
+  """
+    Check a table format, falling back to a structured .npy array when
+    Parquet/Feather are requested without pyarrow installed
+  """
+  if fmt not in TABLE_EXT:
+    raise ValueError('Unknown table format {}, expected one of {}'.format(fmt, ', '.join(TABLE_EXT)))
+  if fmt in ['parquet', 'feather'] and pa is None:
+    print('[WARNING] pyarrow is not installed, writing npy instead of {}'.format(fmt))
+    return 'npy'
+  return fmt
+
+
+def tableName(oFile, fmt):
+  return os.path.splitext(oFile)[0] + TABLE_EXT[fmt]
+
+
+def tableDtype(a):
+  """
+    Native structured dtype of a column dictionary with a leading RECORD
+    field; (n, k) columns become (k,) subarray fields
+  """
+  return np.dtype([('RECORD', 'i8')] + [(key, a[key].dtype, a[key].shape[1:]) for key in a])
+
+
+def openTable(oFile, fmt='csv', nrows=None):
+  """
+    Start a table written in blocks with appendTable and finished with
+    closeTable.  The extension of oFile is replaced to match fmt; nrows is
+    the total number of rows, needed up front for npy.
+  """
+  fmt = tableFormat(fmt)
+  return {'file': tableName(oFile, fmt), 'fmt': fmt, 'nrows': nrows, 'row': 0, 'out': None, 'cols': []}
+
+
+def appendTable(t, a, index):
+  """
+    Append a block of columns, indexed by original record number, to a table
+  """
+  if t['fmt'] in ['csv', 'parquet', 'feather']:
+    df = pd.DataFrame.from_dict(flattenTable(a))
+    df.index = index
+    if t['fmt'] == 'csv':
+      if t['out'] is None:
+        t['out'] = open(t['file'], 'w', newline='')
+      df.to_csv(t['out'], header=(t['row'] == 0))
+    else:
+      df.index.name = 'RECORD'
+      tbl = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+      if t['out'] is None:
+        t['out'] = pq.ParquetWriter(t['file'], tbl.schema) if t['fmt'] == 'parquet' else pa.ipc.new_file(t['file'], tbl.schema)
+      t['out'].write_table(tbl)
+  elif t['fmt'] == 'npy':
+    if t['out'] is None:
+      nrows = t['nrows'] if t['nrows'] is not None else len(index)
+      t['out'] = np.lib.format.open_memmap(t['file'], mode='w+', dtype=tableDtype(a), shape=(nrows,))
+    rows = t['out'][t['row']:t['row']+len(index)]
+    rows['RECORD'] = index
+    for key in a:
+      rows[key] = a[key]
+  elif t['fmt'] == 'npz':
+    t['cols'].append((index, a))
+  t['row'] += len(index)
+  return t
+
+
+def closeTable(t):
+  if t['fmt'] == 'npz':
+    if len(t['cols']):
+      cols = {'RECORD': np.concatenate([i for i, _ in t['cols']])}
+      for key in t['cols'][0][1]:
+        cols[key] = np.concatenate([a[key] for _, a in t['cols']])
+      np.savez(t['file'], **cols)
+  elif t['fmt'] == 'npy':
+    if t['out'] is not None:
+      t['out'].flush()
+  elif t['out'] is not None:
+    t['out'].close()
+  t['out'] = None
+  return t['file']
+
+
+def writeTable(a, oFile, fmt='csv', index=None):
+  """
+    Write a column dictionary as CSV, Parquet, Feather, .npy (structured
+    array) or .npz, keeping the column dtypes in the binary formats
+  """
+  index = np.arange(len(next(iter(a.values())))) if index is None else index
+  t = openTable(oFile, fmt, len(index))
+  appendTable(t, a, index)
+  return closeTable(t)
+
+
+def readTable(fname):
+  """
+    Read a table written by writeTable back as a DataFrame indexed by
+    record number
+  """
+  ext = os.path.splitext(fname)[1]
+  if ext == '.csv':
+    return pd.read_csv(fname, index_col=0)
+  if ext == '.parquet':
+    return pd.read_parquet(fname).set_index('RECORD')
+  if ext == '.feather':
+    return pd.read_feather(fname).set_index('RECORD')
+  if ext == '.npy':
+    a = np.load(fname, mmap_mode='r')
+    return pd.DataFrame.from_dict(flattenTable({key: a[key] for key in a.dtype.names})).set_index('RECORD')
+  if ext == '.npz':
+    with np.load(fname) as a:
+      return pd.DataFrame.from_dict(flattenTable({key: a[key] for key in a.files})).set_index('RECORD')
+  raise ValueError('Unknown table file {}'.format(fname))
+
+
+def parseAncillary(fname):
+  """
+    Decode an ancillary file of back-to-back 186-byte records
+  """
+  if os.path.isfile(fname):
+    nrec = int(os.path.getsize(fname) / ANC_RECLEN)
+    return decodeAncillary(np.fromfile(fname, dtype=ANC_DTYPE, count=nrec))
+
+
+def readRecords(iS, n):
+  """
+    Memory map a science telemetry file as an (nrec, n) uint8 record view,
+    where n is the record length from parseFileName
+  """
+  nrec = int(os.path.getsize(iS) / n)
+  if nrec == 0:
+    return np.zeros((0, n), dtype='u1')
+  return np.memmap(iS, dtype='u1', mode='r', shape=(nrec, n))
+
+
+#
+# Blocks read ahead of the decoder by default (see readBlocks)
+#
+READ_AHEAD = 2
+
+def readBlocks(iS, n, runs, block, depth=0, stats=None):
+  """
+    Yield (start, records) for consecutive blocks of at most block records
+    of the [start, stop] runs of science file iS, in order.  With depth 0,
+    or when one block covers the selection, each block is a read-only view
+    of the memory mapped file, so nothing is copied.  Otherwise a background
+    thread reads up to depth blocks ahead into a fixed pool of reusable
+    buffers, so disk reads overlap with the caller's decoding and writing.
+    A block's buffer is handed back to the reader once the next block is
+    requested, so anything that must outlive the loop iteration has to be
+    copied.  The time spent waiting for each block is the readRecords stage
+    of stats.
+  """
+  if depth <= 0 or block >= sum(e - s + 1 for s, e in runs):
+    recs = readRecords(iS, n)
+    for s, e in runs:
+      for _i in range(s, e+1, block):
+        with timeStage(stats, 'readRecords') as c:
+          r = recs[_i:min(_i+block, e+1)]
+          c['records'], c['bytesRead'] = len(r), r.nbytes
+        yield _i, r
+    return
+  rows = min(block, max(e - s + 1 for s, e in runs))
+  free, full = queue.Queue(), queue.Queue(maxsize=depth)
+  for _ in range(depth + 1):
+    free.put(np.empty((rows, n), dtype='u1'))
+  stop = threading.Event()
+
+  def reader():
+    try:
+      with open(iS, 'rb') as f:
+        for s, e in runs:
+          for _i in range(s, e+1, block):
+            buf = free.get()
+            if buf is None or stop.is_set():
+              return
+            k = min(block, e+1-_i)
+            f.seek(_i * n)
+            if f.readinto(buf[:k]) != k * n:
+              raise IOError('Short read of {} records at record {} of {}'.format(k, _i, iS))
+            full.put((_i, buf, k))
+    except BaseException as err:
+      full.put(err)
+
+  t = threading.Thread(target=reader, name='readBlocks', daemon=True)
+  t.start()
+  try:
+    for _ in range(sum(len(range(s, e+1, block)) for s, e in runs)):
+      with timeStage(stats, 'readRecords') as c:
+        item = full.get()
+        if isinstance(item, tuple):
+          c['records'], c['bytesRead'] = item[2], item[2] * n
+      if isinstance(item, BaseException):
+        raise item
+      _i, buf, k = item
+      yield _i, buf[:k]
+      free.put(buf)
+  finally:
+    #
+    # Unblock and stop the reader if the caller stopped early
+    #
+    stop.set()
+    while t.is_alive():
+      free.put(None)
+      try:
+        full.get(timeout=0.01)
+      except queue.Empty:
+        pass
+    t.join()
+
+
+def sepSAdata(iS, oS, oA, n, b, p, idx=[None,None], block=None, rc=None, oR=None, fmt='csv',
+              sci='raw', sciDtype='int8', meta={}, stats=None, depth=READ_AHEAD, workers=None,
+              stack=None, oK=None, align=None):
+  """
+    Split, decode and decompress the SCIENCE and ANCILLARY data of the
+    selected records.  idx is [None, None] for the whole file, a single
+    [start, stop] range, or a list of [start, stop] runs as returned by
+    parseAuxFile; only those runs are read.  With block set, records are
+    processed in blocks of that many records, each appended to the outputs
+    before the next is read, so peak memory scales with the block size and
+    not the file size, and depth blocks are read ahead on a background
+    thread (see readBlocks).  workers splits the records into shards decoded
+    in parallel processes.  rc and oR add an optional range compression
+    stage, stack and oK an along-track stacking stage and align a receive
+    window alignment stage, see sepSAdataROIs, and fmt selects the ancillary
+    table format.  sci, sciDtype and meta select the science product layout
+    and stats collects the stage statistics, see sepSAdataROIs.
+  """
+  nrec = int(os.path.getsize(iS) / n)
+  mask = runMask(toRuns(idx, nrec), nrec)
+  return sepSAdataROIs(iS, [oS], [oA], mask[None, :], n, b, p, block=block,
+                       rc=rc, oR=[oR] if rc is not None else None, fmt=fmt,
+                       sci=sci, sciDtype=sciDtype, meta=meta, stats=stats, depth=depth,
+                       workers=workers, stack=stack, oK=[oK] if stack is not None else None, align=align)[0]
+
+
+def decodeBlock(r, i0, b, p, rc=None, sci='raw', sciDtype='int8', stats=None, echoes=False, align=None):
+  """
+    Decode a block of science records starting at record i0 for the
+    outputs of sepSAdataROIs.  Returns the ancillary columns, the science
+    samples in the product layout of sci/sciDtype, their scale factors,
+    the range compressed traces (None without rc) and, with echoes True,
+    the decompressed echoes (otherwise None).  With align the decompressed
+    echoes are first shifted by align['shift'] (see alignTraces).
+  """
+  scaled = sci == 'raw' or sciDtype == 'float32'
+  packed = sci != 'raw' and sciDtype == 'packed'
+  #
+  # Decode the ancillary data
+  #
+  with timeStage(stats, 'decodeAncillary', len(r), len(r)*ANC_RECLEN):
+    a = decodeAncillary(r[:, :ANC_RECLEN])
+  #
+  # Unpack the science samples to int8 and get each record's
+  # decompression factor; the decompressed echoes are only formed
+  # when an output needs them
+  #
+  with timeStage(stats, 'unpackSamples', len(r), len(r)*NSAMP*b//8):
+    tmp = unpackSamples(r[:, ANC_RECLEN:], b)
+  with timeStage(stats, 'decompress', len(r)):
+    decom = getDecom(a['OST_COMPRESSION_SELECTION'], p, b, a['SDI_BIT_FIELD'])
+    scale = np.broadcast_to(decom, (len(r), 1))[:, 0]
+    if rc is not None or echoes or align is not None or (scaled and not packed):
+      data = tmp * decom
+  if align is not None:
+    with timeStage(stats, 'align', len(r)):
+      data = alignTraces(data, align['shift'][i0:i0+len(r)])
+  echo = data if echoes else None
+  #
+  # Range compress the decompressed echoes
+  #
+  rcData = None
+  if rc is not None:
+    with timeStage(stats, 'rangeCompression', len(r)):
+      rcData = rangeCompression(data, blockFilter(rc, i0, i0+len(r)), power=rc.get('power', False))
+  if packed:
+    data = r[:, ANC_RECLEN:ANC_RECLEN + NSAMP*b//8]
+  elif sci == 'raw':
+    data = clipInt8(data, i0)
+  elif scaled:
+    data = data.astype(sciDtype)
+  else:
+    data = tmp
+  return a, data, scale, rcData, echo
+
+
+def clipInt8(data, i0=0):
+  """
+    Saturate the decompressed samples of the records from i0 to the int8
+    range of the raw science stream, warning when any are clipped (e.g.
+    dynamic scaling factors of up to 2**S/N)
+  """
+  if data.size and (data.min() < -128 or data.max() > 127):
+    nclip = np.count_nonzero((data < -128) | (data > 127))
+    print('[WARNING] {} decompressed samples of records {}-{} are outside the int8 range of the raw science '
+          'stream and were clipped; use --sciFormat sherpa --sciDtype float32 to keep them'.format(nclip, i0, i0+len(data)-1))
+    data = np.clip(data, -128, 127)
+  return data.astype('int8')
+
+
+def sepSAdataROIs(iS, oS, oA, masks, n, b, p, block=None, rc=None, oR=None, fmt='csv',
+                  sci='raw', sciDtype='int8', meta={}, stats=None, depth=READ_AHEAD, workers=None,
+                  stack=None, oK=None, align=None):
+  """
+    Single-pass version of sepSAdata for several record selections.  masks
+    is an (nsel, nrec) boolean array; the union of the selections is read
+    and decoded once and each selection's rows are written to its own
+    oS[k] / oA[k] outputs, the ancillary table in format fmt (see
+    writeTable).  Returns the last record count of each output.
+
+    rc optionally adds a range compression stage on the decompressed echoes
+    of each block, writing to oR[k]: a dictionary with either a fixed filter
+    spectrum 'H' or per-record 'TX_TEMP'/'RX_TEMP' arrays (with 'cal' and
+    'interp', see traceFilters), and 'power' (see rangeCompression).
+
+    stack optionally adds an along-track stacking stage writing to the
+    [science, ancillary, aux] files oK[k]: a dictionary with 'n' (traces
+    per stack) or 'distance' (km per stack, see stackKeys), 'power' (sum
+    power instead of amplitudes) and 'aux', the auxiliary file interpolated
+    onto the stacks (see openStack).  The range compressed traces are
+    stacked when rc is set, otherwise the decompressed echoes, and always
+    written as a SCI_EXT product.  Only the unfinished stack is carried
+    from one block to the next.
+
+    align optionally shifts the decompressed echoes of every record by
+    align['shift'] samples (see alignShifts) before any other stage; the
+    science product then holds decompressed float32 samples.
+
+    sci selects the science output (see openSci): 'raw', the default,
+    writes the legacy headerless int8 stream of decompressed samples,
+    saturated to the int8 range (see clipInt8), 'sherpa' a self-describing
+    SCI_EXT product carrying meta, the per-record scale factors and the
+    original record numbers.  With sciDtype 'int8' the product holds the
+    compressed samples and their scale, with 'float32' the decompressed
+    samples, with 'packed' the telemetry's own 4/6/8-bit packed bytes and
+    their scale.  Range compressed outputs use the same layout.
+
+    stats (see newStats) collects the time, records, bytes and memory of
+    the readRecords, decodeAncillary, unpackSamples, decompress,
+    rangeCompression, writeAncillary and writeScience stages.
+
+    With block set, depth blocks are read ahead of the decoder on a
+    background thread into reusable buffers (see readBlocks); depth 0
+    reads each block when it is needed.  With workers above 1 the blocks
+    are split into record-range shards decoded in a process pool (see
+    sepShard), except when stacking.  The outputs are the same either way.
+  """
+  #
+  # Record view over the science file; each block is read from it once and
+  # the ANCILLARY and SCIENCE columns are slices of the block, so nothing
+  # is copied to temporary files
+  #
+  recs = readRecords(iS, n)
+  masks = fitMask(masks, len(recs))
+  runs = maskRuns(masks.any(axis=0))
+  cnt = [int(m.sum()) - 1 for m in masks]
+  workers = workers if workers and workers > 1 and stack is None else None
+  if block:
+    block = int(block)
+  else:
+    block = -(-max(sum(e - s + 1 for s, e in runs), 1) // (SHARDS_PER_WORKER * workers)) if workers else max(len(recs), 1)
+  if align is not None and sci != 'raw':
+    sciDtype = 'float32'
+  with ExitStack() as exits:
+    scaled = sci == 'raw' or sciDtype == 'float32'
+    packed = b if sci != 'raw' and sciDtype == 'packed' else None
+    _s = [openSci(f, int(m.sum()), meta, dtype='float32' if sciDtype == 'float32' and sci != 'raw' else 'int8',
+                  scaled=scaled, fmt=sci, packed=packed)
+          for f, m in zip(oS, masks)]
+    for t in _s:
+      exits.callback(closeSci, t)
+    _a = [openTable(f, fmt, int(m.sum())) for f, m in zip(oA, masks)]
+    for t in _a:
+      exits.callback(closeTable, t)
+    _r = []
+    if rc is not None:
+      rcDtype = 'f4' if rc.get('power', False) else 'c8'
+      _r = [openSci(f, int(m.sum()), dict(meta, product='rc'), dtype=rcDtype, scaled=True, fmt=sci)
+            for f, m in zip(oR, masks)]
+      for t in _r:
+        exits.callback(closeSci, t)
+    _t = []
+    if stack is not None:
+      #
+      # Range compressed power is averaged as it is
+      #
+      powerIn = rc is not None and rc.get('power', False)
+      stDtype = 'f4' if rc is None or powerIn or stack.get('power', False) else 'c8'
+      keys = stackKeys(iS, n, stack)
+      _t = [openStack(f[0], f[1], f[2], keys, m, stack, recs, meta, stDtype, fmt,
+                      square=stack.get('power', False) and not powerIn)
+            for f, m in zip(oK, masks)]
+      for t in _t:
+        exits.callback(closeStack, t)
+    if workers:
+      sepShards(iS, n, b, p, runs, masks, block, _s, _a, _r, rc, sci, sciDtype, stats, depth, workers, align)
+    else:
+      blocks = readBlocks(iS, n, runs, block, depth, stats)
+      exits.callback(blocks.close)
+      for _i, r in blocks:
+        a, data, scale, rcData, echo = decodeBlock(r, _i, b, p, rc, sci, sciDtype, stats, echoes=len(_t) > 0,
+                                                    align=align)
+        index = np.arange(_i, _i+len(r))
+        #
+        # Save each selection's Ancillary table, indexed by the original
+        # record number, and its science samples with their scale factors
+        #
+        for _k in range(len(masks)):
+          sel = masks[_k, _i:_i+len(r)]
+          if not sel.any():
+            continue
+          with timeStage(stats, 'writeAncillary', int(sel.sum())):
+            appendTable(_a[_k], {key: a[key][sel] for key in a}, index[sel])
+          with timeStage(stats, 'writeScience', int(sel.sum())):
+            appendSci(_s[_k], data[sel], scale[sel], index[sel])
+            if rc is not None:
+              appendSci(_r[_k], rcData[sel], scale[sel], index[sel])
+          if len(_t):
+            with timeStage(stats, 'stack', int(sel.sum())):
+              appendStack(_t[_k], (rcData if rc is not None else echo)[sel], index[sel])
+  #
+  # Output sizes are only final once the files are closed
+  #
+  addBytes(stats, 'writeAncillary', [t['file'] for t in _a])
+  addBytes(stats, 'writeScience', [t['file'] for t in _s + _r])
+  addBytes(stats, 'stack', [t[key]['file'] for t in _t for key in ['sci', 'anc', 'aux']])
+  return cnt
+
+
+###############################################
+#
+# Intra-observation parallelism: the blocks of one observation are split
+# into record-range shards, each decoded by a worker process that writes
+# its science rows straight into the preallocated product files and
+# returns the (small) ancillary columns and scale factors, which are
+# appended in record order
+#
+###############################################
+#
+# Shards per worker process when no block size is given, for load balance
+#
+SHARDS_PER_WORKER = 2
+
+def shardRuns(runs, block, nshard):
+  """
+    Split the [start, stop] runs into at most nshard lists of runs with
+    about the same number of records.  Shards only break at the block
+    boundaries of a serial pass, so the blocks are the same either way.
+  """
+  blocks = [[_i, min(_i+block, e+1) - 1] for s, e in runs for _i in range(s, e+1, block)]
+  size = np.cumsum([e - s + 1 for s, e in blocks])
+  if len(blocks) == 0:
+    return []
+  cut = np.searchsorted(size, size[-1] * np.arange(1, nshard) / nshard, 'right')
+  shards = []
+  for part in np.split(np.arange(len(blocks)), np.unique(cut)):
+    if len(part) == 0:
+      continue
+    #
+    # Merge the blocks of a shard back into runs
+    #
+    out = []
+    for _j in part:
+      s, e = blocks[_j]
+      if len(out) and out[-1][1] + 1 == s:
+        out[-1][1] = e
+      else:
+        out.append([s, e])
+    shards.append(out)
+  return shards
+
+
+def sciTarget(t):
+  """
+    What a worker needs to write rows into an open science product
+  """
+  return {'file': t['file'], 'dtype': t['dtype'], 'packed': t['packed'], 'rowBytes': t['rowBytes'],
+          'offset': SCI_HDRLEN if t['fmt'] == 'sherpa' else 0}
+
+
+def sepShard(iS, n, b, p, runs, masks, i0, rows, block, sciOut, rcOut, rc=None, sci='raw', sciDtype='int8',
+             stats=False, depth=0, align=None):
+  """
+    Decode the shard of records in runs and write each selection's science
+    (and range compressed) rows into its product from output row rows[k].
+    masks holds the selections of records i0 onwards.  Returns, block by
+    block, each selection's ancillary columns, scale factors and record
+    numbers, plus the shard's stage statistics when stats is True.
+  """
+  stats = newStats() if stats else None
+  rows = list(rows)
+  out = []
+  for _i, r in readBlocks(iS, n, runs, block, depth, stats):
+    a, data, scale, rcData, _ = decodeBlock(r, _i, b, p, rc, sci, sciDtype, stats, align=align)
+    index = np.arange(_i, _i+len(r))
+    res = []
+    for _k in range(len(masks)):
+      sel = masks[_k, _i-i0:_i-i0+len(r)]
+      if not sel.any():
+        continue
+      m = int(sel.sum())
+      with timeStage(stats, 'writeScience', m):
+        for t, d in [(sciOut[_k], data)] + ([(rcOut[_k], rcData)] if rc is not None else []):
+          mm = np.memmap(t['file'], dtype='u1', mode='r+', offset=t['offset'] + rows[_k]*t['rowBytes'],
+                         shape=(m, t['rowBytes']))
+          mm[:] = sciRows(t, d[sel])
+          mm.flush()
+          del mm
+      res.append((_k, {key: a[key][sel] for key in a}, scale[sel], index[sel]))
+      rows[_k] += m
+    out.append(res)
+  return out, (stats['stages'] if stats else None)
+
+
+def mergeStats(stats, stages):
+  """
+    Add the stage statistics of a worker to stats; seconds are summed over
+    workers
+  """
+  if stats is None or stages is None:
+    return
+  for name, w in stages.items():
+    s = stats['stages'].setdefault(name, dict({key: 0 for key in STAGE_KEYS}, calls=0, seconds=0., peakMB=0.))
+    for key in STAGE_KEYS + ['calls', 'seconds']:
+      s[key] += w[key]
+    s['peakMB'] = max(s['peakMB'], w['peakMB'])
+
+
+def sepShards(iS, n, b, p, runs, masks, block, _s, _a, _r, rc, sci, sciDtype, stats, depth, workers, align=None):
+  """
+    Run sepShard over the shards of an observation in a pool of worker
+    processes.  The science products _s and _r are sized up front so the
+    workers can write their rows in place; the ancillary tables _a, scale
+    factors and record numbers are appended here in record order.
+  """
+  for t in _s + _r:
+    t['out'].flush()
+    t['out'].truncate(sciTarget(t)['offset'] + t['nrec'] * t['rowBytes'])
+  shards = shardRuns(runs, block, SHARDS_PER_WORKER * workers)
+  with timeStage(stats, 'shards', int(masks.any(axis=0).sum())):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      jobs = []
+      for shard in shards:
+        i0, i1 = shard[0][0], shard[-1][1] + 1
+        rows = masks[:, :i0].sum(axis=1)
+        jobs.append(pool.submit(sepShard, iS, n, b, p, shard, masks[:, i0:i1], i0, rows, block,
+                                [sciTarget(t) for t in _s], [sciTarget(t) for t in _r], rc, sci, sciDtype,
+                                stats is not None, depth, align))
+      for job in jobs:
+        out, stages = job.result()
+        mergeStats(stats, stages)
+        for res in out:
+          for _k, a, scale, index in res:
+            with timeStage(stats, 'writeAncillary', len(index)):
+              appendTable(_a[_k], a, index)
+            appendSci(_s[_k], None, scale, index)
+            if rc is not None:
+              appendSci(_r[_k], None, scale, index)
+  return
+
+def detPRF(val):
+  PRF = {'335': 335.12,
+         '350': 350.14,
+         '387': 387.60,
+         '670': 670.24,
+         '700': 700.28,
+         '775': 775.19,
+         }
+  return PRF[str(val)] 
+
+
+def getDecom(c, p, b, s):
+  """
+    This function decompresses the data based off page 8 of the
+    SHALLOW RADAR EXPERIMENT DATA RECORD SOFTWARE INTERFACE SPECIFICATION.
+    If the compression type is 'Static'
+       U = C* ( 2**S / N )
+         C is the Compressed Data
+         S = L - R + 8
+            L is base 2 log of N rounded UP to the nearest integer
+            R is the bit resolution of the compressed values
+         N is the number of pre-summed echoes
+    If the compression type is 'dynamic'
+      U = C*2**S/N
+        C is the compressed data
+        N is the number of pre-summed echoes
+        S = SDI for SDI <= 5
+        S = SDI-6 for 5 < SDI <= 16
+        S = SDI-16 for SDI > 16
+          where SDI is the SDI_BIT_FIELD parameter from ANCILLIARY DATA
+
+    c is OST_COMPRESSION_SELECTION (False static, True dynamic), either a
+    single value or one per record, and s the SDI_BIT_FIELD of each record.
+    A static-only selection returns the scalar scale factor; otherwise an
+    (nrec, 1) vector of per-record factors is returned, ready to broadcast
+    over the (nrec, 3600) echo matrix.
+  """
+  #
+  # Static scaling
+  #
+  N = p
+  L = np.ceil(np.log2(int(p)))
+  R = b
+  static = np.power(2, L - R + 8) / N
+  c = np.asarray(c, dtype=bool)
+  if not c.any():
+    return static
+  #
+  # Dynamic scaling, applied record by record where selected
+  #
+  SDI = np.asarray(s, dtype=int)
+  c = np.broadcast_to(c, SDI.shape)
+  S = np.select([SDI <= 5, SDI <= 16], [SDI, SDI - 6], SDI - 16)
+  return np.where(c, np.power(2., S) / N, static)[:, None]
+
+def formOut(lblFile, outDir):
+  oDirs = {'SCIENCE': outDir + '/SCIENCE/',
+           'ANCILLARY': outDir + '/ANCILLARY/',
+           'AUX': outDir + '/AUXILIARY/',
+           'LOGS': outDir + '/LOGS/',
+           'RC': outDir + '/RC/',
+           'STACK': outDir + '/STACK/',
+           'GEOMETRY': outDir + '/GEOMETRY/',
+          }
+  tmp = os.path.basename(lblFile).split('.')[0]
+  oFiles = {'SCIENCE': oDirs['SCIENCE'] + tmp + '.sci',
+            'ANCILLARY': oDirs['ANCILLARY'] + tmp +'.csv',
+            'AUX': oDirs['AUX'] + tmp + '.csv',
+            'LOG': oDirs['LOGS'] + tmp + '.log',
+            'RC': oDirs['RC'] + tmp + '.rc',
+            'STACK': oDirs['STACK'] + tmp + SCI_EXT,
+            'STACK_ANC': oDirs['STACK'] + tmp + '_anc.csv',
+            'STACK_AUX': oDirs['STACK'] + tmp + '_aux.csv',
+            'GEOMETRY': oDirs['GEOMETRY'] + tmp + '.csv',
+            'STATS': oDirs['LOGS'] + tmp + '.json',
+            'MANIFEST': outDir + '/' + MANIFEST,
+           }
+  return oDirs, oFiles
+
+def tagOut(oFiles, tag):
+  """
+    Data file names of oFiles with _<tag> appended, e.g. for one ROI of many
+  """
+  tFiles = {}
+  for key in ['SCIENCE', 'ANCILLARY', 'AUX', 'RC', 'STACK', 'STACK_ANC', 'STACK_AUX', 'GEOMETRY']:
+    root, ext = os.path.splitext(oFiles[key])
+    tFiles[key] = root + '_' + tag + ext
+  return tFiles
+
+def makeOut(outDir, oDirs):
+  #
+  # Make output directories; exist_ok keeps this safe when several
+  # processes share an output directory
+  #
+  if not os.path.isdir(outDir):
+    print('[WARNING] New output directory will be created at {}'.format(outDir))
+    os.makedirs(outDir, exist_ok=True)
+  #
+  # Check output subdirectories
+  #
+  for key in ['SCIENCE', 'ANCILLARY', 'AUX', 'LOGS']:
+    os.makedirs(oDirs[key], exist_ok=True)
+  return
+
+###############################################
+#
+# Output manifest: one JSON line per processed label in the output
+# directory, recording the inputs, ROI, options, version and outputs so
+# up-to-date observations can be skipped.  Lines are only appended once
+# an observation is finished, and the last line of a label wins, so
+# interrupted runs resume with the unfinished observations.
+#
+###############################################
+MANIFEST = 'manifest.jsonl'
+MANIFEST_OPTS = {'rc': None, 'chirp': None, 'cal': False, 'interp': False,
+                 'fmt': 'csv', 'sci': 'raw', 'sciDtype': 'int8',
+                 'stack': None, 'stackDistance': None, 'stackPower': False, 'align': False, 'alignRef': None,
+                 'geometry': False}
+
+def fileSignature(fname, hash=False):
+  """
+    Size and mtime of a file, plus its SHA-256 when hash is True
+  """
+  st = os.stat(fname)
+  sig = {'size': st.st_size, 'mtime': st.st_mtime}
+  if hash:
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+    sig['sha256'] = h.hexdigest()
+  return sig
+
+
+def manifestKey(roi, opts):
+  """
+    The ROI and output-affecting options of a run and the science product
+    version, as stored in the manifest (normalized through JSON so they
+    compare equal on reload)
+  """
+  opts = normOpts({key: opts.get(key, v) for key, v in MANIFEST_OPTS.items()})
+  return json.loads(json.dumps({'version': SHERPA_VERSION, 'roi': getROIs(roi), 'opts': opts,
+                                'sciVersion': SCI_VERSION if opts['sci'] == 'sherpa' else None}))
+
+
+def readManifest(fname):
+  """
+    Latest manifest entry of every label in fname, keyed by label path
+  """
+  entries = {}
+  if os.path.isfile(fname):
+    with open(fname) as f:
+      for line in f:
+        try:
+          e = json.loads(line)
+        except ValueError:
+          #
+          # A line cut short by an interrupted run
+          #
+          continue
+        entries[e['label']] = e
+  return entries
+
+
+def writeManifest(fname, iFiles, roi, opts, outputs, status='OK', hash=False):
+  """
+    Append the entry of a finished label; the single short write keeps
+    lines from concurrent batch workers intact
+  """
+  e = {'label': os.path.abspath(iFiles['LABEL']), 'status': status, 'time': datetime.now().isoformat(),
+       'inputs': {key: fileSignature(iFiles[key], hash) for key in ['LABEL', 'SCIENCE', 'AUX']},
+       'outputs': {os.path.abspath(f): os.path.getsize(f) for f in outputs if os.path.isfile(f)}}
+  e.update(manifestKey(roi, opts))
+  with open(fname, 'a') as f:
+    f.write(json.dumps(e) + '\n')
+  return e
+
+
+def upToDate(lblFile, fname, roi, opts={}, hash=False, entries=None):
+  """
+    True when the manifest fname holds an entry for lblFile with the same
+    version, ROI and options, unchanged inputs (size and mtime, or size
+    and SHA-256 with hash True) and all its outputs present with their
+    recorded sizes.  entries may pass an already read manifest.  A label
+    whose data files are missing is not up to date.
+  """
+  entries = readManifest(fname) if entries is None else entries
+  e = entries.get(os.path.abspath(lblFile))
+  if e is None:
+    return False
+  key = manifestKey(roi, opts)
+  if any(e.get(k) != key[k] for k in key):
+    return False
+  try:
+    iFiles = findFiles(lblFile)
+  except FileNotFoundError:
+    return False
+  for k, sig in e['inputs'].items():
+    if not os.path.isfile(iFiles[k]):
+      return False
+    new = fileSignature(iFiles[k], hash and 'sha256' in sig)
+    check = ['size', 'sha256'] if 'sha256' in new else ['size', 'mtime']
+    if any(new[c] != sig.get(c) for c in check):
+      return False
+  return all(os.path.isfile(f) and os.path.getsize(f) == size for f, size in e['outputs'].items())
+
+def roiMasks(lons, lats, rois):
+  """
+    Test every record against every ROI = [minLat, minLon, maxLat, maxLon]
+    at once, returning an (nroi, nrec) boolean array.  Longitudes are
+    compared modulo 360, so an ROI such as [.., 350, .., 10] or
+    [.., -10, .., 10] crosses the 0/360 seam.
+  """
+  rois = np.asarray(rois, dtype=float).reshape(-1, 4)
+  lons = np.mod(np.asarray(lons, dtype=float), 360)[None, :]
+  lats = np.asarray(lats, dtype=float)[None, :]
+  minLat, minLon, maxLat, maxLon = [rois[:, _j][:, None] for _j in range(4)]
+  inLat = np.logical_and(lats >= minLat, lats <= maxLat)
+  lo = np.mod(minLon, 360)
+  hi = np.mod(maxLon, 360)
+  inLon = np.where(lo <= hi,
+                   np.logical_and(lons >= lo, lons <= hi),
+                   np.logical_or(lons >= lo, lons <= hi))
+  inLon = np.logical_or(inLon, maxLon - minLon >= 360)
+  return np.logical_and(inLat, inLon)
+
+
+def roiMask(lons, lats, roi):
+  """
+    Boolean mask of the records inside a single ROI (see roiMasks)
+  """
+  return roiMasks(lons, lats, [roi])[0]
+
+
+def getROIs(roi):
+  """
+    Normalise an ROI argument to a list of [minLat, minLon, maxLat, maxLon]
+    boxes: [None]*4 gives an empty list, a single box a list of one and a
+    string is read as an ROI file
+  """
+  if isinstance(roi, str):
+    return readROIs(roi)
+  if roi is None or np.size(roi) == 0 or roi == [None,None,None,None]:
+    return []
+  if np.ndim(roi) == 1:
+    return [list(roi)]
+  return [list(r) for r in roi]
+
+
+def normROI(roi):
+  """
+    The ROI argument in the form the pipeline passes around: [None]*4 for
+    no ROI, a single box, or a list of boxes (see getROIs)
+  """
+  rois = getROIs(roi)
+  return [None,None,None,None] if len(rois) == 0 else rois[0] if len(rois) == 1 else rois
+
+
+def normOpts(opts):
+  """
+    The options as the stages run them: aligned traces are decompressed,
+    so a 'sherpa' product of them is float32, and stacking carries partial
+    stacks from block to block, so it decodes serially (see
+    sepSAdataROIs).  normWarnings lists what was changed.
+  """
+  if opts.get('align') and opts.get('sci', 'raw') != 'raw':
+    opts = dict(opts, sciDtype='float32')
+  if (opts.get('workers') or 0) > 1 and (opts.get('stack') is not None or opts.get('stackDistance') is not None):
+    opts = dict(opts, workers=None)
+  return opts
+
+
+def normWarnings(given, opts):
+  """
+    Warnings for the options normOpts changed from those given
+  """
+  warn = []
+  if opts.get('sciDtype') != given.get('sciDtype'):
+    warn.append('Aligned traces are decompressed, storing them as {} instead of {}'.format(opts['sciDtype'], given['sciDtype']))
+  if opts.get('workers') != given.get('workers'):
+    warn.append('Stacking carries partial stacks from block to block, decoding serially instead of on {} worker processes'.format(given['workers']))
+  return warn
+
+
+def readROIs(fname):
+  """
+    Read ROIs from a text file with one 'minLat minLon maxLat maxLon' box
+    per line (whitespace or comma separated, '#' starts a comment)
+  """
+  rois = []
+  with open(fname) as f:
+    for line in f:
+      line = line.split('#')[0].replace(',', ' ').split()
+      if len(line) == 0:
+        continue
+      if len(line) != 4:
+        raise ValueError('ROI lines need 4 values, got: {}'.format(' '.join(line)))
+      rois.append([float(v) for v in line])
+  return rois
+
+
+def detRuns(lons, lats, roi, gap=0):
+  """
+    Return the contiguous [start, stop] record runs (inclusive) inside the
+    ROI.  Runs separated by no more than gap records are merged.
+  """
+  return maskRuns(roiMask(lons, lats, roi), gap=gap)
+
+
+def maskRuns(mask, gap=0):
+  """
+    Convert a boolean record mask into a list of inclusive [start, stop] runs
+  """
+  d = np.diff(np.concatenate(([0], np.asarray(mask).astype('i1'), [0])))
+  starts = np.flatnonzero(d == 1)
+  stops = np.flatnonzero(d == -1) - 1
+  if len(starts) > 1:
+    keep = (starts[1:] - stops[:-1] - 1) > gap
+    starts = starts[np.concatenate(([True], keep))]
+    stops = stops[np.concatenate((keep, [True]))]
+  return [[int(s), int(e)] for s, e in zip(starts, stops)]
+
+
+def toRuns(idx, nrec):
+  """
+    Normalise a record selection to a list of [start, stop] runs
+  """
+  if idx == [None, None]:
+    return [[0, nrec-1]] if nrec else []
+  if np.ndim(idx) == 1:
+    return [[int(idx[0]), int(idx[1])]]
+  return [[int(s), int(e)] for s, e in idx]
+
+
+def runIndex(runs):
+  """
+    Original record numbers of every record in a list of runs
+  """
+  if len(runs) == 0:
+    return np.zeros(0, dtype=int)
+  return np.concatenate([np.arange(s, e+1) for s, e in runs])
+
+
+def runMask(runs, nrec):
+  """
+    Boolean record mask for a list of runs
+  """
+  mask = np.zeros(nrec, dtype=bool)
+  for s, e in runs:
+    mask[s:e+1] = True
+  return mask
+
+
+def fitMask(masks, nrec):
+  """
+    Pad or truncate (nsel, n) record masks to nrec records
+  """
+  masks = np.atleast_2d(np.asarray(masks, dtype=bool))
+  out = np.zeros((masks.shape[0], nrec), dtype=bool)
+  m = min(nrec, masks.shape[1])
+  out[:, :m] = masks[:, :m]
+  return out
+
+
+def takeRuns(recs, runs):
+  """
+    Gather the records of each run from a record array or memmap
+  """
+  if len(runs) == 1:
+    return recs[runs[0][0]:runs[0][1]+1]
+  return np.concatenate([recs[s:e+1] for s, e in runs])
+
+
+def detIDX(lons, lats, roi):
+  idx = np.flatnonzero(roiMask(lons, lats, roi))
+  if len(idx) == 0:
+    return -1, -1
+  return idx.min(), idx.max()
+
+
+###############################################
+#
+# Science echo layouts (see format/science4bit.fmt, science6bit.fmt
+# and science8bit.fmt): 3600 MSB-first signed samples per record
+#
+###############################################
+NSAMP = 3600
+SCI_BYTES = {4: 1800, 6: 2700, 8: 3600}
+
+
+def unpackSamples(buf, b, n=NSAMP):
+  """
+    Unpack MSB-first signed b-bit samples (b = 4, 6 or 8) into an
+    (nrec, n) int8 array using only array operations.  buf may be bytes,
+    a 1-D uint8 array or a 2-D (nrec, nbytes) uint8 array such as a
+    memmap slice.
+  """
+  nbytes = n * b // 8
+  if isinstance(buf, (bytes, bytearray, memoryview)):
+    buf = np.frombuffer(buf, dtype='u1')
+  if buf.ndim == 1:
+    buf = buf[:len(buf) - len(buf) % nbytes].reshape(-1, nbytes)
+  buf = buf[:, :nbytes]
+  nrec = buf.shape[0]
+  if b == 8:
+    return buf.view('i1')
+  elif b == 4:
+    #
+    # Two samples per byte; arithmetic shifts on int8 sign extend
+    #
+    s = buf.view('i1')
+    out = np.empty((nrec, nbytes, 2), dtype='i1')
+    out[:, :, 0] = s >> 4
+    out[:, :, 1] = (s << 4) >> 4
+    return out.reshape(nrec, n)
+  elif b == 6:
+    #
+    # Four samples per 3-byte group.  The three bytes of every group are
+    # first gathered into contiguous planes, so the shifts below run on
+    # contiguous arrays rather than stride-3 views
+    #
+    b0, b1, b2 = np.ascontiguousarray(buf.reshape(-1, 3).T).view('i1')
+    out = np.empty((len(b0), 4), dtype='i1')
+    #
+    # Move each sample's high bits to the top of an int8 and shift back
+    # down arithmetically to sign extend, then OR in the low bits taken
+    # from the following byte
+    #
+    out[:, 0] = b0 >> 2
+    out[:, 1] = ((b0 << 6) >> 2) | (b1.view('u1') >> 4).view('i1')
+    out[:, 2] = ((b1 << 4) >> 2) | (b2.view('u1') >> 6).view('i1')
+    out[:, 3] = (b2 << 2) >> 2
+    return out.reshape(nrec, n)
+  raise ValueError('Unsupported bits per sample: {}'.format(b))
+
+
+def loadSamples(f, b, n=NSAMP, mmap=False):
+  """
+    Load a file of packed science records as an (nrec, n) int8 array
+  """
+  nbytes = n * b // 8
+  nrec = int(os.path.getsize(f) / nbytes)
+  if mmap:
+    buf = np.memmap(f, dtype='u1', mode='r', shape=(nrec, nbytes))
+  else:
+    buf = np.fromfile(f, dtype='u1', count=nrec*nbytes).reshape(nrec, nbytes)
+  return unpackSamples(buf, b, n)
+
+
+def load6bit(f, n):
+  return loadSamples(f, 6, n).ravel()
+
+
+###############################################
+#
+# Science product: a 4096-byte JSON header followed by the (nrec, nsamp)
+# sample array, the per-record scale factors (float64) and the original
+# record numbers (int64).  Packed products keep the 4/6-bit telemetry
+# packing, (nrec, nsamp*bits/8) bytes, and are unpacked on read
+#
+###############################################
+SCI_MAGIC = b'SHERPA01'
+SCI_HDRLEN = 4096
+SCI_VERSION = 1
+#
+# Extension of the self-describing products, so they are never mistaken
+# for the legacy headerless .sci (and .rc) streams
+#
+SCI_EXT = '.sherpa'
+SCI_FORMATS = ['sherpa', 'raw']
+SCI_DTYPES = ['int8', 'float32', 'packed']
+SCI_CHUNK = 64
+
+
+def sciName(oFile, fmt):
+  """
+    File name of a science product: oFile itself for 'raw', with the
+    SCI_EXT extension for 'sherpa'
+  """
+  return oFile if fmt == 'raw' else os.path.splitext(oFile)[0] + SCI_EXT
+
+
+def openSci(oFile, nrec, meta={}, dtype='int8', scaled=False, n=NSAMP, fmt='sherpa', packed=None):
+  """
+    Start a science product of nrec records written in blocks with
+    appendSci and finished with closeSci.  meta (mode, presum, bits, ...)
+    is stored in the header.  scaled says whether the samples are already
+    decompressed; otherwise readers multiply them by the record's scale.
+    packed (4, 6 or 8) stores the samples as telemetry packed bytes of
+    that many bits per sample; appendSci then takes the packed bytes.
+    fmt 'raw' writes the legacy headerless sample stream instead.  The
+    extension of oFile is replaced to match fmt (see sciName).
+  """
+  if fmt not in SCI_FORMATS:
+    raise ValueError('Unknown science format {}, expected one of {}'.format(fmt, ', '.join(SCI_FORMATS)))
+  dtype = np.dtype('int8' if packed else dtype)
+  t = {'file': sciName(oFile, fmt), 'fmt': fmt, 'nrec': int(nrec), 'nsamp': n, 'dtype': dtype.str, 'packed': packed,
+       'rowBytes': n * packed // 8 if packed else n * dtype.itemsize,
+       'scaled': scaled, 'meta': dict(meta), 'row': 0, 'scale': [], 'record': []}
+  t['out'] = open(t['file'], 'wb')
+  if fmt == 'sherpa':
+    t['out'].write(bytes(SCI_HDRLEN))
+  return t
+
+
+def appendSci(t, data, scale, index):
+  """
+    Append a block of (n, nsamp) samples, or (n, rowBytes) packed bytes,
+    with their scale factors (a scalar or one per record) and original
+    record numbers.  data None skips over rows already written in place
+    (see sepShard).
+  """
+  if data is None:
+    t['out'].seek(len(index) * t['rowBytes'], 1)
+  else:
+    sciRows(t, data).tofile(t['out'])
+  if t['fmt'] == 'sherpa':
+    t['scale'].append(np.broadcast_to(np.asarray(scale, dtype='f8').ravel(), (len(index),)))
+    t['record'].append(np.asarray(index, dtype='i8'))
+  t['row'] += len(index)
+  return t
+
+
+def sciRows(t, data):
+  """
+    A block of samples as the (n, rowBytes) bytes stored in product t
+  """
+  data = np.ascontiguousarray(data, dtype='u1' if t['packed'] else t['dtype'])
+  return data.view('u1').reshape(len(data), t['rowBytes'])
+
+
+def closeSci(t):
+  if t['fmt'] == 'sherpa':
+    scale = np.concatenate(t['scale']) if len(t['scale']) else np.zeros(0)
+    record = np.concatenate(t['record']) if len(t['record']) else np.zeros(0, dtype='i8')
+    hdr = dict(t['meta'])
+    hdr.update({'version': SCI_VERSION, 'nrec': t['row'], 'nsamp': t['nsamp'], 'dtype': t['dtype'], 'scaled': t['scaled'],
+                'packed': t['packed'], 'rowBytes': t['rowBytes'],
+                'scale': float(scale[0]) if len(scale) and (scale == scale[0]).all() else None,
+                'records': [int(record[0]), int(record[-1])] if len(record) else [None, None],
+                'dataOffset': SCI_HDRLEN,
+                'scaleOffset': SCI_HDRLEN + t['row'] * t['rowBytes']})
+    hdr['recordOffset'] = hdr['scaleOffset'] + 8 * t['row']
+    scale.astype('<f8').tofile(t['out'])
+    record.astype('<i8').tofile(t['out'])
+    hdr = SCI_MAGIC + json.dumps(hdr).encode('utf-8')
+    if len(hdr) > SCI_HDRLEN:
+      raise ValueError('Science product header is larger than {} bytes'.format(SCI_HDRLEN))
+    t['out'].seek(0)
+    t['out'].write(hdr.ljust(SCI_HDRLEN, b' '))
+  t['out'].close()
+  return t['file']
+
+
+def readSciHeader(fname):
+  with open(fname, 'rb') as f:
+    hdr = f.read(SCI_HDRLEN)
+  if hdr[:len(SCI_MAGIC)] != SCI_MAGIC:
+    raise ValueError('{} is not a SHERPA science product'.format(fname))
+  return json.loads(hdr[len(SCI_MAGIC):].decode('utf-8'))
+
+
+def readSci(fname, start=0, stop=None, scaled=False):
+  """
+    Memory map a science product and return the records start..stop-1 as a
+    zero-copy (n, nsamp) view, together with the header in which 'SCALE'
+    and 'RECORD' hold the scale factors and original record numbers of
+    those records.  With scaled True the samples are returned decompressed
+    as float32, which copies only the requested slice.  Packed products
+    are unpacked in one pass, or unpacked and scaled SCI_CHUNK records at
+    a time into the output; unlike int8 products they are never zero-copy.
+  """
+  hdr = readSciHeader(fname)
+  nrec, n = hdr['nrec'], hdr['nsamp']
+  packed, rowBytes = hdr.get('packed'), hdr.get('rowBytes', n * np.dtype(hdr['dtype']).itemsize)
+  start, stop, _ = slice(start, stop).indices(nrec)
+  stop = max(start, stop)
+  shape = (stop - start,)
+  if stop > start:
+    data = np.memmap(fname, dtype='u1' if packed else hdr['dtype'], mode='r', offset=hdr['dataOffset'] + start*rowBytes,
+                     shape=(stop-start, rowBytes if packed else n))
+    hdr['SCALE'] = np.memmap(fname, dtype='<f8', mode='r', offset=hdr['scaleOffset'] + 8*start, shape=shape)
+    hdr['RECORD'] = np.memmap(fname, dtype='<i8', mode='r', offset=hdr['recordOffset'] + 8*start, shape=shape)
+  else:
+    data = np.zeros((0, n), dtype=hdr['dtype'])
+    hdr['SCALE'] = np.zeros(0)
+    hdr['RECORD'] = np.zeros(0, dtype='i8')
+  scaled = scaled and not hdr['scaled']
+  if packed and scaled:
+    raw = data
+    data = np.empty((len(raw), n), dtype='f4')
+    #
+    # int8 samples times scales that are exact in float32 round once
+    # either way, so the product is formed in float32 directly
+    #
+    scale = hdr['SCALE'].astype('f4')
+    if not np.array_equal(scale, hdr['SCALE']):
+      scale = hdr['SCALE']
+    for _i in range(0, len(raw), SCI_CHUNK):
+      np.multiply(unpackSamples(raw[_i:_i+SCI_CHUNK], packed, n), scale[_i:_i+SCI_CHUNK, None],
+                  out=data[_i:_i+SCI_CHUNK], casting='unsafe')
+  elif packed:
+    data = unpackSamples(data, packed, n)
+  elif scaled:
+    data = (data * hdr['SCALE'][:, None]).astype('f4')
+  return data, hdr
+
+
+###############################################
+#
+# Range compression
+#
+###############################################
+CAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calib')
+NFFT = 4096
+NCHIRP = 2048
+
+
+def chirpName(tx, rx):
+  """
+    File name of the reference chirp for transmitter and receiver
+    temperature bins given in degrees C, e.g. (-5, 20) -> m05tx_p20rx
+  """
+  fmt = lambda t: '{}{:02d}'.format('m' if t < 0 else 'p', abs(int(t)))
+  return 'reference_chirp_{}tx_{}rx.dat'.format(fmt(tx), fmt(rx))
+
+
+def loadChirp(tx, rx, calDir=CAL_DIR):
+  """
+    Load a reference chirp spectrum.  The files hold 2048 real values
+    followed by 2048 imaginary values covering 0 to fs/2 of a 4096-point
+    transform of the 3600-sample echo.
+  """
+  c = np.fromfile(os.path.join(calDir, chirpName(tx, rx)), dtype='<f4')
+  return (c[:NCHIRP] + 1j * c[NCHIRP:]).astype('c8')
+
+
+def loadCalFilter(calDir=CAL_DIR):
+  """
+    Load cal_filter.dat, a real two-sided weighting of the 3600-point echo
+    spectrum
+  """
+  return np.fromfile(os.path.join(calDir, 'cal_filter.dat'), dtype='<f4')
+
+
+def chirpFilter(chirp, cal=None, n=NSAMP, nfft=NFFT):
+  """
+    Precompute the matched filter spectrum for a reference chirp: its
+    complex conjugate, optionally weighted by cal_filter.dat resampled from
+    the n-point onto the nfft-point frequency grid
+  """
+  H = np.conj(chirp)
+  if cal is not None:
+    w = np.interp(np.arange(len(H)) / nfft, np.arange(n//2 + 1) / n, cal[:n//2 + 1])
+    H = H * w
+  return H.astype('c8')
+
+
+CHIRP_CACHE = 32
+
+
+@lru_cache(maxsize=None)
+def chirpIndex(calDir=CAL_DIR):
+  """
+    Index of the reference chirp temperature bins available in calDir,
+    built once: returns the sorted TX and RX bins in degrees C
+  """
+  tx = set()
+  rx = set()
+  for f in glob.glob(os.path.join(calDir, 'reference_chirp_*tx_*rx.dat')):
+    t, r = os.path.basename(f)[len('reference_chirp_'):-len('rx.dat')].split('tx_')
+    tx.add(int(t[1:]) * (-1 if t[0] == 'm' else 1))
+    rx.add(int(r[1:]) * (-1 if r[0] == 'm' else 1))
+  return np.array(sorted(tx)), np.array(sorted(rx))
+
+
+@lru_cache(maxsize=None)
+def calFilter(calDir=CAL_DIR):
+  return loadCalFilter(calDir)
+
+
+@lru_cache(maxsize=CHIRP_CACHE)
+def chirpSpectrum(tx, rx, cal=False, calDir=CAL_DIR):
+  """
+    Matched filter spectrum for one TX/RX temperature bin, loaded lazily and
+    kept in an LRU cache so repeated observations reuse it
+  """
+  H = chirpFilter(loadChirp(tx, rx, calDir), calFilter(calDir) if cal else None)
+  H.setflags(write=False)
+  return H
+
+
+def tempBins(temp, bins, interp=False):
+  """
+    Vectorized binning of temperatures onto the chirp bins.  Returns the
+    lower and upper bin indices and the weight of the upper bin; with
+    interp False the nearest bin is used for both.
+  """
+  temp = np.clip(np.asarray(temp, dtype=float), bins[0], bins[-1])
+  hi = np.clip(np.searchsorted(bins, temp), 1, len(bins)-1)
+  lo = hi - 1
+  w = (temp - bins[lo]) / (bins[hi] - bins[lo])
+  if not interp:
+    lo = np.where(w < 0.5, lo, hi)
+    return lo, lo, np.zeros(len(temp))
+  return lo, hi, w
+
+
+def traceFilters(txTemp, rxTemp, cal=False, interp=False, calDir=CAL_DIR):
+  """
+    Matched filters of a block of traces from the aux TX_TEMP and RX_TEMP
+    of each trace: the nearest TX/RX chirp, or with interp the bilinear
+    interpolation of the four surrounding chirps.  Returns the (2048,)
+    spectrum itself when every trace uses the same chirp, otherwise a list
+    of (rows, weights, spectrum) terms, one per distinct chirp and
+    interpolation corner, with weights None where they are all 1 (see
+    applyFilters).  Each distinct chirp is fetched from the cache once per
+    call and the per-trace filters are never formed.
+  """
+  txBins, rxBins = chirpIndex(calDir)
+  t0, t1, tw = tempBins(txTemp, txBins, interp)
+  r0, r1, rw = tempBins(rxTemp, rxBins, interp)
+  terms = []
+  for ti, ri, w in [(t0, r0, (1-tw)*(1-rw)), (t1, r0, tw*(1-rw)),
+                    (t0, r1, (1-tw)*rw), (t1, r1, tw*rw)]:
+    if not w.any():
+      continue
+    pair = ti * len(rxBins) + ri
+    ids, inv = np.unique(pair, return_inverse=True)
+    for _k, _j in enumerate(ids):
+      rows = np.flatnonzero((inv == _k) & (w != 0))
+      if len(rows) == 0:
+        continue
+      H = chirpSpectrum(int(txBins[_j // len(rxBins)]), int(rxBins[_j % len(rxBins)]), cal, calDir)
+      terms.append((rows, None if np.all(w[rows] == 1) else w[rows].astype('f4'), H))
+  if len(terms) == 1 and terms[0][1] is None and len(terms[0][0]) == len(tw):
+    return terms[0][2]
+  return terms
+
+
+def applyFilters(spec, H):
+  """
+    Multiply echo spectra by a filter spectrum, an (nrec, 2048) array of
+    them, or the (rows, weights, spectrum) terms of traceFilters, each
+    applied to its rows by broadcasting
+  """
+  if isinstance(H, np.ndarray):
+    return spec * H
+  out = np.zeros(spec.shape, dtype=np.result_type(spec, np.complex64))
+  for rows, w, Hc in H:
+    term = spec[rows] * Hc
+    if w is not None:
+      term *= w[:, None]
+    out[rows] += term
+  return out
+
+
+def blockFilter(rc, i0, i1):
+  """
+    Filter spectrum for records i0..i1-1 of a range compression stage: the
+    fixed 'H' if given, otherwise per-trace chirps from its TX_TEMP/RX_TEMP,
+    one per science record
+  """
+  if rc.get('H') is not None:
+    return rc['H']
+  return traceFilters(rc['TX_TEMP'][i0:i1], rc['RX_TEMP'][i0:i1],
+                      cal=rc.get('cal', False), interp=rc.get('interp', False))
+
+
+def echoSpectrum(data, nfft=NFFT):
+  """
+    Batched real FFT of an (nrec, 3600) echo matrix zero padded to nfft,
+    keeping the bins covered by the reference chirps.  The result can be
+    reused for matched filtering against any number of chirp spectra.
+  """
+  return np.fft.rfft(np.asarray(data, dtype='f4'), n=nfft, axis=1)[:, :NCHIRP]
+
+
+def rangeCompression(data, H, n=NSAMP, nfft=NFFT, power=False, spec=None):
+  """
+    Matched filter a block of echoes against the reference chirp in the
+    frequency domain.  H is one (2048,) filter spectrum from chirpFilter
+    for the whole block, an (nrec, 2048) array with one per trace, or the
+    per-trace terms of traceFilters.  Pass spec from echoSpectrum to reuse
+    an existing transform.  Returns the complex (analytic) range
+    compressed traces as an (nrec, n) complex64 array, or their power as
+    float32 when power is True.
+  """
+  if spec is None:
+    spec = echoSpectrum(data, nfft)
+  #
+  # Only positive frequencies are kept, so the inverse transform is the
+  # analytic signal; the factor 2 restores the real signal's amplitude
+  #
+  rc = np.fft.ifft(applyFilters(spec, H), n=nfft, axis=1)[:, :n] * 2
+  if power:
+    return (rc.real**2 + rc.imag**2).astype('f4')
+  return rc.astype('c8') 
+
+
+###############################################
+#
+# Trace geometry: the auxiliary geometry interpolated onto the SCET of
+# every science record, so ROI cuts and maps no longer rely on the aux
+# and science records lining up index for index
+#
+###############################################
+GEO_COLUMNS = ['EPHEMERIS_TIME',
+               'X_MARS_SC_POSITION_VECTOR', 'Y_MARS_SC_POSITION_VECTOR', 'Z_MARS_SC_POSITION_VECTOR',
+               'SPACECRAFT_ALTITUDE', 'SUB_SC_EAST_LONGITUDE',
+               'SUB_SC_PLANETOCENTRIC_LATITUDE', 'SUB_SC_PLANETOGRAPHIC_LATITUDE',
+               'X_MARS_SC_VELOCITY_VECTOR', 'Y_MARS_SC_VELOCITY_VECTOR', 'Z_MARS_SC_VELOCITY_VECTOR',
+               'MARS_SC_RADIAL_VELOCITY', 'MARS_SC_TANGENTIAL_VELOCITY', 'SOLAR_ZENITH_ANGLE',
+               'SC_PITCH_ANGLE', 'SC_YAW_ANGLE', 'SC_ROLL_ANGLE']
+#
+# Angles interpolated modulo 360 degrees, with the lower end of the range
+# their values are returned in
+#
+GEO_ANGLES = {'SUB_SC_EAST_LONGITUDE': 0., 'SC_PITCH_ANGLE': -180., 'SC_YAW_ANGLE': -180., 'SC_ROLL_ANGLE': -180.}
+
+def scetSeconds(whole, frac):
+  """
+    SCET_BLOCK_WHOLE/SCET_BLOCK_FRAC (2^-16 s) pairs as float seconds
+  """
+  return whole.astype('f8') + frac.astype('f8') / 65536.
+
+
+def interpWeights(t, tq):
+  """
+    Indices i and weights w with tq = t[i] + w * (t[i+1] - t[i]) for
+    increasing t, from one searchsorted.  w is clipped to [0, 1], so
+    times outside t take the values at its ends.
+  """
+  i = np.clip(np.searchsorted(t, tq, 'right') - 1, 0, max(len(t) - 2, 0))
+  if len(t) < 2:
+    return i, np.zeros(len(tq))
+  dt = t[i+1] - t[i]
+  return i, np.clip((tq - t[i]) / np.where(dt > 0, dt, 1.), 0., 1.)
+
+
+def interpColumn(y, i, w, wrap=None):
+  """
+    Interpolate y at the weights of interpWeights.  With wrap, y is an
+    angle in degrees unwrapped before interpolating and returned in
+    [wrap, wrap + 360).
+  """
+  if len(y) < 2:
+    return np.full(len(i), y[0] if len(y) else np.nan)
+  if wrap is not None:
+    y = np.unwrap(y, period=360.)
+  v = y[i] + w * (y[i+1] - y[i])
+  if wrap is not None:
+    v = wrap + np.mod(v - wrap, 360.)
+  return v
+
+
+def traceTimes(iS, n):
+  """
+    SCET in seconds of every record of science file iS; only the SCET
+    columns are read
+  """
+  r = recordView(readRecords(iS, n), ANC_DTYPE)
+  return scetSeconds(toNative(r['SCET_BLOCK_WHOLE']), toNative(r['SCET_BLOCK_FRAC']))
+
+
+def auxTimes(recs):
+  """
+    Sorted SCET in seconds of the auxiliary records, with repeats dropped,
+    and the record number of each
+  """
+  return np.unique(scetSeconds(toNative(recs['SCET_BLOCK_WHOLE']), toNative(recs['SCET_BLOCK_FRAC'])),
+                   return_index=True)
+
+
+def interpAux(recs, times, tq, t0=None):
+  """
+    Auxiliary records decoded at the SCET times tq (see decodeAux), with
+    times those of auxTimes(recs): float columns are interpolated linearly,
+    the angles of GEO_ANGLES across their seams, and the other columns are
+    taken from the nearest record
+  """
+  t, keep = times
+  i, w = interpWeights(t, tq)
+  x0 = decodeAux(recs[keep[i]], t0=t0)
+  x1 = decodeAux(recs[keep[np.minimum(i + 1, len(t) - 1)]], t0=t0)
+  x = {}
+  for key in x0:
+    if x0[key].dtype.kind != 'f':
+      x[key] = np.where(w < 0.5, x0[key], x1[key])
+      continue
+    d = x1[key] - x0[key]
+    if key in GEO_ANGLES:
+      d = np.mod(d + 180., 360.) - 180.
+      x[key] = GEO_ANGLES[key] + np.mod(x0[key] + w * d - GEO_ANGLES[key], 360.)
+    else:
+      x[key] = x0[key] + w * d
+    x[key] = x[key].astype(x0[key].dtype)
+  return x
+
+
+def joinGeometry(auxFile, iS, n, columns=GEO_COLUMNS):
+  """
+    Geometry of every trace of science file iS: the auxiliary columns
+    interpolated linearly in SCET onto the ancillary SCET of each record,
+    with longitudes and attitude angles interpolated across the 0/360 and
+    +/-180 seams.  Returns a dictionary of per-trace columns: SCET, the
+    interpolated columns and AUX_OUTSIDE, True for traces outside the
+    auxiliary time span, whose geometry is that of the nearest aux record.
+  """
+  recs = readAux(auxFile, mmap=True)
+  if len(recs) == 0:
+    raise ValueError('No auxiliary records in {}'.format(auxFile))
+  t, keep = auxTimes(recs)
+  tq = traceTimes(iS, n)
+  i, w = interpWeights(t, tq)
+  g = {'SCET': tq}
+  for key in columns:
+    g[key] = interpColumn(toNative(recs[key])[keep].astype('f8'), i, w, GEO_ANGLES.get(key))
+  g['AUX_OUTSIDE'] = (tq < t[0]) | (tq > t[-1])
+  return g
+
+
+def geometryMasks(geo, rois):
+  """
+    (nroi, ntrace) ROI masks of the traces from their joined geometry
+  """
+  return roiMasks(geo['SUB_SC_EAST_LONGITUDE'], geo['SUB_SC_PLANETOCENTRIC_LATITUDE'], rois)
+
+
+def geometryAuxMasks(auxFile, geo, masks):
+  """
+    (nsel, naux) masks of the aux records spanning the SCET of each run of
+    traces in the (nsel, ntrace) masks: from the aux record at or before
+    the first trace of a run to the one at or after its last, found with
+    searchsorted on the aux times as in joinGeometry
+  """
+  recs = readAux(auxFile, mmap=True)
+  t = scetSeconds(toNative(recs['SCET_BLOCK_WHOLE']), toNative(recs['SCET_BLOCK_FRAC']))
+  out = np.zeros((len(masks), len(t)), dtype=bool)
+  for _k, m in enumerate(masks):
+    runs = np.array(maskRuns(m), dtype=int).reshape(-1, 2)
+    if len(runs) == 0 or len(t) == 0:
+      continue
+    s = np.clip(np.searchsorted(t, geo['SCET'][runs[:, 0]], 'right') - 1, 0, len(t) - 1)
+    e = np.clip(np.searchsorted(t, geo['SCET'][runs[:, 1]], 'left'), 0, len(t) - 1)
+    out[_k] = runMask(zip(s, e), len(t))
+  return out
+
+
+def writeGeometry(geo, oFile, fmt='csv', mask=None):
+  """
+    Save the per-trace geometry of the traces in mask (all by default),
+    indexed by record number
+  """
+  index = np.arange(len(geo['SCET'])) if mask is None else np.flatnonzero(mask)
+  return writeTable({key: geo[key][index] for key in geo}, oFile, fmt, index=index)
+
+
+###############################################
+#
+# Receive window alignment: every trace is shifted to a common two-way
+# travel time reference using its RECEIVE_WINDOW_OPENING_TIME, in ADC
+# samples of 0.0375 microseconds
+#
+###############################################
+def alignShifts(iS, n, ref=None):
+  """
+    Shift in samples that moves each record of science file iS from its
+    receive window opening time to the reference opening time ref, by
+    default the earliest of the file, so that no trace is shifted up.
+    Only the RECEIVE_WINDOW_OPENING_TIME column is read.
+  """
+  r = recordView(readRecords(iS, n), ANC_DTYPE)
+  rwot = toNative(r['RECEIVE_WINDOW_OPENING_TIME']).astype('f8')
+  if ref is None:
+    ref = rwot.min() if len(rwot) else 0.
+  return rwot - ref, float(ref)
+
+
+def alignTraces(data, shift):
+  """
+    Delay every trace of an (nrec, nsamp) block by its shift in samples,
+    zero filling the start of the window and dropping what is shifted past
+    its end.  Whole samples are moved with one fancy-indexing gather and
+    the fractional remainders applied as linear phase ramps on the zero
+    padded FFT of the traces that need them.  Real and complex traces are
+    supported.
+  """
+  shift = np.broadcast_to(np.asarray(shift, dtype='f8'), (len(data),))
+  whole = np.floor(shift).astype('i8')
+  frac = shift - whole
+  m = data.shape[1]
+  src = np.arange(m)[None, :] - whole[:, None]
+  valid = (src >= 0) & (src < m)
+  out = np.take_along_axis(data, np.clip(src, 0, m - 1), axis=1)
+  out[~valid] = 0
+  rows = np.flatnonzero(frac)
+  if len(rows):
+    nfft = 1 << int(np.ceil(np.log2(m + 1)))
+    if np.iscomplexobj(out):
+      ramp = np.exp(-2j * np.pi * np.fft.fftfreq(nfft)[None, :] * frac[rows, None])
+      out[rows] = np.fft.ifft(np.fft.fft(out[rows], n=nfft, axis=1) * ramp, axis=1)[:, :m]
+    else:
+      ramp = np.exp(-2j * np.pi * np.fft.rfftfreq(nfft)[None, :] * frac[rows, None])
+      out[rows] = np.fft.irfft(np.fft.rfft(out[rows], n=nfft, axis=1) * ramp, n=nfft, axis=1)[:, :m]
+  return out
+
+
+###############################################
+#
+# Along-track stacking: consecutive traces with the same group key (every
+# n records, or each distance bin along the ground track) are averaged
+# coherently or as power, block by block with the unfinished group carried
+# over, and the ancillary and aux rows are decimated to the stack grid
+#
+###############################################
+def trackDistance(tlp, scet):
+  """
+    Along-track distance (km) of each record.  TLP is read from the Orbital
+    Data Table line preceding each record, so it holds its value between
+    updates; it is interpolated linearly in SCET between the records where
+    it changes, and extrapolated along the last segment.
+  """
+  tlp = np.asarray(tlp, dtype='f8')
+  ch = np.r_[0, np.flatnonzero(np.diff(tlp)) + 1]
+  if len(ch) < 2:
+    return tlp
+  d = np.interp(scet, scet[ch], tlp[ch])
+  slope = (tlp[ch[-1]] - tlp[ch[-2]]) / (scet[ch[-1]] - scet[ch[-2]])
+  tail = scet > scet[ch[-1]]
+  d[tail] = tlp[ch[-1]] + slope * (scet[tail] - scet[ch[-1]])
+  return d
+
+
+def stackKeys(iS, n, stack):
+  """
+    Group key of every record of science file iS: record // stack['n'], or
+    the stack['distance'] km bin of its trackDistance.  Only the TLP and
+    SCET columns are read.
+  """
+  recs = readRecords(iS, n)
+  if stack.get('distance'):
+    r = recordView(recs, ANC_DTYPE)
+    d = trackDistance(toNative(r['TLP']), scetSeconds(toNative(r['SCET_BLOCK_WHOLE']), toNative(r['SCET_BLOCK_FRAC'])))
+    return np.floor((d - d[:1]) / stack['distance']).astype('i8')
+  return np.arange(len(recs)) // int(stack['n'])
+
+
+def openStack(oS, oA, oX, keys, mask, stack, recs, meta={}, dtype='f4', fmt='csv', square=None):
+  """
+    Start the stacked product oS, always a self-describing SCI_EXT product
+    as its float traces have no legacy layout, with its decimated
+    ancillary (oA) and aux (oX) tables for the records selected by mask.
+    keys are the group keys of stackKeys, recs the science record view and
+    dtype that of the stacked traces.  Traces are squared before summing
+    when square is True (by default stack['power']); pass False for traces
+    that already are power.
+  """
+  k = keys[mask]
+  ngroup = int(np.count_nonzero(k[1:] != k[:-1])) + 1 if len(k) else 0
+  aux = readAux(stack['aux'], mmap=True)
+  if len(aux) == 0:
+    raise ValueError('No auxiliary records in {}'.format(stack['aux']))
+  info = {key: stack.get(key) for key in ['n', 'distance', 'power']}
+  return {'sci': openSci(oS, ngroup, dict(meta, product='stack', stack=info), dtype=dtype, scaled=True, fmt='sherpa'),
+          'anc': openTable(oA, fmt, ngroup), 'aux': openTable(oX, fmt, ngroup),
+          'keys': keys, 'power': stack.get('power', False) if square is None else square, 'recs': recs,
+          'auxRecs': aux, 'auxTimes': auxTimes(aux), 't0': float(aux['EPHEMERIS_TIME'][0]), 'carry': None}
+
+
+def appendStack(t, data, index):
+  """
+    Add the traces of the selected records index of one block, in record
+    order, to the stacks; every group finished by this block is written
+  """
+  if len(index) == 0:
+    return t
+  x = data.real**2 + data.imag**2 if t['power'] and np.iscomplexobj(data) else data**2 if t['power'] else data
+  k = t['keys'][index]
+  if t['carry'] is not None and t['carry']['key'] != k[0]:
+    flushStack(t)
+  c = t['carry']
+  #
+  # Sum every run of equal keys with one reduceat, then fold the carried
+  # partial group into the first
+  #
+  starts = np.r_[0, np.flatnonzero(k[1:] != k[:-1]) + 1]
+  sums = np.add.reduceat(x, starts, axis=0, dtype='c16' if np.iscomplexobj(x) else 'f8')
+  cnt = np.diff(np.r_[starts, len(k)])
+  m0 = 0
+  if c is not None:
+    sums[0] += c['sum']
+    m0 = len(c['index'])
+    index = np.r_[c['index'], index]
+  gstarts = np.r_[0, starts[1:] + m0]
+  cnt[0] += m0
+  centre = index[gstarts + cnt//2]
+  emitStack(t, sums[:-1], cnt[:-1], centre[:-1])
+  t['carry'] = {'key': k[-1], 'sum': sums[-1].copy(), 'index': index[gstarts[-1]:]}
+  return t
+
+
+def emitStack(t, sums, cnt, centre):
+  """
+    Write finished groups: the mean trace, the ancillary row of each
+    group's centre record and the aux row interpolated to its SCET (see
+    interpAux), with the number of traces stacked
+  """
+  if len(cnt) == 0:
+    return
+  appendSci(t['sci'], sums / cnt[:, None], 1., centre)
+  a = decodeAncillary(np.asarray(t['recs'][centre, :ANC_RECLEN]))
+  a['STACK_COUNT'] = cnt
+  appendTable(t['anc'], a, centre)
+  tq = scetSeconds(a['SCET_BLOCK_WHOLE'], a['SCET_BLOCK_FRAC'])
+  x = interpAux(t['auxRecs'], t['auxTimes'], tq, t0=t['t0'])
+  x['STACK_COUNT'] = cnt
+  appendTable(t['aux'], x, centre)
+
+
+def flushStack(t):
+  """
+    Write the carried, unfinished group
+  """
+  c = t['carry']
+  if c is not None:
+    emitStack(t, c['sum'][None, :], np.array([len(c['index'])]), c['index'][[len(c['index'])//2]])
+    t['carry'] = None
+
+
+def closeStack(t):
+  flushStack(t)
+  closeTable(t['anc'])
+  closeTable(t['aux'])
+  return closeSci(t['sci'])
+
+
+###############################################
+#
+# Lazy observation access: the label's files are memory mapped on first
+# use and only the records that are indexed are decoded
+#
+###############################################
+class Records(object):
+  """
+    Sliceable view of the fixed-length records of one file.  load() opens
+    the records (a memmap) the first time they are needed and decode()
+    turns a block of them into arrays.  Indexing with a slice, an array of
+    record numbers or a boolean mask decodes only those records, and an
+    integer one record without the record axis; time(t0, t1) selects them
+    by the EPHEMERIS_TIME of each record given by times().
+  """
+  def __init__(self, obs, load, decode, times):
+    self.obs = obs
+    self.load = load
+    self.decode = decode
+    self.times = times
+
+  @cached_property
+  def records(self):
+    return self.load()
+
+  def __len__(self):
+    return len(self.records)
+
+  def __getitem__(self, key):
+    if isinstance(key, (int, np.integer)):
+      key = range(len(self))[key]
+      out = self.decode(self.records[key:key+1])
+      return {k: v[0] for k, v in out.items()} if isinstance(out, dict) else out[0]
+    elif not isinstance(key, slice):
+      key = np.asarray(key)
+    return self.decode(self.records[key])
+
+  def time(self, t0=None, t1=None):
+    return self[self.obs.timeSlice(t0, t1, self.times())]
+
+
+class Observation(object):
+  """
+    One EDR observation opened from its PDS label.  Nothing is read until
+    it is used:
+
+      obs = Observation(lblFile)
+      obs.aux[100:200]        auxiliary columns of records 100..199
+      obs.ancillary[100:200]  decoded ancillary headers
+      obs.science[100:200]    decompressed (n, 3600) float32 echoes
+      obs.samples[100:200]    compressed (n, 3600) int8 samples
+      obs.science.time(t0, t1)
+      obs.geometry            aux geometry interpolated onto every trace
+
+    Times are EPHEMERIS_TIME: that of each record for the aux view, and for
+    the science, sample and ancillary views that of each trace's SCET (see
+    traceTime), so the two files need not line up record for record.
+  """
+  def __init__(self, lblFile):
+    self.files = findFiles(lblFile)
+    self.transID, self.ostLine, self.mode = parseFileName(self.files['SCIENCE'])
+    self.nrec = self.mode['nrec']
+    self.bits = self.mode['BitsPerSample']
+    self.presum = self.mode['Presum']
+    self.recLen = self.mode['recLen']
+
+  def __repr__(self):
+    return 'Observation({}, {}, {} records)'.format(os.path.basename(self.files['LABEL']), self.mode['Mode'], self.nrec)
+
+  def __len__(self):
+    return self.nrec
+
+  #
+  # Memory mapped records, opened once
+  #
+  @cached_property
+  def auxRecords(self):
+    return readAux(self.files['AUX'], mmap=True)
+
+  @cached_property
+  def sciRecords(self):
+    return readRecords(self.files['SCIENCE'], self.recLen)
+
+  @cached_property
+  def ephemerisTime(self):
+    return toNative(self.auxRecords['EPHEMERIS_TIME'])
+
+  @cached_property
+  def traceTime(self):
+    """
+      EPHEMERIS_TIME of every trace: the aux EPHEMERIS_TIME interpolated onto
+      its SCET, continued at one second per second outside the aux span
+    """
+    if len(self.auxRecords) == 0:
+      raise ValueError('No auxiliary records in {}'.format(self.files['AUX']))
+    t, keep = auxTimes(self.auxRecords)
+    tq = traceTimes(self.files['SCIENCE'], self.recLen)
+    i, w = interpWeights(t, tq)
+    return interpColumn(self.ephemerisTime[keep].astype('f8'), i, w) + tq - np.clip(tq, t[0], t[-1])
+
+  def timeSlice(self, t0=None, t1=None, et=None):
+    """
+      Slice of the records with t0 <= EPHEMERIS_TIME <= t1; either bound
+      may be None.  et holds the times of the records, by default those of
+      the aux records.
+    """
+    et = self.ephemerisTime if et is None else et
+    return slice(0 if t0 is None else int(np.searchsorted(et, t0, 'left')),
+                 len(et) if t1 is None else int(np.searchsorted(et, t1, 'right')))
+
+  #
+  # Sliceable views
+  #
+  @cached_property
+  def geometry(self):
+    """
+      Per-trace geometry interpolated from the aux records (see joinGeometry)
+    """
+    return joinGeometry(self.files['AUX'], self.files['SCIENCE'], self.recLen)
+
+  @cached_property
+  def aux(self):
+    t0 = lambda: float(self.ephemerisTime[0]) if len(self.ephemerisTime) else 0.
+    return Records(self, lambda: self.auxRecords, lambda r: decodeAux(r, t0=t0()),
+                   lambda: self.ephemerisTime)
+
+  @cached_property
+  def ancillary(self):
+    return Records(self, lambda: self.sciRecords, lambda r: decodeAncillary(r[:, :ANC_RECLEN]),
+                   lambda: self.traceTime)
+
+  @cached_property
+  def samples(self):
+    return Records(self, lambda: self.sciRecords, lambda r: unpackSamples(r[:, ANC_RECLEN:], self.bits),
+                   lambda: self.traceTime)
+
+  @cached_property
+  def science(self):
+    return Records(self, lambda: self.sciRecords, self.decompress, lambda: self.traceTime)
+
+  def scale(self, recs):
+    """
+      Decompression factor of each of a block of science records
+    """
+    a = decodeAncillary(recs[:, :ANC_RECLEN])
+    decom = getDecom(a['OST_COMPRESSION_SELECTION'], self.presum, self.bits, a['SDI_BIT_FIELD'])
+    return np.broadcast_to(decom, (len(recs), 1))[:, 0]
+
+  def decompress(self, recs):
+    return (unpackSamples(recs[:, ANC_RECLEN:], self.bits) * self.scale(recs)[:, None]).astype('f4')
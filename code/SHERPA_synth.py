@@ -0,0 +1,260 @@
+from SHERPA_funcs import *
+
+###############################################
+#
+# Synthetic SHARAD EDR observations: science/ancillary telemetry, 267-byte
+# auxiliary records and a PDS label for any mode in SSInstrMode/ROInstrMode.
+# The values are random but well formed, so every stage of the pipeline
+# can be run and timed without real MRO data
+#
+###############################################
+#
+# OST_PULSE_REPETITION_INTERVAL code of each PRF named in the file names
+# (see PRI_LUT and detPRF)
+#
+PRI_CODE = {'387': 0, '700': 1, '670': 2, '775': 3, '350': 4, '335': 5}
+C_LIGHT = 299792.458
+ADC_DT = 0.0375e-6
+GROUND_SPEED = 3.0
+
+
+def modeInfo(mode):
+  """
+    Return the SSInstrMode / ROInstrMode entry of mode, e.g. 'SS05'
+  """
+  mode = mode.upper()
+  table = SSInstrMode if mode[0:2] == 'SS' else ROInstrMode
+  if mode not in table:
+    raise ValueError('Unknown instrument mode {}'.format(mode))
+  return dict(table[mode])
+
+
+def groundTrack(nrec, track=(-60., 120., 60., 110.)):
+  """
+    Latitude and east longitude of nrec records evenly spaced on a straight
+    line in latitude/longitude, track = (lat0, lon0, lat1, lon1).
+    Longitudes may cross 0/360 and are wrapped into [0, 360).
+  """
+  lat0, lon0, lat1, lon1 = track
+  lats = np.linspace(lat0, lat1, nrec)
+  lons = np.linspace(lon0, lon1, nrec) % 360.
+  return lats, lons
+
+
+def packSamples(s, b):
+  """
+    Inverse of unpackSamples: pack an (nrec, n) int8 array of b-bit signed
+    samples (b = 4, 6 or 8) MSB first into an (nrec, n*b/8) uint8 array
+  """
+  s = np.ascontiguousarray(s, dtype='i1').view('u1')
+  nrec = s.shape[0]
+  if b == 8:
+    return s
+  elif b == 4:
+    return ((s[:, 0::2] & 0x0F) << 4) | (s[:, 1::2] & 0x0F)
+  elif b == 6:
+    v = (s & 0x3F).reshape(nrec, -1, 4)
+    out = np.empty((nrec, v.shape[1], 3), dtype='u1')
+    out[:, :, 0] = (v[:, :, 0] << 2) | (v[:, :, 1] >> 4)
+    out[:, :, 1] = ((v[:, :, 1] & 0x0F) << 4) | (v[:, :, 2] >> 2)
+    out[:, :, 2] = ((v[:, :, 2] & 0x03) << 6) | v[:, :, 3]
+    return out.reshape(nrec, -1)
+  raise ValueError('Unsupported bits per sample: {}'.format(b))
+
+
+def sclk(t):
+  """
+    Split times in seconds into whole seconds and 2^-16 s fractions
+  """
+  whole = np.floor(t)
+  return whole.astype('u4'), np.round((t - whole) * 65536).clip(0, 65535).astype('u2')
+
+
+def makeAux(fname, nrec, seed=0, track=(-60., 120., 60., 110.), et0=3e8, dt=0.0298, alt=None):
+  """
+    Write nrec auxiliary records to fname along a ground track (see
+    groundTrack).  Records are dt seconds apart starting at ephemeris time
+    et0; alt optionally gives the spacecraft altitude (km) of every record.
+    TX_TEMP/RX_TEMP fall within the reference chirp temperature bins.
+  """
+  rng = np.random.default_rng(seed)
+  recs = np.zeros(nrec, dtype=AUX_DTYPE)
+  for key in AUX_DTYPE.names:
+    kind = AUX_DTYPE[key].kind
+    if kind == 'f':
+      recs[key] = rng.uniform(-180, 180, nrec)
+    elif kind in 'ui':
+      recs[key] = rng.integers(0, 2**15, nrec)
+  t = et0 + np.arange(nrec) * dt
+  recs['EPHEMERIS_TIME'] = t
+  recs['SCET_BLOCK_WHOLE'], recs['SCET_BLOCK_FRAC'] = sclk(t - et0 + 1e9)
+  recs['GEOMETRY_EPOCH'] = b'2010-01-01T00:00:00.000'
+  lats, lons = groundTrack(nrec, track)
+  recs['SUB_SC_PLANETOCENTRIC_LATITUDE'] = lats
+  recs['SUB_SC_PLANETOGRAPHIC_LATITUDE'] = lats
+  recs['SUB_SC_EAST_LONGITUDE'] = lons
+  recs['SPACECRAFT_ALTITUDE'] = alt if alt is not None else 300. + 20. * np.sin(np.linspace(0, np.pi, nrec))
+  recs['ORBIT_NUMBER'] = 12345
+  recs['TX_TEMP'] = rng.uniform(-10, 50, nrec)
+  recs['RX_TEMP'] = rng.uniform(-10, 50, nrec)
+  recs['CORRUPTED_DATA_FLAG'] = 0
+  recs.tofile(fname)
+  return fname
+
+
+def makeAncillary(nrec, mode, prf='700', t=None, alt=None, seed=0, dynamic=False):
+  """
+    Build nrec 186-byte ancillary headers as an ANC_DTYPE array.  t and alt
+    are the record times (s) and spacecraft altitudes (km); the receive
+    window follows the altitude in 128-sample steps.  dynamic selects
+    dynamic scaling with random SDI_BIT_FIELD values.
+  """
+  rng = np.random.default_rng(seed)
+  info = modeInfo(mode)
+  t = np.arange(nrec) * info['Presum'] / detPRF(prf) if t is None else t - t[0]
+  alt = np.full(nrec, 300.) if alt is None else alt
+  recs = np.zeros(nrec, dtype=ANC_DTYPE)
+  recs['SCET_BLOCK_WHOLE'], recs['SCET_BLOCK_FRAC'] = sclk(t + 1e9)
+  recs['SCET_OST_WHOLE'], recs['SCET_OST_FRAC'] = sclk(np.full(nrec, 1e9))
+  recs['TLM_COUNTER'] = np.arange(nrec)
+  recs['FMT_LENGTH'] = info['recLen']
+  recs['OST_LINE_NUMBER'] = 1
+  #
+  # OST_LINE bit fields, MSB first, at their science_ancillary.fmt
+  # positions; all of them lie in the first 64 bits
+  #
+  fields = {'OST_PULSE_REPETITION_INTERVAL': PRI_CODE[str(prf)],
+            'OST_OPERATIVE_MODE': int(info['Mode'][2:]),
+            'OST_COMPRESSION_SELECTION': int(dynamic),
+            'OST_TRACKING_PRE_SUMMING': 1}
+  hi = np.uint64(0)
+  for p in compileFMT('science_ancillary.fmt')['plan']:
+    if p['name'] in fields:
+      hi |= np.uint64(fields[p['name']]) << np.uint64(64 - planStart(p) - p['bits'])
+  recs['OST_LINE'][:, :8] = np.frombuffer(np.array(hi, dtype='>u8').tobytes(), dtype='u1')
+  recs['DATA_BLOCK_ID'] = np.stack([(np.arange(nrec) >> s) & 0xFF for s in [16, 8, 0]], axis=1)
+  recs['SCIENCE_DATA_SOURCE_COUNTER'] = np.arange(nrec) & 0xFFFF
+  recs['SDI_BIT_FIELD'] = rng.integers(0, 6, nrec) if dynamic else 0
+  recs['TIME_N'] = t
+  recs['RADIUS_N'] = 3396. + alt
+  recs['TANGENTIAL_VELOCITY_N'] = GROUND_SPEED
+  recs['TLP'] = GROUND_SPEED * recs['TIME_N']
+  recs['TLP_INTERPOLATE'] = recs['TLP']
+  recs['RADIUS_INTERPOLATE'] = recs['RADIUS_N']
+  recs['TANGENTIAL_VELOCITY_INTERPOLATE'] = GROUND_SPEED
+  recs['RECEIVE_WINDOW_OPENING_TIME'] = surfaceDelay(alt) // 128 * 128 - 1024
+  recs['RECEIVE_WINDOW_POSITION'] = np.roll(recs['RECEIVE_WINDOW_OPENING_TIME'], 1)
+  return recs
+
+
+def surfaceDelay(alt):
+  """
+    Two-way travel time to the surface in ADC samples for altitudes in km
+  """
+  return np.round(2 * np.asarray(alt) / C_LIGHT / ADC_DT)
+
+
+def makeEchoes(nrec, b, rwot=None, alt=None, n=NSAMP, seed=0):
+  """
+    nrec b-bit echoes of n samples: noise plus a decaying surface return
+    at the sample where the altitude's delay falls in the receive window
+  """
+  rng = np.random.default_rng(seed)
+  top = 2**(b-1) - 1
+  s = rng.normal(0, top / 8., (nrec, n))
+  if rwot is not None and alt is not None:
+    pos = (surfaceDelay(alt) - rwot).astype(int)
+    k = np.arange(n)[None, :] - pos[:, None]
+    s += np.where(k >= 0, top * 0.8 * np.exp(-k / 40.) * np.cos(k * 0.7), 0.)
+  return np.clip(np.round(s), -top - 1, top).astype('i1')
+
+
+def makeScience(fname, mode, nrec, prf='700', t=None, alt=None, seed=0, dynamic=False):
+  """
+    Write nrec science records (ancillary header followed by the packed
+    echo samples) of the given mode to fname
+  """
+  info = modeInfo(mode)
+  b = info['BitsPerSample']
+  anc = makeAncillary(nrec, mode, prf, t, alt, seed, dynamic)
+  rec = np.zeros((nrec, info['recLen']), dtype='u1')
+  rec[:, :ANC_RECLEN] = anc.view('u1').reshape(nrec, ANC_RECLEN)
+  s = makeEchoes(nrec, b, toNative(anc['RECEIVE_WINDOW_OPENING_TIME']), alt, seed=seed)
+  rec[:, ANC_RECLEN:ANC_RECLEN + NSAMP*b//8] = packSamples(s, b)
+  rec.tofile(fname)
+  return fname
+
+
+def makeLabel(fname, sciFile, auxFile, mode, nrec, prf='700'):
+  """
+    Write a minimal PDS3 label pointing at the science and auxiliary files
+  """
+  info = modeInfo(mode)
+  pid = os.path.basename(fname)[:-4].upper()
+  lines = ['PDS_VERSION_ID               = PDS3',
+           'PRODUCT_ID                   = "{}"'.format(pid),
+           'INSTRUMENT_ID                = SHARAD',
+           'INSTRUMENT_MODE_ID           = "{}"'.format(info['Mode']),
+           'MRO:PULSE_REPETITION_FREQUENCY = {}'.format(detPRF(prf)),
+           '^SCIENCE_TELEMETRY_TABLE     = "{}"'.format(os.path.basename(sciFile).upper()),
+           '^AUXILIARY_DATA_TABLE        = "{}"'.format(os.path.basename(auxFile).upper()),
+           'OBJECT                       = SCIENCE_TELEMETRY_TABLE',
+           '  ROWS                       = {}'.format(nrec),
+           '  ROW_BYTES                  = {}'.format(info['recLen']),
+           'END_OBJECT                   = SCIENCE_TELEMETRY_TABLE',
+           'OBJECT                       = AUXILIARY_DATA_TABLE',
+           '  ROWS                       = {}'.format(nrec),
+           '  ROW_BYTES                  = {}'.format(AUX_RECLEN),
+           '  ^STRUCTURE                 = "AUXILIARY.FMT"',
+           'END_OBJECT                   = AUXILIARY_DATA_TABLE',
+           'END']
+  with open(fname, 'w') as f:
+    f.write('\r\n'.join(lines) + '\r\n')
+  return fname
+
+
+def makeObservation(outDir, mode='SS05', nrec=1000, prf='700', transID='0000001', ostLine='001',
+                    track=(-60., 120., 60., 110.), seed=0, dynamic=False):
+  """
+    Write a complete synthetic observation (label, science and auxiliary
+    files named like the PDS EDRs) to outDir and return the label path
+  """
+  info = modeInfo(mode)
+  os.makedirs(outDir, exist_ok=True)
+  base = os.path.join(outDir, 'e_{}_{}_{}_{}'.format(transID, ostLine, info['Mode'].lower(), prf))
+  dt = info['Presum'] / detPRF(prf)
+  t = np.arange(nrec) * dt
+  alt = 300. + 20. * np.sin(np.linspace(0, np.pi, nrec))
+  makeAux(base + '_a.dat', nrec, seed, track, dt=dt, alt=alt)
+  makeScience(base + '_s.dat', info['Mode'], nrec, prf, t, alt, seed, dynamic)
+  return makeLabel(base + '.lbl', base + '_s.dat', base + '_a.dat', info['Mode'], nrec, prf)
+
+
+def main():
+  prog = "SHARAD Synthetic EDR Generator"
+  vers = "0.1"
+  parser = argparse.ArgumentParser(description=str(prog + ' ' + vers))
+  parser.add_argument('outDir', type=str, nargs=1,
+                      help=str('Directory to write the observation to'))
+  parser.add_argument('-m', '--mode', nargs=1, default=['SS05'], type=str,
+                     help=str('Instrument mode, SS01-SS21 or RO01-RO21'))
+  parser.add_argument('-n', '--nrec', nargs=1, default=[1000], type=int,
+                     help=str('Number of records'))
+  parser.add_argument('-p', '--prf', nargs=1, default=['700'], type=str, choices=sorted(PRI_CODE),
+                     help=str('PRF code used in the file names'))
+  parser.add_argument('-t', '--track', nargs=4, default=[-60., 120., 60., 110.], type=float,
+                     help=str('Ground track: startLat startLon endLat endLon'))
+  parser.add_argument('-s', '--seed', nargs=1, default=[0], type=int,
+                     help=str('Random seed'))
+  parser.add_argument('-d', '--dynamic', action="store_true", default=False,
+                     help=str('Use dynamic scaling with random SDI values'))
+  if len(sys.argv[1:]) == 0:
+    parser.print_help()
+    parser.exit()
+  args = parser.parse_args()
+  print(makeObservation(args.outDir[0], args.mode[0], args.nrec[0], args.prf[0],
+                        track=args.track, seed=args.seed[0], dynamic=args.dynamic))
+  return
+
+if __name__ == '__main__':
+  main()
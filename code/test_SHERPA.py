@@ -0,0 +1,297 @@
+from SHERPA import *
+from SHERPA_synth import makeObservation
+import pytest
+
+#
+# Box crossed by the default synthetic ground track (-60, 120) -> (60, 110)
+#
+ROI = [-10., 100., 10., 130.]
+
+@pytest.fixture(scope='module')
+def lbl(tmp_path_factory):
+  return makeObservation(str(tmp_path_factory.mktemp('edr')), 'SS05', 300)
+
+
+def nrecOut(outDir, lbl):
+  _, oFiles = formOut(lbl, outDir)
+  return len(readTable(tableName(oFiles['ANCILLARY'], 'csv')))
+
+###############################################
+#
+# ROI arguments
+#
+###############################################
+def test_roiFileOneBox(lbl, tmp_path):
+  roiFile = tmp_path / 'roi.txt'
+  roiFile.write_text('{} {} {} {}\n'.format(*ROI))
+  assert sherpa(lbl, str(tmp_path / 'file'), str(roiFile))
+  assert sherpa(lbl, str(tmp_path / 'box'), ROI)
+  assert 0 < nrecOut(str(tmp_path / 'file'), lbl) == nrecOut(str(tmp_path / 'box'), lbl) < 300
+
+
+@pytest.mark.parametrize('roi', ['empty', []])
+def test_roiNone(lbl, tmp_path, roi):
+  if roi == 'empty':
+    roi = str(tmp_path / 'roi.txt')
+    open(roi, 'w').close()
+  assert sherpa(lbl, str(tmp_path / 'out'), roi)
+  assert nrecOut(str(tmp_path / 'out'), lbl) == 300
+  e = readManifest(os.path.join(str(tmp_path / 'out'), MANIFEST))[os.path.abspath(lbl)]
+  assert e['roi'] == []
+
+###############################################
+#
+# Science product layouts
+#
+###############################################
+def test_sciDefaultRaw(lbl, tmp_path):
+  assert sherpa(lbl, str(tmp_path / 'raw'), [None,None,None,None])
+  assert sherpa(lbl, str(tmp_path / 'product'), [None,None,None,None], sci='sherpa')
+  _, oRaw = formOut(lbl, str(tmp_path / 'raw'))
+  _, oSci = formOut(lbl, str(tmp_path / 'product'))
+  assert os.path.getsize(oRaw['SCIENCE']) == 300 * NSAMP
+  assert not os.path.exists(oSci['SCIENCE'])
+  d, h = readSci(sciName(oSci['SCIENCE'], 'sherpa'))
+  assert h['version'] == SCI_VERSION and d.shape == (300, NSAMP)
+  for o, version in [(oRaw, None), (oSci, SCI_VERSION)]:
+    assert readManifest(o['MANIFEST'])[os.path.abspath(lbl)]['sciVersion'] == version
+
+
+def test_alignFloatProduct(lbl, tmp_path):
+  out = str(tmp_path / 'out')
+  assert sherpa(lbl, out, [None,None,None,None], sci='sherpa', sciDtype='packed', align=True)
+  _, oFiles = formOut(lbl, out)
+  assert readSci(sciName(oFiles['SCIENCE'], 'sherpa'))[0].dtype == np.float32
+  assert readManifest(oFiles['MANIFEST'])[os.path.abspath(lbl)]['opts']['sciDtype'] == 'float32'
+  assert upToDate(lbl, oFiles['MANIFEST'], [None,None,None,None], {'sci': 'sherpa', 'sciDtype': 'packed', 'align': True})
+
+
+def test_stackSerialLogged(lbl, tmp_path):
+  out = str(tmp_path / 'out')
+  assert sherpa(lbl, out, [None,None,None,None], workers=2, stack=10)
+  _, oFiles = formOut(lbl, out)
+  assert 'decoding serially instead of on 2 worker processes' in open(oFiles['LOG']).read()
+
+
+###############################################
+#
+# Dynamic decompression
+#
+###############################################
+def test_getDecomDynamic():
+  assert getDecom(False, 32, 8, np.zeros(4)) == 1.
+  decom = getDecom([0, 1, 1, 1, 1], 32, 8, [9, 3, 10, 20, 0])
+  assert decom.shape == (5, 1) and np.array_equal(decom[:, 0], np.array([32., 8., 16., 16., 1.]) / 32)
+
+
+def test_sepSAdataDynamic(tmp_path, capsys):
+  lbl = makeObservation(str(tmp_path / 'edr'), 'SS21', 200, dynamic=True)
+  iS = findFiles(lbl)['SCIENCE']
+  m = parseFileName(iS)[2]
+  recs = readRecords(iS, m['recLen'])
+  a = decodeAncillary(recs[:, :ANC_RECLEN])
+  want = unpackSamples(recs[:, ANC_RECLEN:], m['BitsPerSample']) * \
+         getDecom(a['OST_COMPRESSION_SELECTION'], m['Presum'], m['BitsPerSample'], a['SDI_BIT_FIELD'])
+  assert want.min() < -128 and want.max() > 127
+  oS, oA = str(tmp_path / 'out.sci'), str(tmp_path / 'out')
+  sepSAdata(iS, oS, oA, m['recLen'], m['BitsPerSample'], m['Presum'], block=64)
+  assert np.array_equal(np.fromfile(oS, dtype='i1').reshape(-1, NSAMP), np.clip(want, -128, 127))
+  assert 'clipped' in capsys.readouterr().out
+  sepSAdata(iS, oS, oA, m['recLen'], m['BitsPerSample'], m['Presum'], sci='sherpa', sciDtype='float32')
+  assert np.array_equal(readSci(sciName(oS, 'sherpa'))[0], want)
+
+
+###############################################
+#
+# Record decoders against the format files
+#
+###############################################
+def test_ancillaryMatchesFMT():
+  buf = np.random.default_rng(0).integers(0, 256, (1000, ANC_RECLEN), dtype='u1')
+  a = decodeAncillary(buf)
+  f = decodeFMT(buf, 'science_ancillary.fmt')
+  assert list(a) == [ANC_NAMES.get(key, key) for key in f]
+  for key in f:
+    if key in ANC_LUTS:
+      want = ANC_LUTS[key][f[key]]
+    elif key in ANC_TYPES:
+      want = toNative(f[key].astype(compileFMT('science_ancillary.fmt')['dtype'][key]).view(ANC_TYPES[key]))
+    else:
+      want = f[key]
+    got = a[ANC_NAMES.get(key, key)]
+    assert got.dtype == want.dtype and np.array_equal(got, want, equal_nan=got.dtype.kind == 'f'), key
+
+
+def test_auxMatchesFMT(lbl):
+  recs = readAux(findFiles(lbl)['AUX'])
+  a = decodeAux(recs)
+  f = decodeFMT(recs, 'auxiliary.fmt')
+  assert [key for key in a if key != 'ELAPSED_TIME'] == list(f)
+  for key in f:
+    assert a[key].dtype == f[key].dtype and np.array_equal(a[key], f[key]), key
+
+###############################################
+#
+# Batch driver
+#
+###############################################
+def test_batchMissingData(lbl, tmp_path):
+  from SHERPA_batch import batch
+  import shutil
+  src = tmp_path / 'edr'
+  shutil.copytree(os.path.dirname(lbl), str(src))
+  good = str(src / os.path.basename(lbl))
+  bad = str(src / 'e_0000002_001_ss05_700.lbl')
+  with open(good) as f:
+    open(bad, 'w').write(f.read().replace('0000001', '0000002'))
+  out = str(tmp_path / 'out')
+  res = batch([good, bad], out, workers=1, verb=False)
+  assert [r['STATUS'] for r in res] == ['OK', 'FAILED'] and 'FileNotFoundError' in res[1]['ERROR']
+  #
+  # A label whose data went missing after it was processed
+  #
+  os.remove(findFiles(good)['SCIENCE'])
+  res = batch([good, bad], out, workers=1, verb=False, resume=True)
+  assert [r['STATUS'] for r in res] == ['FAILED', 'FAILED']
+
+
+def test_batchInterrupt(lbl, tmp_path, monkeypatch):
+  import SHERPA_batch
+  def interrupt(*args, **kwargs):
+    raise KeyboardInterrupt
+  monkeypatch.setattr(SHERPA_batch, 'sherpa', interrupt)
+  with pytest.raises(KeyboardInterrupt):
+    SHERPA_batch.batch([lbl], str(tmp_path / 'out'), workers=1, verb=False)
+
+###############################################
+#
+# Trace geometry
+#
+###############################################
+def shiftedCopy(lbl, tmp_path, naux=None):
+  """
+    Copy of the observation with the science clock moved 0.1 s (about 17
+    traces) off the aux records, so the trace geometry and the aux
+    positions disagree, and the aux file cut to naux records
+  """
+  import shutil
+  src = str(tmp_path / 'edr')
+  shutil.copytree(os.path.dirname(lbl), src)
+  lbl = os.path.join(src, os.path.basename(lbl))
+  iFiles = findFiles(lbl)
+  n = parseFileName(iFiles['SCIENCE'])[2]['recLen']
+  recs = np.memmap(iFiles['SCIENCE'], dtype='u1', mode='r+').reshape(-1, n)
+  r = recordView(recs, ANC_DTYPE)
+  t = scetSeconds(toNative(r['SCET_BLOCK_WHOLE']), toNative(r['SCET_BLOCK_FRAC'])) + 0.1
+  r['SCET_BLOCK_WHOLE'] = np.floor(t)
+  r['SCET_BLOCK_FRAC'] = np.round((t - np.floor(t)) * 65536)
+  recs.flush()
+  del r, recs
+  if naux is not None:
+    os.truncate(iFiles['AUX'], naux * AUX_RECLEN)
+  return lbl, iFiles, n
+
+#
+# Box over the end of the track, past the end of a truncated aux file
+#
+END_ROI = [30., 100., 60., 130.]
+
+@pytest.mark.parametrize('roi,naux', [(ROI, None), ([ROI, [-30., 100., -5., 130.]], None),
+                                      (END_ROI, 250), ([END_ROI, ROI], 250)])
+def test_geometryCutsAux(lbl, tmp_path, roi, naux):
+  lbl, iFiles, n = shiftedCopy(lbl, tmp_path, naux)
+  out = str(tmp_path / 'out')
+  assert sherpa(lbl, out, roi, geometry=True)
+  _, oFiles = formOut(lbl, out)
+  tags = [''] if np.ndim(roi) == 1 else ['_ROI01', '_ROI02']
+  geo = joinGeometry(iFiles['AUX'], iFiles['SCIENCE'], n)
+  aux = readAux(iFiles['AUX'])
+  tAux = scetSeconds(toNative(aux['SCET_BLOCK_WHOLE']), toNative(aux['SCET_BLOCK_FRAC']))
+  for _k, tag in enumerate(tags):
+    index = {key: readTable(tableName(os.path.splitext(oFiles[key])[0] + tag, 'csv')).index
+             for key in ['AUX', 'ANCILLARY', 'GEOMETRY']}
+    want = np.flatnonzero(geometryMasks(geo, getROIs(roi))[_k])
+    assert 0 < len(want) and np.array_equal(index['ANCILLARY'], want) and np.array_equal(index['GEOMETRY'], want)
+    #
+    # The aux records run from the one at or before the first trace to the
+    # one at or after the last, and never past the end of the aux file
+    #
+    t0, t1 = geo['SCET'][want[0]], geo['SCET'][want[-1]]
+    s = max(np.flatnonzero(tAux <= t0)[-1:].tolist() + [0])
+    e = min(np.flatnonzero(tAux >= t1)[:1].tolist() + [len(tAux) - 1])
+    assert np.array_equal(index['AUX'], np.arange(s, e + 1))
+    assert not np.array_equal(index['AUX'], want)
+
+###############################################
+#
+# Along-track stacking
+#
+###############################################
+def test_stackProduct(lbl, tmp_path):
+  lbl, iFiles, n = shiftedCopy(lbl, tmp_path, 250)
+  out = str(tmp_path / 'out')
+  assert sherpa(lbl, out, [None,None,None,None], stack=10, fmt='npz')
+  _, oFiles = formOut(lbl, out)
+  #
+  # Stacks are float products, so never a headerless .sci stream
+  #
+  d, h = readSci(oFiles['STACK'])
+  assert oFiles['STACK'].endswith(SCI_EXT) and d.shape == (30, NSAMP) and d.dtype == np.float32
+  #
+  # The aux rows follow the SCET of each stack's centre trace, also past
+  # the end of the aux file
+  #
+  x = readTable(tableName(oFiles['STACK_AUX'], 'npz'))
+  geo = joinGeometry(iFiles['AUX'], iFiles['SCIENCE'], n)
+  assert np.array_equal(x.index, h['RECORD'])
+  for key in ['SUB_SC_PLANETOCENTRIC_LATITUDE', 'SUB_SC_EAST_LONGITUDE', 'SPACECRAFT_ALTITUDE']:
+    assert np.allclose(x[key], geo[key][h['RECORD']]), key
+
+###############################################
+#
+# Range compression
+#
+###############################################
+def test_chirpTempsBySCET(lbl, tmp_path):
+  lbl, iFiles, n = shiftedCopy(lbl, tmp_path, 250)
+  out = str(tmp_path / 'out')
+  assert sherpa(lbl, out, [None,None,None,None], rc='power', sci='sherpa')
+  _, oFiles = formOut(lbl, out)
+  d, h = readSci(sciName(oFiles['RC'], 'sherpa'))
+  #
+  # Each trace's chirp follows the aux temperatures at its own SCET, not
+  # those of the aux record with its record number
+  #
+  temps = joinGeometry(iFiles['AUX'], iFiles['SCIENCE'], n, columns=['TX_TEMP', 'RX_TEMP'])
+  echo = Observation(lbl).science[:].astype('f4')
+  want = rangeCompression(echo, traceFilters(temps['TX_TEMP'], temps['RX_TEMP']), power=True)
+  assert d.shape == (300, NSAMP) and np.allclose(d, want, rtol=1e-5, atol=1e-3 * np.abs(want).max())
+  aux = readAux(iFiles['AUX'])
+  idx = np.minimum(np.arange(300), len(aux) - 1)
+  old = rangeCompression(echo, traceFilters(toNative(aux['TX_TEMP'])[idx], toNative(aux['RX_TEMP'])[idx]), power=True)
+  assert not np.allclose(d, old, rtol=1e-5, atol=1e-3 * np.abs(want).max())
+
+###############################################
+#
+# Observation views
+#
+###############################################
+def test_observationTime(lbl, tmp_path):
+  lbl, iFiles, n = shiftedCopy(lbl, tmp_path, 250)
+  obs = Observation(lbl)
+  assert obs.science[5].shape == (NSAMP,) and np.array_equal(obs.science[5], obs.science[5:6][0])
+  assert np.ndim(obs.aux[5]['EPHEMERIS_TIME']) == 0 and np.ndim(obs.ancillary[-1]['SCET_BLOCK_WHOLE']) == 0
+  #
+  # The science and ancillary views are cut on the time of each trace,
+  # which leads the aux record of the same number by the 0.1 s shift and
+  # runs on past the end of the aux file
+  #
+  et = obs.aux[:]['EPHEMERIS_TIME']
+  t0, t1 = et[100], et[-1] + 10.
+  a = obs.ancillary.time(t0, t1)
+  tAux = scetSeconds(obs.aux[100]['SCET_BLOCK_WHOLE'], obs.aux[100]['SCET_BLOCK_FRAC'])
+  scet = traceTimes(iFiles['SCIENCE'], n)
+  want = np.flatnonzero(scet >= tAux)
+  assert np.array_equal(scetSeconds(a['SCET_BLOCK_WHOLE'], a['SCET_BLOCK_FRAC']), scet[want])
+  assert want[0] < 100 and want[-1] == 299
+  assert np.array_equal(obs.science.time(t0, t1), obs.science[want]) and len(obs.aux.time(t0, t1)['EPHEMERIS_TIME']) == 150